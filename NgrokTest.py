@@ -1,27 +1,49 @@
-from flask import Flask, render_template_string, request, jsonify, make_response, session, redirect
+from flask import (Flask, render_template_string, request, jsonify, make_response, session, redirect,
+                   Response, stream_with_context, g)
 import os
-import base64
+import io
 import json
-from openai import OpenAI
+import hashlib
+import time
 from datetime import datetime
-import threading
+import csv
+import zlib
+import uuid
+
+from mathocr.admission import IMAGE_TOKEN_ESTIMATE, UpstreamBusyError, upstream_user
+from mathocr.analysis import ANALYZE_MODE, AnalysisError, analyze_files, collect_pages
+from mathocr.cache import analysis_cache_key, cached_analysis, dedupe_by_number, file_digest, store_analysis
+from mathocr.crops import REANALYZE_CROPS, analysis_pages
+from mathocr.database import db
+from mathocr.history import HISTORY_PAGE_SIZE, analysis_history
+from mathocr.images import IMAGE_MAX_SHORT_SIDE, IMAGE_MAX_SIDE, IMAGE_PREPROCESS
+from mathocr.jobs import JOB_DIR, job_queue
+from mathocr.login_log import login_filter_sql, login_log
+from mathocr.metrics import usage_meter
+from mathocr.openai_client import get_openai_client
+from mathocr.pages import page_index
+from mathocr.parsing import ModelReplyError
+from mathocr.practice import practice_bank, run_practice_generation
+from mathocr.practice_pdf import practice_pdf_cache, render_practice_pdf
+from mathocr.reanalysis import reanalysis_cache, reanalysis_flight, reanalysis_key, run_reanalysis
+from mathocr.sessions import configure_sessions
+from mathocr.stats import STATS_PROVIDERS
+from mathocr.streaming import sse_event, stream_analysis, stream_stats
+from mathocr.uploads import (CLIENT_IMAGE_COMPRESSION, CLIENT_IMAGE_QUALITY, SpoolingRequest, UploadError,
+                             upload_store)
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+app.request_class = SpoolingRequest  # uploads are spooled to disk past UPLOAD_SPOOL_THRESHOLD
 
-# Enable sessions for login persistence
+# Enable sessions for login persistence (SESSION_BACKEND picks where they live, see mathocr/sessions.py)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
-from flask_session import Session
-app.config['SESSION_TYPE'] = 'filesystem'
-app.config['SESSION_FILE_DIR'] = '/tmp/flask_sessions'
-os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)
-Session(app)
-
-# Define log file path - will be created automatically
-LOG_FILE = '/tmp/login_logs.json'
+configure_sessions(app)
 
 # ============ NGROK FIX ============
 from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import escape
+from urllib.parse import urlencode
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # ============ HTML TEMPLATES ============
@@ -455,6 +477,7 @@ MAIN_HTML = '''<!DOCTYPE html>
                             <div>
                                 <h1>Analysis Results</h1>
                                 <p>AI-powered answer sheet analysis</p>
+                                <p id="uploadReport"></p>
                             </div>
                             <div class="badge-group" id="badgeGroup"></div>
                         </div>
@@ -501,6 +524,7 @@ MAIN_HTML = '''<!DOCTYPE html>
         let practiceResult = null;
         let history = [];
         let isAnalyzing = false;
+        const UPLOAD_CONFIG = {{ upload_config|tojson }};
         document.getElementById('userName').textContent = currentUser;
 
         function renderMath(element) {
@@ -529,7 +553,7 @@ MAIN_HTML = '''<!DOCTYPE html>
             closeMobileMenu();
         }
 
-        // File handling (unchanged)...
+        // File handling...
         document.getElementById('questionInput').addEventListener('change', async e => {
             await handleFileUpload(e.target.files, questionFiles, 'questionFileList');
             checkStartButton();
@@ -543,20 +567,137 @@ MAIN_HTML = '''<!DOCTYPE html>
         async function handleFileUpload(files, targetArray, listId) {
             for (let file of files) {
                 if (!targetArray.find(f => f.name === file.name)) {
-                    let dataURL = '';
-                    if (file.type.startsWith('image/')) {
-                        dataURL = await new Promise(resolve => {
-                            const reader = new FileReader();
-                            reader.onload = ev => resolve(ev.target.result);
-                            reader.readAsDataURL(file);
-                        });
-                    }
-                    targetArray.push({name: file.name, file: file, dataURL: dataURL});
+                    // Compression starts now, in the background, so it is usually done before Start Analysis
+                    targetArray.push({name: file.name, file: file, prepared: prepareUpload(file)});
                 }
             }
             displayFiles(listId, targetArray);
         }
 
+        // Runs inside a Web Worker (see compressor()): shrinks a photo as the server's preprocessing would
+        // (greyscale, long side <= max_side, short side <= max_short_side), so a phone photo goes up as a
+        // few hundred KB of JPEG instead of several MB
+        function compressInWorker() {
+            self.onmessage = async e => {
+                const {id, file, config} = e.data;
+                try {
+                    const bitmap = await createImageBitmap(file, {imageOrientation: 'from-image'});
+                    const scale = Math.min(1, config.max_side / Math.max(bitmap.width, bitmap.height),
+                                           config.max_short_side / Math.min(bitmap.width, bitmap.height));
+                    const canvas = new OffscreenCanvas(Math.max(Math.round(bitmap.width * scale), 1),
+                                                       Math.max(Math.round(bitmap.height * scale), 1));
+                    const ctx = canvas.getContext('2d');
+                    ctx.filter = 'grayscale(1)';
+                    ctx.imageSmoothingQuality = 'high';
+                    ctx.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+                    bitmap.close();
+                    self.postMessage({id, blob: await canvas.convertToBlob({type: 'image/jpeg', quality: config.quality})});
+                } catch (err) {
+                    self.postMessage({id, error: String(err)});
+                }
+            };
+        }
+
+        let compressWorker = null;
+        let compressJobId = 0;
+        const compressJobs = new Map();
+
+        function compressor() {
+            // One shared worker, created on first use; false when the browser cannot compress off the main thread
+            if (compressWorker !== null) return compressWorker;
+            compressWorker = false;
+            if (!UPLOAD_CONFIG.compress || !window.Worker || !window.OffscreenCanvas || !window.createImageBitmap) return false;
+            try {
+                const source = new Blob([`(${compressInWorker.toString()})();`], {type: 'text/javascript'});
+                compressWorker = new Worker(URL.createObjectURL(source));
+            } catch (e) {
+                return false;
+            }
+            compressWorker.onmessage = e => {
+                const resolve = compressJobs.get(e.data.id);
+                compressJobs.delete(e.data.id);
+                if (e.data.error) console.warn('Image compression failed:', e.data.error);
+                if (resolve) resolve(e.data.blob || null);
+            };
+            compressWorker.onerror = () => {
+                compressJobs.forEach(resolve => resolve(null));
+                compressJobs.clear();
+            };
+            return compressWorker;
+        }
+
+        function prepareUpload(file) {
+            // Resolves to what gets uploaded: the compressed JPEG when it is smaller, otherwise the file itself
+            const worker = compressor();
+            if (!worker || !file.type.startsWith('image/') || file.type === 'image/gif') return Promise.resolve(file);
+            return new Promise(resolve => {
+                const id = ++compressJobId;
+                compressJobs.set(id, resolve);
+                worker.postMessage({id, file, config: UPLOAD_CONFIG});
+            }).then(blob => blob && blob.size < file.size ? blob : file);
+        }
+
+        async function sha256Hex(blob) {
+            const digest = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+            return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+        }
+
+        async function uploadFile(item, report) {
+            // Resumable upload keyed by content hash: only the chunks the server does not have yet are sent
+            const blob = await item.prepared;
+            const id = await sha256Hex(blob);
+            const res = await fetch('/uploads', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({id, name: item.name, type: blob.type || item.file.type || 'application/octet-stream',
+                                      size: blob.size, original_size: item.file.size})
+            });
+            const state = await res.json();
+            if (!res.ok) throw new Error(state.error || 'Upload failed');
+            report.original += item.file.size;
+            report.compressed += blob.size;
+            for (const index of state.missing) {
+                const chunk = blob.slice(index * state.chunk_size, (index + 1) * state.chunk_size);
+                const started = performance.now();
+                await putChunk(`/uploads/${id}/${index}`, chunk);
+                report.sent += chunk.size;
+                report.seconds += (performance.now() - started) / 1000;
+            }
+            return {id, name: item.name};
+        }
+
+        async function putChunk(url, chunk) {
+            // Retries dropped connections and server errors with backoff; the chunk is resent whole
+            for (let attempt = 1; ; attempt++) {
+                let res = null;
+                try {
+                    res = await fetch(url, {method: 'PUT', body: chunk});
+                } catch (e) {
+                    if (attempt >= 5) throw e;
+                }
+                if (res && res.ok) return;
+                if (res && ((res.status < 500 && res.status !== 429) || attempt >= 5)) {
+                    const data = await res.json().catch(() => ({}));
+                    throw new Error(data.error || 'Upload failed');
+                }
+                await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+            }
+        }
+
+        function showUploadReport(report) {
+            const mb = n => (n / 1048576).toFixed(1) + ' MB';
+            const saved = report.original - report.sent;
+            let text = `Uploaded ${mb(report.sent)} of ${mb(report.original)}`;
+            if (saved > 0) {
+                text += ` (${mb(report.original - report.compressed)} saved by compression, ${mb(report.compressed - report.sent)} already on the server`;
+                // Time saved at the throughput this upload actually got
+                if (report.sent > 0 && report.seconds > 0) text += `, about ${(saved / (report.sent / report.seconds)).toFixed(1)}s saved`;
+                text += ')';
+            }
+            document.getElementById('uploadReport').textContent = text;
+            console.log(text);
+        }
+
         function displayFiles(elementId, files) {
             const el = document.getElementById(elementId);
             el.innerHTML = files.map(f => `
@@ -579,18 +720,47 @@ MAIN_HTML = '''<!DOCTYPE html>
             btn.disabled = true;
             allFiles = [...questionFiles, ...answerFiles];
             const formData = new FormData();
-            allFiles.forEach(f => formData.append('files', f.file));
+            document.getElementById('uploadReport').textContent = '';
             try {
-                const res = await fetch('/analyze', { method: 'POST', body: formData });
-                const data = await res.json();
-                if (data.error) alert(data.error);
-                else {
-                    analysisResult = data;
-                    displayAnalysis(data);
-                    addToHistory();
-                    document.getElementById('uploadSection').classList.add('hidden');
-                    document.getElementById('resultsSection').classList.remove('hidden');
+                if (window.crypto && crypto.subtle) {
+                    const report = {original: 0, compressed: 0, sent: 0, seconds: 0};
+                    const uploads = [];
+                    for (const [i, f] of allFiles.entries()) {
+                        btn.innerHTML = `<div class="loading"></div> Uploading ${i + 1}/${allFiles.length}...`;
+                        uploads.push(await uploadFile(f, report));
+                    }
+                    formData.append('uploads', JSON.stringify(uploads));
+                    showUploadReport(report);
+                    btn.innerHTML = '<div class="loading"></div> Analyzing...';
+                } else {
+                    // No Web Crypto (plain http): one multipart request, as before
+                    allFiles.forEach(f => formData.append('files', f.file));
+                }
+                // Questions arrive one by one as Server-Sent Events and are rendered as they come
+                const res = await fetch('/analyze/stream', { method: 'POST', body: formData });
+                if (!res.ok) {
+                    const data = await res.json();
+                    alert(data.error || 'Analysis failed');
+                    return;
                 }
+                analysisResult = {questions: []};
+                document.getElementById('accordion').innerHTML = '';
+                updateBadges();
+                await readEvents(res, (event, data) => {
+                    if (event === 'question') {
+                        if (analysisResult.questions.length === 0) {
+                            document.getElementById('uploadSection').classList.add('hidden');
+                            document.getElementById('resultsSection').classList.remove('hidden');
+                        }
+                        analysisResult.questions.push(data);
+                        renderQuestion(data, analysisResult.questions.length - 1);
+                        updateBadges();
+                    } else if (event === 'done') {
+                        loadHistory();
+                    } else if (event === 'error') {
+                        alert(data.error);
+                    }
+                });
             } catch (e) {
                 alert('Error: ' + e.message);
             } finally {
@@ -600,6 +770,29 @@ MAIN_HTML = '''<!DOCTYPE html>
             }
         }
 
+        async function readEvents(res, onEvent) {
+            // Minimal SSE reader for fetch() responses (EventSource cannot POST files)
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const {done, value} = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, {stream: true});
+                let sep;
+                while ((sep = buffer.indexOf('\\n\\n')) !== -1) {
+                    const block = buffer.slice(0, sep);
+                    buffer = buffer.slice(sep + 2);
+                    let event = 'message', data = '';
+                    block.split('\\n').forEach(line => {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    });
+                    onEvent(event, data ? JSON.parse(data) : null);
+                }
+            }
+        }
+
         function processSteps(str) {
             if (!str) return '';
             // Split by <br> and create proper paragraph structure
@@ -608,53 +801,62 @@ MAIN_HTML = '''<!DOCTYPE html>
         }
 
         function displayAnalysis(result) {
+            document.getElementById('accordion').innerHTML = '';
+            result.questions.forEach((q, i) => renderQuestion(q, i));
+            updateBadges();
+        }
+
+        function renderQuestion(q, i) {
             const accordion = document.getElementById('accordion');
-            accordion.innerHTML = '';
-            let counts = {correct: 0, partial: 0, incorrect: 0};
-            result.questions.forEach((q, i) => {
-                counts[q.status]++;
-                const item = document.createElement('div');
-                item.className = 'accordion-item';
-                item.innerHTML = `
-                    <button class="accordion-trigger" onclick="toggleAccordion('q${i}')">
-                        <div class="question-number ${q.status}">${q.number}</div>
-                        <div class="question-info">
-                            <p>${q.question}</p>
-                            <p>Status: ${q.status}</p>
-                        </div>
+            const item = document.createElement('div');
+            item.className = 'accordion-item';
+            item.id = `question${i}`;
+            item.innerHTML = `
+                <button class="accordion-trigger" onclick="toggleAccordion('q${i}')">
+                    <div class="question-number ${q.status}">${q.number}</div>
+                    <div class="question-info">
+                        <p>${q.question}</p>
+                        <p>Status: ${q.status}</p>
+                    </div>
+                </button>
+                <div id="q${i}" class="accordion-content">
+                    <div class="analysis-section">
+                        <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M11 5H6a2 2 0 00-2 2v11a2 2 0 002 2h11a2 2 0 002-2v-5m-1.414-9.414a2 2 0 112.828 2.828L11.828 15H9v-2.828l8.586-8.586z"/></svg> Student Solution</h3>
+                        <div class="solution-card"><div class="solution-steps">${processSteps(q.student_original)}</div></div>
+                    </div>
+                    <div class="analysis-section">
+                        <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M12 8v4m0 4h.01M21 12a9 9 0 11-18 0 9 9 0 0118 0z"/></svg> Error Analysis</h3>
+                        <div class="solution-card error"><p>${q.error}</p></div>
+                    </div>
+                    <div class="analysis-section">
+                        <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9 12l2 2 4-4m6 2a9 9 0 11-18 0 9 9 0 0118 0z"/></svg> LLM-Corrected Solution</h3>
+                        <div class="solution-card corrected"><div class="solution-steps">${processSteps(q.correct_solution)}</div></div>
+                    </div>
+                    <button class="btn-outline" onclick="openImageModal(${i})">
+                        <svg style="width: 1rem; height: 1rem;" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M4 16l4.586-4.586a2 2 0 012.828 0L16 16m-2-2l1.586-1.586a2 2 0 012.828 0L20 14m-6-6h.01M6 20h12a2 2 0 002-2V6a2 2 0 00-2-2H6a2 2 0 00-2 2v12a2 2 0 002 2z"/></svg>
+                        View Answer Image
                     </button>
-                    <div id="q${i}" class="accordion-content">
-                        <div class="analysis-section">
-                            <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M11 5H6a2 2 0 00-2 2v11a2 2 0 002 2h11a2 2 0 002-2v-5m-1.414-9.414a2 2 0 112.828 2.828L11.828 15H9v-2.828l8.586-8.586z"/></svg> Student Solution</h3>
-                            <div class="solution-card"><div class="solution-steps">${processSteps(q.student_original)}</div></div>
+                    <div class="reanalysis-card">
+                        <h3 style="font-size: 1rem; font-weight: 600; margin-bottom: 0.75rem;">Re-analyze This Question</h3>
+                        <div class="reanalysis-input-group">
+                            <input type="text" id="reanalysisInput${i}" placeholder="Ask AI to re-analyze this question...">
+                            <button class="btn-primary" style="width: auto;" onclick="reanalyzeQuestion(${i})">Send</button>
                         </div>
-                        <div class="analysis-section">
-                            <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M12 8v4m0 4h.01M21 12a9 9 0 11-18 0 9 9 0 0118 0z"/></svg> Error Analysis</h3>
-                            <div class="solution-card error"><p>${q.error}</p></div>
+                        <div id="aiResponse${i}" style="display: ${q.ai_response ? 'flex' : 'none'};" class="ai-response">
+                            <div class="ai-badge">AI</div>
+                            <p>${q.ai_response || ''}</p>
                         </div>
-                        <div class="analysis-section">
-                            <h3><svg fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M9 12l2 2 4-4m6 2a9 9 0 11-18 0 9 9 0 0118 0z"/></svg> LLM-Corrected Solution</h3>
-                            <div class="solution-card corrected"><div class="solution-steps">${processSteps(q.correct_solution)}</div></div>
-                        </div>
-                        <button class="btn-outline" onclick="openImageModal(${i}, '${q.status}', '${q.image_file || ''}', ${JSON.stringify(q.error_bbox || {})})">
-                            <svg style="width: 1rem; height: 1rem;" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M4 16l4.586-4.586a2 2 0 012.828 0L16 16m-2-2l1.586-1.586a2 2 0 012.828 0L20 14m-6-6h.01M6 20h12a2 2 0 002-2V6a2 2 0 00-2-2H6a2 2 0 00-2 2v12a2 2 0 002 2z"/></svg>
-                            View Answer Image
-                        </button>
-                        <div class="reanalysis-card">
-                            <h3 style="font-size: 1rem; font-weight: 600; margin-bottom: 0.75rem;">Re-analyze This Question</h3>
-                            <div class="reanalysis-input-group">
-                                <input type="text" id="reanalysisInput${i}" placeholder="Ask AI to re-analyze this question...">
-                                <button class="btn-primary" style="width: auto;" onclick="reanalyzeQuestion(${i})">Send</button>
-                            </div>
-                            <div id="aiResponse${i}" style="display: none;" class="ai-response">
-                                <div class="ai-badge">AI</div>
-                                <p></p>
-                            </div>
-                        </div>
-                    </div>`;
-                accordion.appendChild(item);
-                renderMath(item);
-            });
+                    </div>
+                </div>`;
+            const existing = document.getElementById(`question${i}`);
+            if (existing) existing.replaceWith(item);
+            else accordion.appendChild(item);
+            renderMath(item);
+        }
+
+        function updateBadges() {
+            let counts = {correct: 0, partial: 0, incorrect: 0};
+            (analysisResult ? analysisResult.questions : []).forEach(q => counts[q.status]++);
             document.getElementById('badgeGroup').innerHTML = `
                 <div class="badge"><div class="badge-dot correct"></div>${counts.correct} Correct</div>
                 <div class="badge"><div class="badge-dot partial"></div>${counts.partial} Partial</div>
@@ -666,7 +868,79 @@ MAIN_HTML = '''<!DOCTYPE html>
             document.getElementById(id).classList.toggle('open');
         }
 
-        // reanalyzeQuestion, openImageModal, closeImageModal unchanged...
+        async function reanalyzeQuestion(i) {
+            const input = document.getElementById(`reanalysisInput${i}`);
+            const query = input.value.trim();
+            if (!query) return;
+            const q = analysisResult.questions[i];
+            const response = document.getElementById(`aiResponse${i}`);
+            response.style.display = 'flex';
+            response.querySelector('p').innerHTML = '<div class="loading"></div>';
+            try {
+                // analysis_id and number let the server attach a crop of the student's working
+                const res = await fetch('/reanalyze', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({...q, user_query: query}) });
+                const data = await res.json();
+                if (!res.ok) {
+                    response.querySelector('p').textContent = data.error || 'Re-analysis failed';
+                    return;
+                }
+                Object.assign(q, {status: data.status, error: data.error, correct_solution: data.correct_solution, ai_response: data.response});
+                renderQuestion(q, i);
+                updateBadges();
+                document.getElementById(`q${i}`).classList.add('open');
+            } catch (e) {
+                response.querySelector('p').textContent = 'Error: ' + e.message;
+            }
+        }
+
+        let modalObjectURL = null;
+
+        function openImageModal(i) {
+            const q = analysisResult.questions[i];
+            const img = document.getElementById('modalImage');
+            const highlight = document.getElementById('errorHighlight');
+            const box = q.error_bbox;
+            document.getElementById('modalTitle').textContent = `Answer Sheet - Question ${q.number}`;
+            document.getElementById('modalCaption').textContent = `${q.image_file || ''} (${q.status})`;
+            highlight.style.display = 'none';
+            // The page as the server kept it is the image the box was drawn on; the local file is a fallback
+            const local = allFiles.find(f => f.name === q.image_file && f.file.type.startsWith('image/'));
+            const showLocal = () => {
+                img.onerror = null;
+                if (!local) return;
+                modalObjectURL = URL.createObjectURL(local.file);
+                img.src = modalObjectURL;
+            };
+            img.onload = () => {
+                img.parentElement.style.aspectRatio = `${img.naturalWidth} / ${img.naturalHeight}`;
+                if (!box || !(box.width > 0 && box.height > 0) || img.src === modalObjectURL) return;
+                // Fractions of the page, or pixels if the model answered in pixels
+                const pixels = Math.max(box.x + box.width, box.y + box.height) > 1.5;
+                const sx = pixels ? img.naturalWidth : 1, sy = pixels ? img.naturalHeight : 1;
+                highlight.style.left = `${box.x / sx * 100}%`;
+                highlight.style.top = `${box.y / sy * 100}%`;
+                highlight.style.width = `${box.width / sx * 100}%`;
+                highlight.style.height = `${box.height / sy * 100}%`;
+                highlight.style.display = 'block';
+            };
+            if (q.analysis_id) {
+                img.onerror = showLocal;
+                img.src = `/analyses/${q.analysis_id}/page?name=${encodeURIComponent(q.image_file || '')}`;
+            } else {
+                showLocal();
+            }
+            document.getElementById('imageModal').classList.add('open');
+        }
+
+        function closeImageModal() {
+            const img = document.getElementById('modalImage');
+            document.getElementById('imageModal').classList.remove('open');
+            img.onload = img.onerror = null;
+            img.src = '';
+            if (modalObjectURL) URL.revokeObjectURL(modalObjectURL);
+            modalObjectURL = null;
+        }
+
         async function generatePracticePaper() {
             if (!analysisResult) return;
             const content = document.getElementById('practicePaperContent');
@@ -707,6 +981,26 @@ MAIN_HTML = '''<!DOCTYPE html>
         }
 
         async function downloadPracticePaper() {
+            // Paginated vector PDF rendered by the server; the screenshot path below is the fallback
+            if (!practiceResult) return;
+            try {
+                const res = await fetch('/practice_pdf', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({practice_questions: practiceResult.practice_questions}) });
+                if (!res.ok) throw new Error('HTTP ' + res.status);
+                const url = URL.createObjectURL(await res.blob());
+                const link = document.createElement('a');
+                link.href = url;
+                link.download = `Math_Practice_Paper_${new Date().toISOString().slice(0,10)}.pdf`;
+                document.body.appendChild(link);
+                link.click();
+                link.remove();
+                setTimeout(() => URL.revokeObjectURL(url), 10000);
+            } catch (e) {
+                console.warn('Server PDF failed, falling back to screenshot:', e);
+                await downloadPracticePaperScreenshot();
+            }
+        }
+
+        async function downloadPracticePaperScreenshot() {
     if (!practiceResult) return;
     const practicePaper = document.getElementById('practice-paper');
     if (!practicePaper) {
@@ -760,28 +1054,109 @@ MAIN_HTML = '''<!DOCTYPE html>
     }
 }
 
-        // addToHistory and updateHistory unchanged...
-        function addToHistory() {
-            const title = `Analysis - ${new Date().toLocaleDateString()}`;
-            history.push({title, date: new Date().toLocaleDateString()});
-            updateHistory();
+        // History is kept on the server per user; reopening an analysis reads it back, no new model call
+        async function loadHistory() {
+            try {
+                const res = await fetch('/history');
+                if (!res.ok) return;
+                history = (await res.json()).analyses;
+                updateHistory();
+            } catch (e) {
+                console.error('History error:', e);
+            }
+        }
+
+        function historyItem(h) {
+            // Built with textContent: the title is made of the file names the user uploaded
+            const item = document.createElement('div');
+            item.className = 'sidebar-item';
+            item.onclick = () => openHistory(h.id);
+            const title = document.createElement('div');
+            title.className = 'sidebar-item-title';
+            title.textContent = h.title;
+            const date = document.createElement('div');
+            date.className = 'sidebar-item-date';
+            date.textContent = `${new Date(h.created * 1000).toLocaleString()} · ${h.counts.correct}/${h.counts.correct + h.counts.partial + h.counts.incorrect} correct`;
+            item.append(title, date);
+            return item;
         }
 
         function updateHistory() {
-            const html = history.map(h => `
-                <div class="sidebar-item">
-                    <div class="sidebar-item-title">${h.title}</div>
-                    <div class="sidebar-item-date">${h.date}</div>
-                </div>
-            `).join('');
-            document.getElementById('historyList').innerHTML = html;
-            document.getElementById('mobileHistoryList').innerHTML = html;
+            document.getElementById('historyList').replaceChildren(...history.map(historyItem));
+            document.getElementById('mobileHistoryList').replaceChildren(...history.map(historyItem));
         }
+
+        async function openHistory(id) {
+            if (isAnalyzing) return;
+            try {
+                const res = await fetch(`/history/${id}`);
+                const data = await res.json();
+                if (!res.ok) {
+                    alert(data.error || 'Could not open this analysis');
+                    return;
+                }
+                analysisResult = {questions: data.questions};
+                allFiles = [];
+                document.getElementById('uploadReport').textContent = '';
+                document.getElementById('uploadSection').classList.add('hidden');
+                document.getElementById('resultsSection').classList.remove('hidden');
+                displayAnalysis(analysisResult);
+                closeMobileMenu();
+            } catch (e) {
+                alert('Error: ' + e.message);
+            }
+        }
+
+        loadHistory();
     </script>
 </body>
 </html>'''
 
 # ============ ROUTES ============
+@app.before_request
+def start_background_workers():
+    # Picks up jobs left behind by a restarted worker as soon as this process serves a request
+    job_queue.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        usage_meter.record_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method,
+                                   response.status_code, time.perf_counter() - started)
+    return response
+
+def _busy_response(e):
+    # Upstream limits were hit or OpenAI is failing: a friendly 429/503/504 the frontend can retry, not a raw 500
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status
+
+def _request_files():
+    # Multipart "files" plus finished resumable uploads named in the "uploads" form field
+    files = request.files.getlist('files')
+    try:
+        uploads = json.loads(request.form.get('uploads') or '[]')
+    except ValueError:
+        raise UploadError('Invalid uploads list')
+    if not isinstance(uploads, list):
+        raise UploadError('Invalid uploads list')
+    opened = g.setdefault('opened_uploads', [])
+    for item in uploads:
+        if not isinstance(item, dict):
+            raise UploadError('Invalid uploads list')
+        opened.append(upload_store.open(str(item.get('id', '')), session.get('user'), item.get('name')))
+    return files + opened
+
+@app.teardown_request
+def close_opened_uploads(exc):
+    for file in g.pop('opened_uploads', ()):
+        file.close()
+
 @app.route('/')
 def index():
     return render_template_string(LOGIN_HTML)
@@ -790,7 +1165,12 @@ def index():
 def main():
     if not session.get('logged_in'):
         return redirect('/')
-    return render_template_string(MAIN_HTML)
+    return render_template_string(MAIN_HTML, upload_config={
+        'compress': CLIENT_IMAGE_COMPRESSION and IMAGE_PREPROCESS,
+        'max_side': IMAGE_MAX_SIDE,
+        'max_short_side': IMAGE_MAX_SHORT_SIDE * 2,
+        'quality': CLIENT_IMAGE_QUALITY,
+    })
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
@@ -800,86 +1180,247 @@ def analyze():
         if not api_key:
             return jsonify({'error': 'OpenAI API key not configured.'}), 500
 
-        files = request.files.getlist('files')
+        files = _request_files()
         if not files:
             return jsonify({'error': 'No files uploaded'}), 400
 
-        client = OpenAI(api_key=api_key)
-        file_contents = []
-        file_names = []
+        result, status = analyze_files(api_key, files, request.form.get('mode', ANALYZE_MODE))
+        return jsonify(result), status
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except UpstreamBusyError as e:
+        return _busy_response(e)
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 500
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    # Same input as /analyze; questions are pushed as Server-Sent Events as soon as each one is complete
+    started = time.perf_counter()
+    try:
+        api_key = os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            return jsonify({'error': 'OpenAI API key not configured.'}), 500
+
+        files = _request_files()
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+
+        digests = [file_digest(file) for file in files]
+        cache_key = analysis_cache_key(digests)
+        cached = cached_analysis(cache_key, digests, files)
+        user = upstream_user(default=None)
+        upload_names = [file.filename for file in files]
+        if cached is None:
+            client = get_openai_client(api_key)
+            analysis_id = uuid.uuid4().hex
+            per_file, reused, page_prints, dedupe = collect_pages(files, user, analysis_id)
+            file_names = [name for entry in per_file for name in entry[0]]
+            file_contents = [part for entry in per_file for part in entry[1]]
+            del per_file
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+    def first_question(elapsed):
+        # Timed whatever the first question came from: the analysis cache, a reused page or the model
+        stream_stats.record(elapsed)
+        print(f"⏱️ Time to first question: {elapsed:.2f}s")
+
+    def generate():
+        if cached is not None:
+            if cached:
+                first_question(time.perf_counter() - started)
+            for q in cached:
+                yield sse_event('question', q)
+            yield sse_event('done', {'count': len(cached), 'cached': True,
+                                     'history_id': analysis_history.add(user, upload_names, cached)})
+            return
+        # Questions of pages seen before go out first; the model only sees the new pages
+        questions = dedupe_by_number(reused)
+        if questions:
+            first_question(time.perf_counter() - started)
+        for q in questions:
+            yield sse_event('question', q)
+        seen = {q['number'] for q in questions}
+        analyzed = []
+        try:
+            for q, elapsed in stream_analysis(client, file_names, file_contents, started) if file_names else ():
+                analyzed.append(q)
+                if q['number'] in seen:
+                    continue
+                if not questions:
+                    first_question(elapsed)
+                seen.add(q['number'])
+                analysis_pages.remember(analysis_id, [q])
+                questions.append(q)
+                yield sse_event('question', q)
+        except UpstreamBusyError as e:
+            yield sse_event('error', {'error': str(e), 'retry_after': e.retry_after})
+            return
+        except Exception as e:
+            print(f"Stream error: {str(e)}")
+            yield sse_event('error', {'error': str(e)})
+            return
+        if not questions:
+            yield sse_event('error', {'error': 'Could not understand AI response. Please try again.'})
+            return
+        print(f"✅ Streamed {len(questions)} unique questions in {time.perf_counter() - started:.2f}s")
+        page_index.remember(user, page_prints, file_names, analyzed)
+        store_analysis(cache_key, digests, files, questions)
+        skipped = dedupe['duplicates'] + dedupe['reused']
+        yield sse_event('done', {'count': len(questions), 'cached': False, 'images_skipped': skipped,
+                                 'image_tokens_saved': skipped * IMAGE_TOKEN_ESTIMATE,
+                                 'history_id': analysis_history.add(user, upload_names, questions)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+ANONYMOUS_JOBS_PER_SESSION = 20
+
+def _claim_job(job_id):
+    # Anonymous jobs have no user to check against, so the ids are kept in the submitting session instead
+    if not session.get('user'):
+        session['jobs'] = (session.get('jobs', []) + [job_id])[-ANONYMOUS_JOBS_PER_SESSION:]
+
+def _owns_job(job):
+    if job['user'] is not None:
+        return job['user'] == session.get('user')
+    return not session.get('user') and job['id'] in session.get('jobs', [])
+
+@app.route('/jobs/analyze', methods=['POST'])
+def submit_analysis_job():
+    # Same input as /analyze; returns a job id immediately and the analysis runs in the background
+    try:
+        if not os.environ.get('OPENAI_API_KEY'):
+            return jsonify({'error': 'OpenAI API key not configured.'}), 500
+
+        files = _request_files()
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+
+        job_id = uuid.uuid4().hex
+        mode = request.form.get('mode', ANALYZE_MODE)
+        digests = [file_digest(file) for file in files]
+        cached = cached_analysis(analysis_cache_key(digests), digests, files)
+        if cached is not None:
+            history_id = analysis_history.add(session.get('user'), [file.filename for file in files], cached)
+            job_queue.submit('analyze', {'files': [], 'mode': mode}, user=session.get('user'),
+                             job_id=job_id, result={'questions': cached, 'history_id': history_id})
+            _claim_job(job_id)
+            return jsonify({'job_id': job_id, 'status': 'done'}), 202
+
+        job_dir = os.path.join(JOB_DIR, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        spooled = []
         for i, file in enumerate(files):
+            path = os.path.join(job_dir, str(i))
             file.seek(0)
-            if file.content_type.startswith('image/'):
-                encoded = base64.b64encode(file.read()).decode('utf-8')
-                file_contents.append({
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{encoded}", "detail": "high"}
-                })
-            else:
-                file_contents.append({
-                    "type": "text",
-                    "text": f"[PDF file: {file.filename}]"
-                })
-            file_names.append(file.filename)
-
-        prompt = f""" 
-        Analyze the math problems in these files: {', '.join(file_names)}
-        For each question you find:
-        1. Extract the question number (use what's in the image)
-        2. Write the question with math formatted using $ for inline math like $x^2$ and $$ for display math
-        3. Copy the student's work exactly as written (use $ for their math too)
-        4. Check if it's "correct", "partial", or "incorrect". Be balanced: 'correct' if fully right, 'partial' if mostly right but minor errors, 'incorrect' if major mistakes.
-        5. Explain any errors you see
-        6. Provide the correct solution with clear steps (separate steps with <br>)
-        7. Note which image file this is from
-        Ensure each unique question number appears only once, even if in multiple files. Deduplicate by question number.
-        Return ONLY a JSON array (no extra text): 
-        [{{
-            "number": "1",
-            "question": "Solve $2x + 5 = 15$",
-            "student_original": "Student wrote: $2x = 10$ <br> $x = 5$",
-            "status": "correct",
-            "error": "No errors found",
-            "correct_solution": "Subtract 5 from both sides: $2x = 10$ <br> Divide by 2: $x = 5$ <br> Answer: $x = 5$",
-            "image_file": "{file_names[0] if file_names else 'image.jpg'}",
-            "error_bbox": null
-        }}]
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-5.1",
-            messages=[{
-                "role": "user",
-                "content": [{"type": "text", "text": prompt}] + file_contents
-            }],
-            max_completion_tokens=9000,
-            temperature=0.3
-        )
-
-        result_text = response.choices[0].message.content.strip()
-        # Clean up the response
-        result_text = result_text.replace('```json', '').replace('```', '').strip()
-        # Find JSON array
-        start = result_text.find('[')
-        end = result_text.rfind(']')
-        if start != -1 and end != -1:
-            result_text = result_text[start:end + 1]
+            file.save(path)
+            spooled.append({'path': path, 'name': file.filename, 'content_type': file.content_type})
+        job_queue.submit('analyze', {'files': spooled, 'mode': mode}, user=session.get('user'), job_id=job_id)
+        _claim_job(job_id)
+        return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        try:
-            questions = json.loads(result_text)
-            # Deduplicate questions by number
-            seen = set()
-            unique_questions = []
-            for q in questions:
-                if q['number'] not in seen:
-                    seen.add(q['number'])
-                    unique_questions.append(q)
-            print(f"✅ Parsed {len(unique_questions)} unique questions")
-            return jsonify({'questions': unique_questions})
-        except json.JSONDecodeError as e:
-            print(f"JSON Error: {str(e)}")
-            print(f"Response preview: {result_text[:500]}")
-            return jsonify({'error': 'Could not understand AI response. Please try again.'}), 500
+@app.route('/uploads', methods=['POST'])
+def begin_upload():
+    # {"id": sha256 hex, "name", "type", "size", "original_size"} -> {"chunk_size", "missing": [chunk indexes]}
+    if not session.get('user'):
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        body = request.get_json(silent=True) or {}
+        state = upload_store.begin(str(body.get('id', '')), session.get('user'), str(body.get('name') or 'upload'),
+                                   str(body.get('type') or 'application/octet-stream'), body.get('size'),
+                                   body.get('original_size'))
+        return jsonify(state)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/uploads/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    # The raw chunk bytes are the request body
+    if not session.get('user'):
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        return jsonify(upload_store.put_chunk(upload_id, session.get('user'), index, request.stream))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    # Jobs are answered only to the user (or anonymous session) that submitted them; anyone else gets
+    # the same 404 as for an unknown id
+    job = job_queue.get(job_id)
+    if job is None or not _owns_job(job):
+        return jsonify({'error': 'Job not found'}), 404
+    body = {'job_id': job['id'], 'status': job['status'], 'attempts': job['attempts']}
+    if job['started']:
+        body['wait_seconds'] = round(job['started'] - job['created'], 2)
+    else:
+        body['wait_seconds'] = round(time.time() - job['created'], 2)
+    if job['finished'] and job['started']:
+        body['run_seconds'] = round(job['finished'] - job['started'], 2)
+    if job['status'] == 'done':
+        body['result'] = job['result']
+    elif job['status'] == 'failed':
+        body['error'] = job['error']
+    return jsonify(body)
+
+@app.route('/analyses/<analysis_id>/page')
+def analysis_page(analysis_id):
+    # The page a question was read from, as the model saw it; for the answer-sheet viewer. Only the
+    # user who ran the analysis can read it
+    page = analysis_pages.page(analysis_id, request.args.get('name', ''), session.get('user'))
+    if page is None:
+        return jsonify({'error': 'Page not found'}), 404
+    response = make_response(page[0])
+    response.headers['Content-Type'] = 'image/jpeg'
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+@app.route('/history')
+def list_history():
+    # ?before=<created of the last entry seen> pages back through older analyses
+    user = session.get('user')
+    if not user:
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        before = request.args.get('before', type=float)
+        limit = max(min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 200), 1)
+        entries = analysis_history.list(user, before, limit)
+        return jsonify({'analyses': entries, 'next_before': entries[-1]['created'] if len(entries) == limit else None})
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/history/<history_id>')
+def get_history(history_id):
+    user = session.get('user')
+    if not user:
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        entry = analysis_history.get(user, history_id)
+        if entry is None:
+            return jsonify({'error': 'Analysis not found'}), 404
+        return jsonify(entry)
     except Exception as e:
         print(f"Error: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -896,38 +1437,23 @@ def reanalyze():
         if not data:
             return jsonify({'error': 'No data provided'}), 400
 
-        client = OpenAI(api_key=api_key)
-
-        prompt = f"""
-        Re-analyze this question based on user query: "{data['user_query']}"
-        Original: Question: {data['question']}
-        Student: {data['student_original']}
-        Previous error: {data['error']}
-        Previous correct: {data['correct_solution']}
-        Provide updated:
-        - status: "correct|partial|incorrect"
-        - error: updated description
-        - correct_solution: updated steps <br> separated
-        - response: brief response to user query
-        Format ALL with LaTeX $
-        Return JSON: {{"status": "", "error": "", "correct_solution": "", "response": ""}}
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-5.1",
-            messages=[{"role": "user", "content": prompt}],
-            max_completion_tokens=2000,
-            temperature=0.3
-        )
-
-        result_text = response.choices[0].message.content.strip()
-        result_text = result_text.replace('```json', '').replace('```', '').strip()
-
-        try:
-            updated = json.loads(result_text)
+        # The question's region of the original page, when the analysis kept it
+        crop = None
+        if REANALYZE_CROPS:
+            crop = analysis_pages.crop(data.get('analysis_id'), data.get('number'), session.get('user'))
+        # Repeated follow-ups are answered from the cache; identical in-flight ones share one call
+        key = reanalysis_key(data, crop)
+        updated = reanalysis_cache.get(key)
+        if updated is not None:
             return jsonify(updated)
-        except json.JSONDecodeError:
-            return jsonify({'error': 'Parse error'}), 500
+        client = get_openai_client(api_key)
+        updated = reanalysis_flight.do(key, lambda: run_reanalysis(client, data, crop))
+        reanalysis_cache.set(key, updated)
+        return jsonify(updated)
+    except UpstreamBusyError as e:
+        return _busy_response(e)
+    except ModelReplyError:
+        return jsonify({'error': 'Parse error'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -947,34 +1473,42 @@ def handle_login():
         user_agent = request.headers.get('User-Agent', 'Unknown')[:100]
         current_time = datetime.utcnow().isoformat()
 
-        def save_login():
-            login_data = {
-                'username': username,
-                'timestamp': current_time,
-                'ip': ip_address,
-                'user_agent': user_agent
-            }
-            if os.path.exists(LOG_FILE):
-                with open(LOG_FILE, 'r') as f:
-                    logins = json.load(f)
-            else:
-                logins = []
-            logins.append(login_data)
-            with open(LOG_FILE, 'w') as f:
-                json.dump(logins, f, indent=2)
-
-        threading.Thread(target=save_login, daemon=True).start()
+        login_log.record(username, current_time, ip_address, user_agent)
 
         return jsonify({'success': True, 'message': 'Login successful', 'user': username})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+LOGS_PAGE_SIZE = 100
+LOGS_SORTS = {'timestamp': 'timestamp', 'username': 'username', 'ip': 'ip'}
+
 @app.route('/view-logs')
 def view_logs():
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r') as f:
-            logins = json.load(f)
-        html = '''
+    # Paginated, filterable view; rows are streamed straight from the query cursor
+    login_log.start()
+    args = request.args
+    where, params = login_filter_sql(args)
+    sort = args.get('sort', 'timestamp') if args.get('sort') in LOGS_SORTS else 'timestamp'
+    order = 'ASC' if args.get('order') == 'asc' else 'DESC'
+    per_page = min(max(request.args.get('per_page', LOGS_PAGE_SIZE, type=int), 1), 1000)
+    page = max(request.args.get('page', 1, type=int), 1)
+    conn = db()
+    total = conn.execute('SELECT COUNT(*) FROM logins' + where, params).fetchone()[0]
+    if not total and not where:
+        return "<h1>No logins yet</h1>"
+    pages = max(-(-total // per_page), 1)
+    page = min(page, pages)
+    rows = conn.execute(f'SELECT username, timestamp, ip, user_agent FROM logins{where} '
+                        f'ORDER BY {LOGS_SORTS[sort]} {order}, id {order} LIMIT ? OFFSET ?',
+                        params + [per_page, (page - 1) * per_page])
+
+    def link(**changes):
+        query = {k: v for k, v in args.items() if v}
+        query.update(changes)
+        return '?' + urlencode(query)
+
+    def generate():
+        yield '''
         <!DOCTYPE html>
         <html>
         <head><title>Login Logs</title>
@@ -983,45 +1517,122 @@ def view_logs():
             table { border-collapse: collapse; width: 100%; margin-top: 20px; }
             th, td { border: 1px solid #ddd; padding: 12px; text-align: left; }
             th { background-color: #667eea; color: white; }
+            th a { color: white; }
             tr:nth-child(even) { background-color: #f2f2f2; }
+            form input { padding: 6px; margin-right: 8px; }
         </style>
         </head>
         <body>
-            <h1>🔐 Login Logs (Total: ''' + str(len(logins)) + ''')</h1>
+        '''
+        yield f'''
+            <h1>🔐 Login Logs (Total: {total})</h1>
+            <form method="get">
+                <input name="username" placeholder="Username starts with" value="{escape(args.get('username', ''))}">
+                <input name="ip" placeholder="IP address" value="{escape(args.get('ip', ''))}">
+                From <input type="date" name="from" value="{escape(args.get('from', ''))}">
+                To <input type="date" name="to" value="{escape(args.get('to', ''))}">
+                <button type="submit">Filter</button> <a href="/view-logs">Clear</a>
+            </form>
             <table>
-                <tr><th>#</th><th>Username</th><th>Timestamp</th><th>IP Address</th><th>User Agent</th></tr>
+                <tr><th>#</th><th><a href="{escape(link(sort='username', order='asc', page=1))}">Username</a></th>
+                <th><a href="{escape(link(sort='timestamp', order='desc' if order == 'ASC' else 'asc', page=1))}">Timestamp</a></th>
+                <th><a href="{escape(link(sort='ip', order='asc', page=1))}">IP Address</a></th><th>User Agent</th></tr>
         '''
-        for i, login in enumerate(reversed(logins), 1):
-            html += f'''
+        for i, (username, timestamp, ip, user_agent) in enumerate(rows, (page - 1) * per_page + 1):
+            yield f'''
                 <tr>
                     <td>{i}</td>
-                    <td><strong>{login['username']}</strong></td>
-                    <td>{login['timestamp']}</td>
-                    <td>{login['ip']}</td>
-                    <td>{login['user_agent'][:50]}...</td>
+                    <td><strong>{escape(username)}</strong></td>
+                    <td>{escape(timestamp)}</td>
+                    <td>{escape(ip or '')}</td>
+                    <td>{escape((user_agent or '')[:50])}...</td>
                 </tr>
             '''
-        html += '''
+        prev_link = f'<a href="{escape(link(page=page - 1))}">← Previous</a>' if page > 1 else ''
+        next_link = f'<a href="{escape(link(page=page + 1))}">Next →</a>' if page < pages else ''
+        export_args = {k: args[k] for k in ('username', 'from', 'to', 'ip') if args.get(k)}
+        export_query = escape('?' + urlencode(export_args)) if export_args else ''
+        yield f'''
             </table>
+            <p style="margin-top: 20px;">{prev_link} Page {page} of {pages} {next_link}</p>
             <p style="margin-top: 20px;">
-                <a href="/download-logs">📥 Download JSON</a> | <a href="/">🏠 Back to Login</a>
+                📥 Download <a href="/download-logs{export_query}">JSON</a> |
+                <a href="/download-logs{export_query}{'&' if export_query else '?'}format=jsonl">JSON Lines</a> |
+                <a href="/download-logs{export_query}{'&' if export_query else '?'}format=csv">CSV</a>
+                | <a href="/">🏠 Back to Login</a>
             </p>
         </body>
         </html>
         '''
-        return html
-    return "<h1>No logins yet</h1>"
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+LOGS_EXPORT_CHUNK = 64 * 1024
+LOGS_EXPORT_TYPES = {'json': 'application/json', 'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
 
 @app.route('/download-logs')
 def download_logs():
-    if os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'r') as f:
-            data = f.read()
-        response = make_response(data)
-        response.headers['Content-Type'] = 'application/json'
-        response.headers['Content-Disposition'] = 'attachment; filename=math_ocr_logins.json'
-        return response
-    return "No logins yet", 404
+    # Streamed export: ?format=json|jsonl|csv, optional ?gzip=1 and the /view-logs filters (from, to, username, ip)
+    login_log.start()
+    fmt = request.args.get('format', 'json')
+    if fmt not in LOGS_EXPORT_TYPES:
+        return "Unknown format", 400
+    compress = request.args.get('gzip') == '1'
+    where, params = login_filter_sql(request.args)
+    conn = db()
+    if not conn.execute('SELECT 1 FROM logins LIMIT 1').fetchone():
+        return "No logins yet", 404
+    cursor = conn.execute('SELECT username, timestamp, ip, user_agent FROM logins' + where + ' ORDER BY id', params)
+
+    def records():
+        # Serialized rows in constant memory, a few hundred at a time
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(['username', 'timestamp', 'ip', 'user_agent'])
+            yield buf.getvalue()
+        elif fmt == 'json':
+            yield '['
+        first = True
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            if fmt == 'csv':
+                buf = io.StringIO()
+                csv.writer(buf).writerows(rows)
+                yield buf.getvalue()
+                continue
+            lines = [json.dumps({'username': r[0], 'timestamp': r[1], 'ip': r[2], 'user_agent': r[3]}) for r in rows]
+            if fmt == 'jsonl':
+                yield '\n'.join(lines) + '\n'
+            else:
+                yield ('\n' if first else ',\n') + ',\n'.join(lines)
+            first = False
+        if fmt == 'json':
+            yield '\n]\n'
+
+    def generate():
+        pending, size = [], 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits 31 = gzip container
+        for text in records():
+            data = text.encode('utf-8')
+            if compressor:
+                data = compressor.compress(data)
+            pending.append(data)
+            size += len(data)
+            if size >= LOGS_EXPORT_CHUNK:
+                yield b''.join(pending)
+                pending, size = [], 0
+        if compressor:
+            pending.append(compressor.flush())
+        yield b''.join(pending)
+
+    filename = f'math_ocr_logins.{fmt}' + ('.gz' if compress else '')
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/gzip' if compress else LOGS_EXPORT_TYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
 
 @app.route('/generate_practice', methods=['POST'])
 def generate_practice():
@@ -1044,44 +1655,72 @@ def generate_practice():
         if not error_questions:
             return jsonify({'practice_questions': []})
 
-        client = OpenAI(api_key=api_key)
-
-        prompt = f"""
-        Generate practice questions for these problems with mistakes: {json.dumps(error_questions, indent=2)}
-        CRITICAL INSTRUCTIONS:
-        1. Use the EXACT SAME question numbers as originals
-        2. Create MODIFIED versions (similar concept, different values)
-        3. Target the specific errors/concepts
-        4. Format math with $LaTeX$
-        5. Ensure each question number appears only once. No duplicates. If multiple for same number, combine into one.
-        6. Ensure terms are not repeated in the question text; each mathematical term appears only once.
-        Return JSON array: [{{"number": "number", "question": "modified with $LaTeX$"}}]
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-5.1",
-            messages=[{"role": "user", "content": prompt}],
-            max_completion_tokens=2000,
-            temperature=0.7
-        )
-
-        result_text = response.choices[0].message.content.strip()
-        result_text = result_text.replace('```json', '').replace('```', '').strip()
+        # Serve concepts with enough fresh variants from the bank; only the rest go upstream
+        served, missing = practice_bank.take(error_questions)
+        generated = []
+        if missing:
+            client = get_openai_client(api_key)
+            try:
+                generated = run_practice_generation(client, missing)
+            except ModelReplyError as e:
+                return jsonify({'error': f'Failed to parse: {str(e)}'}), 500
+        practice_bank.schedule_topup(error_questions, session.get('user'))
+        by_number = dict(served)
+        for pq in generated:
+            by_number.setdefault(pq['number'], pq)
+        practice = [by_number[q['number']] for q in error_questions if q['number'] in by_number]
+        # Deduplicate practice questions by number
+        return jsonify({'practice_questions': dedupe_by_number(practice)})
+    except UpstreamBusyError as e:
+        return _busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/practice_pdf', methods=['POST'])
+def practice_pdf():
+    try:
+        data = request.json
+        practice_questions = (data or {}).get('practice_questions')
+        if not practice_questions:
+            return jsonify({'error': 'No practice questions provided.'}), 400
+        key = hashlib.sha256(json.dumps(practice_questions, sort_keys=True).encode()).hexdigest()
+        pdf = practice_pdf_cache.get(key)
+        if pdf is None:
+            pdf = render_practice_pdf(practice_questions)
+            practice_pdf_cache.set(key, pdf)
+        response = make_response(pdf)
+        response.headers['Content-Type'] = 'application/pdf'
+        response.headers['Content-Disposition'] = f'attachment; filename=Math_Practice_Paper_{datetime.utcnow():%Y-%m-%d}.pdf'
+        return response
+    except Exception as e:
+        print(f"PDF error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        try:
-            practice_questions = json.loads(result_text)
-            # Deduplicate practice questions by number
-            seen = set()
-            unique_practice = []
-            for pq in practice_questions:
-                if pq['number'] not in seen:
-                    seen.add(pq['number'])
-                    unique_practice.append(pq)
-            return jsonify({'practice_questions': unique_practice})
-        except json.JSONDecodeError as e:
-            return jsonify({'error': f'Failed to parse: {str(e)}'}), 500
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition of the host-wide counters and histograms
+    return Response(usage_meter.exposition(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/costs')
+def metrics_costs():
+    # Per-user daily spend: ?from=YYYY-MM-DD&to=YYYY-MM-DD (default: today, UTC), optional ?user=
+    try:
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        day_from = datetime.strptime(request.args.get('from', today), '%Y-%m-%d').strftime('%Y-%m-%d')
+        day_to = datetime.strptime(request.args.get('to', day_from), '%Y-%m-%d').strftime('%Y-%m-%d')
+        rows = usage_meter.daily_costs(day_from, day_to)
+        if request.args.get('user'):
+            rows = [row for row in rows if row['user'] == request.args['user']]
+        return jsonify({'from': day_from, 'to': day_to, 'users': rows,
+                        'total_cost_usd': round(sum(row['cost_usd'] for row in rows), 6)})
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/stats')
+def stats():
+    return jsonify({name: provider() for name, provider in STATS_PROVIDERS.items()})
+
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
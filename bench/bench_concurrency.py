@@ -0,0 +1,66 @@
+"""How many concurrent analyses one gunicorn worker process can hold, per worker class.
+
+Starts one worker of each profile against the local mock OpenAI API (bench/mock_openai.py) and
+drives /analyze at rising concurrency. Admission control and the result cache are switched off so
+the worker itself is the only limit. "held" is the most upstream calls the mock saw at once, which
+is the number of analyses the process had in flight.
+
+    python bench/bench_concurrency.py
+    python bench/bench_concurrency.py --levels 1,16,64,256 --latency 5 --profiles sync,gevent
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_openai  # noqa: E402
+from loadtest import fixture_image, free_port, run_scenario, scenarios, start_app  # noqa: E402
+
+# name -> (worker class, threads)
+PROFILES = {
+    'sync': ('sync', 1),
+    'gthread': ('gthread', 8),
+    'gevent': ('gevent', 1),
+}
+UNLIMITED = {'ADMISSION_MAX_CONCURRENCY': '0', 'ADMISSION_TOKENS_PER_MINUTE': '0',
+             'OPENAI_POOL_MAX_CONNECTIONS': '2000', 'OPENAI_POOL_MAX_KEEPALIVE': '2000'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--profiles', default='sync,gthread,gevent', help=', '.join(PROFILES))
+    parser.add_argument('--levels', default='1,8,32,128', help='client concurrency levels')
+    parser.add_argument('--rounds', type=int, default=1, help='requests per client at each level')
+    parser.add_argument('--latency', type=float, default=1.0, help='mock upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--worker-connections', type=int, default=1000)
+    args = parser.parse_args()
+
+    _, mock_url, mock_stats = mock_openai.start(latency=args.latency, jitter=args.jitter)
+    analyze = scenarios(fixture_image())['analyze']
+    print(f'1 gunicorn worker per profile, mock latency {args.latency}s ± {args.jitter}s\n')
+    print(f'{"profile":<10}{"clients":>8}{"reqs":>6}{"errs":>6}{"p50":>9}{"p95":>9}{"req/s":>8}{"held":>6}'
+          f'{"peak RSS":>10}')
+    for name in args.profiles.split(','):
+        worker_class, threads = PROFILES[name]
+        options = argparse.Namespace(workers=1, worker_class=worker_class, threads=threads,
+                                     worker_connections=args.worker_connections)
+        port = free_port()
+        proc = start_app(options, mock_url, port, extra_env=UNLIMITED)
+        try:
+            for level in [int(n) for n in args.levels.split(',')]:
+                with mock_stats['lock']:
+                    mock_stats['peak_in_flight'] = 0
+                r = run_scenario(port, analyze, level, level * args.rounds, proc.pid)
+                print(f'{name:<10}{level:>8}{r["requests"]:>6}{r["errors"]:>6}{r["p50"]:>8.2f}s{r["p95"]:>8.2f}s'
+                      f'{r["rps"]:>8.1f}{mock_stats["peak_in_flight"]:>6}{r["peak_rss_mb"]:>8.0f}MB')
+                if r['error_samples']:
+                    print(f'{"":<10}errors: {r["error_samples"]}')
+        finally:
+            proc.terminate()
+            proc.wait()
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""End-to-end /analyze latency with and without server-side image preprocessing.
+
+Runs the Flask app in-process against the local mock OpenAI API (bench/mock_openai.py), reading
+request bodies at a simulated uplink bandwidth, so the numbers reflect the real encode and upload
+path without spending API credits.
+
+    python bench/bench_images.py                      # synthetic phone-photo fixtures
+    python bench/bench_images.py --fixtures ~/scans   # your own images
+"""
+import argparse
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_openai  # noqa: E402
+
+def synthetic_photo(seed, size=(4032, 3024)):
+    # A slightly shadowed sheet of handwriting-like strokes, saved like a phone camera would
+    rnd = random.Random(seed)
+    img = Image.new('RGB', size, (236, 232, 222))
+    draw = ImageDraw.Draw(img)
+    for y in range(300, size[1] - 300, 110):
+        x = 350
+        while x < size[0] - 500:
+            w = rnd.randint(30, 160)
+            draw.line([(x, y + rnd.randint(-8, 8)), (x + w, y + rnd.randint(-8, 8))],
+                      fill=(40, 40, 70), width=rnd.randint(4, 7))
+            x += w + rnd.randint(20, 60)
+    img = img.filter(ImageFilter.GaussianBlur(1))
+    noise = Image.effect_noise(size, 12).convert('RGB')
+    img = Image.blend(img, noise, 0.08)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees, as most phones store portrait shots
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=92, exif=exif)
+    return out.getvalue()
+
+
+def load_fixtures(path, count):
+    if path:
+        names = sorted(n for n in os.listdir(path) if n.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')))
+        return [(n, open(os.path.join(path, n), 'rb').read()) for n in names]
+    return [(f'page{i + 1}.jpg', synthetic_photo(i)) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', help='directory of images (default: synthetic 12 MP photos)')
+    parser.add_argument('--count', type=int, default=4, help='synthetic images per request')
+    parser.add_argument('--repeat', type=int, default=3, help='requests per mode')
+    parser.add_argument('--uplink-mbps', type=float, default=20.0, help='simulated upstream bandwidth')
+    args = parser.parse_args()
+
+    _, mock_url, mock_stats = mock_openai.start(uplink_mbps=args.uplink_mbps)
+    os.environ['OPENAI_BASE_URL'] = mock_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-bench')
+    os.environ['RESULT_CACHE_BACKEND'] = 'none'
+    os.environ.setdefault('MATH_OCR_DB', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import NgrokTest
+    from mathocr import images
+
+    fixtures = load_fixtures(args.fixtures, args.count)
+    upload_bytes = sum(len(data) for _, data in fixtures)
+    print(f'{len(fixtures)} fixtures, {upload_bytes / 1e6:.1f} MB per request, '
+          f'uplink {args.uplink_mbps:g} Mbit/s\n')
+    client = NgrokTest.app.test_client()
+    results = {}
+    for mode, enabled in (('original', False), ('preprocessed', True)):
+        images.IMAGE_PREPROCESS = enabled
+        received = mock_stats['bytes_received']
+        latencies = []
+        for _ in range(args.repeat):
+            files = [(io.BytesIO(data), name, 'image/jpeg') for name, data in fixtures]
+            start = time.perf_counter()
+            response = client.post('/analyze', data={'files': files}, content_type='multipart/form-data')
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        results[mode] = (statistics.median(latencies), (mock_stats['bytes_received'] - received) / args.repeat)
+
+    print(f'{"mode":<14}{"median latency":>16}{"upstream body":>16}')
+    for mode, (latency, body) in results.items():
+        print(f'{mode:<14}{latency:>15.2f}s{body / 1e6:>14.2f}MB')
+    (before, before_body), (after, after_body) = results['original'], results['preprocessed']
+    print(f'\nlatency {before / after:.1f}x faster, upstream body {before_body / after_body:.1f}x smaller')
+
+
+if __name__ == '__main__':
+    main()
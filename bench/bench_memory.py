@@ -0,0 +1,98 @@
+"""Peak memory of one /analyze request by upload size, with and without image preprocessing.
+
+Starts the app under gunicorn with a single sync worker against the local mock OpenAI API
+(bench/mock_openai.py). Before each request the worker's peak-RSS counter is reset through
+/proc/<pid>/clear_refs, so "peak" is the most memory that request made the worker hold above
+where it started. Linux only.
+
+    python bench/bench_memory.py
+    python bench/bench_memory.py --sizes 10,45 --repeat 5
+"""
+import argparse
+import http.client
+import io
+import os
+import statistics
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_openai  # noqa: E402
+from loadtest import free_port, multipart, start_app  # noqa: E402
+
+
+def noise_image(megabytes):
+    # Random pixels do not compress, so the PNG is about as large as its raw RGB data
+    side = int((megabytes * 1024 * 1024 / 3) ** 0.5)
+    img = Image.frombytes('RGB', (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    img.save(out, 'PNG', compress_level=1)
+    return out.getvalue()
+
+
+def memory_kb(pid, field):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def worker_pid(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        return int(f.read().split()[0])
+
+
+def measure(port, pid, body, content_type):
+    """(peak MB above the starting RSS, HTTP status) for one request."""
+    with open(f'/proc/{pid}/clear_refs', 'w') as f:
+        f.write('5')  # resets VmHWM to the current RSS
+    before = memory_kb(pid, 'VmRSS')
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+    conn.request('POST', '/analyze', body=body, headers={'Content-Type': content_type})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return (memory_kb(pid, 'VmHWM') - before) / 1024, response.status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='5,20,45', help='upload sizes in MB (MAX_CONTENT_LENGTH is 50)')
+    parser.add_argument('--repeat', type=int, default=3, help='requests per size; the median is reported')
+    args = parser.parse_args()
+
+    _, mock_url, mock_stats = mock_openai.start(latency=0.2)
+    fixtures = [(float(mb), multipart([('page.png', noise_image(float(mb)))])) for mb in args.sizes.split(',')]
+    print(f'{"preprocess":<12}{"upload":>9}{"peak RSS":>11}{"x upload":>10}{"upstream body":>15}')
+    for preprocess in ('1', '0'):
+        options = argparse.Namespace(workers=1, worker_class='sync', threads=1, worker_connections=1)
+        port = free_port()
+        # A fixed mmap threshold stops glibc from keeping freed large buffers in the heap, which would
+        # make each request's peak depend on the ones before it
+        env = {'IMAGE_PREPROCESS': preprocess, 'EXACT_PAGE_DEDUPE': '0', 'ADMISSION_TOKENS_PER_MINUTE': '0',
+               'MALLOC_MMAP_THRESHOLD_': str(1024 * 1024)}
+        proc = start_app(options, mock_url, port, extra_env=env)
+        try:
+            pid = worker_pid(proc.pid)
+            measure(port, pid, *multipart([('warmup.png', noise_image(0.5))]))
+            for mb, (body, content_type) in fixtures:
+                peaks = []
+                for _ in range(args.repeat):
+                    received = mock_stats['bytes_received']
+                    peak, status = measure(port, pid, body, content_type)
+                    if status != 200:
+                        print(f'  request failed with HTTP {status}')
+                    peaks.append(peak)
+                upstream = (mock_stats['bytes_received'] - received) / 1024 / 1024
+                peak = statistics.median(peaks)
+                print(f'{"on" if preprocess == "1" else "off":<12}{len(body) / 1024 / 1024:>7.1f}MB{peak:>9.0f}MB'
+                      f'{peak / (len(body) / 1024 / 1024):>10.1f}{upstream:>13.1f}MB')
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Practice-paper PDF: server-side reportlab rendering vs the browser screenshot path.
+
+The browser path (html2canvas at scale 2, then one full-height PNG placed in jsPDF) is emulated
+by rasterizing the same paper at 2x CSS resolution, stacking it into one tall PNG and embedding
+that in a single-page PDF. That is about what the client produces, minus DOM layout time, so the
+client numbers are a lower bound.
+
+    python bench/bench_pdf.py --questions 12 --repeat 5
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('MATH_OCR_DB', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NgrokTest  # noqa: E402
+from mathocr.practice_pdf import render_practice_pdf  # noqa: E402
+
+QUESTION = r'Solve $\frac{x^{2} + 3x}{4} \geq \sqrt{2x + 1} - 5$ and give the answer to $2$ decimal places.'
+CSS_PX_PER_PT = 96 / 72
+
+
+def client_screenshot_pdf(server_pdf):
+    import pymupdf
+    from PIL import Image
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    pages = []
+    with pymupdf.open(stream=server_pdf, filetype='pdf') as doc:
+        for page in doc:
+            pix = page.get_pixmap(matrix=pymupdf.Matrix(2 * CSS_PX_PER_PT, 2 * CSS_PX_PER_PT), alpha=False)
+            pages.append(Image.frombytes('RGB', (pix.width, pix.height), pix.samples))
+    tall = Image.new('RGB', (pages[0].width, sum(p.height for p in pages)), 'white')
+    y = 0
+    for page in pages:
+        tall.paste(page, (0, y))
+        y += page.height
+    png = io.BytesIO()
+    tall.save(png, 'PNG')  # canvas.toDataURL('image/png')
+    out = io.BytesIO()
+    pdf = canvas.Canvas(out, pagesize=A4)
+    width = A4[0]
+    pdf.drawImage(ImageReader(io.BytesIO(png.getvalue())), 0, A4[1] - tall.height * width / tall.width,
+                  width=width, height=tall.height * width / tall.width)
+    pdf.save()
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--questions', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    questions = [{'number': str(i + 1), 'question': QUESTION} for i in range(args.questions)]
+
+    server_times, client_times = [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        server_pdf = render_practice_pdf(questions)
+        server_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client_pdf = client_screenshot_pdf(server_pdf)
+        client_times.append(time.perf_counter() - start)
+
+    client = NgrokTest.app.test_client()
+    client.post('/practice_pdf', json={'practice_questions': questions})
+    start = time.perf_counter()
+    client.post('/practice_pdf', json={'practice_questions': questions})
+    cached = time.perf_counter() - start
+
+    print(f'{args.questions} questions, median of {args.repeat}\n')
+    print(f'{"path":<22}{"render time":>12}{"file size":>12}')
+    print(f'{"server (reportlab)":<22}{statistics.median(server_times) * 1000:>10.0f}ms{len(server_pdf) / 1024:>10.0f}KB')
+    print(f'{"server (cached)":<22}{cached * 1000:>10.1f}ms{len(server_pdf) / 1024:>10.0f}KB')
+    print(f'{"client screenshot*":<22}{statistics.median(client_times) * 1000:>10.0f}ms{len(client_pdf) / 1024:>10.0f}KB')
+    print('\n* emulated; real html2canvas also pays for DOM layout on the device')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Per-request session overhead of each SESSION_BACKEND.
+
+Times the session interface's open_session + save_session for a logged-in user, as Flask runs
+them around every request: mostly read-only requests, with one in --write-every modifying the
+session. Postgres is included when SESSION_DATABASE_URL or DATABASE_URL is set.
+
+    python bench/bench_sessions.py --requests 5000 --write-every 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('MATH_OCR_DB', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import NgrokTest  # noqa: E402
+from flask import request  # noqa: E402
+from mathocr import sessions  # noqa: E402
+
+
+def measure(backend, requests, write_every, cache_ttl):
+    sessions.SESSION_CACHE_TTL = cache_ttl
+    app = NgrokTest.app
+    interface = sessions.configure_sessions(app, backend)
+    with app.test_request_context('/'):
+        session = interface.open_session(app, request)
+        session.update(user='bench', logged_in=True, login_time='2024-01-01T00:00:00')
+        response = app.response_class()
+        interface.save_session(app, session, response)
+        cookie = response.headers.getlist('Set-Cookie')[0].split(';')[0]
+
+    times = []
+    for i in range(requests):
+        with app.test_request_context('/', headers={'Cookie': cookie}):
+            response = app.response_class()
+            start = time.perf_counter()
+            session = interface.open_session(app, request)
+            assert session.get('user') == 'bench'
+            if write_every and i % write_every == 0:
+                session['last_seen'] = i
+            interface.save_session(app, session, response)
+            times.append(time.perf_counter() - start)
+            cookies = response.headers.getlist('Set-Cookie')
+            if cookies:
+                cookie = cookies[0].split(';')[0]
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--write-every', type=int, default=20, help='one modifying request in N (0 = never)')
+    args = parser.parse_args()
+
+    runs = [('filesystem', 'filesystem', 0), ('sqlite', 'sqlite', sessions.SESSION_CACHE_TTL),
+            ('sqlite (no cache)', 'sqlite', 0), ('cookie', 'cookie', 0)]
+    if os.environ.get('SESSION_DATABASE_URL') or os.environ.get('DATABASE_URL'):
+        runs += [('postgres', 'postgres', sessions.SESSION_CACHE_TTL), ('postgres (no cache)', 'postgres', 0)]
+
+    print(f"{args.requests} requests, one write in {args.write_every or 'none'}\n")
+    print(f"{'backend':<22}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for label, backend, cache_ttl in runs:
+        times = sorted(measure(backend, args.requests, args.write_every, cache_ttl))
+        pct = lambda p: times[min(len(times) - 1, int(len(times) * p))] * 1e6  # noqa: E731
+        print(f"{label:<22}{statistics.mean(times) * 1e6:>8.0f}us{pct(0.5):>8.0f}us{pct(0.95):>8.0f}us{pct(0.99):>8.0f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Throughput and latency of the app's routes against the local mock OpenAI API.
+
+Starts the mock (bench/mock_openai.py) and the app under gunicorn, drives each scenario at the
+given concurrency and prints p50/p95/p99 latency, requests per second, errors and the peak RSS
+of the app's worker processes.
+
+    python bench/loadtest.py --concurrency 16 --requests 200 --latency 3 --jitter 1
+    python bench/loadtest.py --scenarios analyze --workers 4 --worker-class gthread --threads 8
+    python bench/loadtest.py --scenarios analyze --workers 1 --worker-class gevent --concurrency 64
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_openai  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUESTION = {"number": "3", "question": "Solve $2x + 3 = 13$", "student_original": "$2x = 16$ <br> $x = 8$",
+            "status": "incorrect", "error": "Added 3 instead of subtracting", "correct_solution": "$x = 5$",
+            "image_file": "page1.jpg", "error_bbox": None}
+
+
+def fixture_image():
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (1600, 1200), (240, 238, 230))
+    draw = ImageDraw.Draw(img)
+    for y in range(100, 1100, 60):
+        draw.line([(100, y), (1400, y + 5)], fill=(30, 30, 60), width=4)
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def multipart(files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, data in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                   f'Content-Type: image/jpeg\r\n\r\n'.encode())
+        body.write(data + b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+def scenarios(image):
+    analyze_body, analyze_type = multipart([('page1.jpg', image)])
+    return {
+        'login': lambda i: ('POST', '/api/login', json.dumps({'username': f'bench{i % 50}@example.com'}),
+                            'application/json'),
+        'analyze': lambda i: ('POST', '/analyze', analyze_body, analyze_type),
+        'reanalyze': lambda i: ('POST', '/reanalyze', json.dumps(dict(QUESTION, user_query=f'why is this wrong? {i}')),
+                                'application/json'),
+        'practice': lambda i: ('POST', '/generate_practice', json.dumps({'analysis': {'questions': [QUESTION]}}),
+                               'application/json'),
+    }
+
+
+def process_tree_rss(pid):
+    """Total resident memory in MB of pid and its direct children (the gunicorn workers)."""
+    pids = [pid]
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    total = 0
+    for p in pids:
+        try:
+            with open(f'/proc/{p}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = (len(values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def run_scenario(port, make_request, concurrency, total, server_pid):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(total))
+    peak_rss = [process_tree_rss(server_pid)]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.2):
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(server_pid))
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            method, path, body, content_type = make_request(i)
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers={'Content-Type': content_type})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+            except Exception as e:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+                ok, response = False, e
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if ok else errors).append(elapsed if ok else str(getattr(response, 'status', response)))
+        conn.close()
+
+    threading.Thread(target=sample, daemon=True).start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    wall = time.perf_counter() - start
+    done.set()
+    return {
+        'requests': len(latencies) + len(errors), 'errors': len(errors), 'error_samples': errors[:3],
+        'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+        'rps': (len(latencies) + len(errors)) / wall, 'peak_rss_mb': peak_rss[0],
+    }
+
+
+def wait_for_port(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit('app server exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit('app server did not start')
+
+
+def start_app(args, mock_url, port, extra_env=None):
+    tmp = tempfile.mkdtemp(prefix='math_ocr_bench_')
+    env = dict(os.environ, OPENAI_BASE_URL=mock_url, OPENAI_API_KEY='sk-bench',
+               MATH_OCR_DB=os.path.join(tmp, 'bench.db'), JOB_DIR=os.path.join(tmp, 'jobs'),
+               LOGIN_LOG_FILE=os.path.join(tmp, 'login_logs.json'), RESULT_CACHE_BACKEND='none',
+               **(extra_env or {}))
+    cmd = [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(args.workers),
+           '-k', args.worker_class, '--threads', str(args.threads),
+           '--worker-connections', str(args.worker_connections), '--timeout', '600', 'NgrokTest:app']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wait_for_port(port, proc)
+    return proc
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default='login,analyze,reanalyze,practice')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=80, help='requests per scenario')
+    parser.add_argument('--latency', type=float, default=2.0, help='mock upstream latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.5)
+    parser.add_argument('--recordings', help='JSON file of recorded replies (see mock_openai.py)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--worker-connections', type=int, default=1000, help='requests per gevent worker')
+    args = parser.parse_args()
+
+    recordings = json.load(open(args.recordings)) if args.recordings else None
+    _, mock_url, mock_stats = mock_openai.start(latency=args.latency, jitter=args.jitter, recordings=recordings)
+    port = free_port()
+    proc = start_app(args, mock_url, port)
+    try:
+        print(f'gunicorn {args.workers} x {args.worker_class} (threads={args.threads}), concurrency '
+              f'{args.concurrency}, mock latency {args.latency}s ± {args.jitter}s\n')
+        print(f'{"scenario":<11}{"reqs":>6}{"errs":>6}{"p50":>9}{"p95":>9}{"p99":>9}{"req/s":>9}{"peak RSS":>11}')
+        available = scenarios(fixture_image())
+        for name in args.scenarios.split(','):
+            r = run_scenario(port, available[name], args.concurrency, args.requests, proc.pid)
+            print(f'{name:<11}{r["requests"]:>6}{r["errors"]:>6}{r["p50"]:>8.2f}s{r["p95"]:>8.2f}s'
+                  f'{r["p99"]:>8.2f}s{r["rps"]:>9.1f}{r["peak_rss_mb"]:>9.0f}MB')
+            if r['error_samples']:
+                print(f'{"":<11}errors: {r["error_samples"]}')
+        print(f'\nupstream calls: {mock_stats["requests"]} {mock_stats["by_route"]}')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
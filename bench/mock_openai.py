@@ -0,0 +1,152 @@
+"""Local stand-in for the OpenAI chat completions API, for benchmarks that must not spend credits.
+
+Replays recorded replies with configurable latency and jitter, streamed or not, and can throttle
+how fast request bodies are read to simulate a slow uplink.
+
+    python bench/mock_openai.py --port 8900 --latency 8 --jitter 2
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 gunicorn NgrokTest:app
+
+Recordings are a JSON object mapping a route name (analyze, reanalyze, practice) to a list of
+reply strings; one is picked at random for each request.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_RECORDINGS = {
+    'analyze': [json.dumps([
+        {"number": str(n), "question": f"Solve $2x + {n} = {n + 10}$",
+         "student_original": "Student wrote: $2x = 10$ <br> $x = 5$",
+         "status": ("correct", "partial", "incorrect")[n % 3], "error": "No errors found" if n % 3 == 0 else "Sign error",
+         "correct_solution": f"Subtract {n}: $2x = 10$ <br> Divide by 2: $x = 5$",
+         "image_file": "page1.jpg", "error_bbox": None}
+        for n in range(1, 9)])],
+    'reanalyze': [json.dumps({"status": "partial", "error": "The sign flips when moving the term.",
+                              "correct_solution": "$2x = 10$ <br> $x = 5$",
+                              "response": "You subtracted on one side only."})],
+    'practice': [json.dumps([{"number": str(n), "question": f"Solve $3x - {n} = {2 * n}$"} for n in range(1, 6)])],
+}
+
+
+def route_of(body):
+    text = json.dumps(body.get('messages', []))
+    if 'Re-analyze' in text:
+        return 'reanalyze'
+    if 'Generate practice' in text:
+        return 'practice'
+    return 'analyze'
+
+
+class MockOpenAI(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    config = None  # set by start()
+
+    def do_POST(self):
+        cfg = self.config
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if cfg['uplink_bytes_per_sec']:
+            time.sleep(length / cfg['uplink_bytes_per_sec'])
+        route = route_of(body)
+        with cfg['lock']:
+            cfg['requests'] += 1
+            cfg['bytes_received'] += length
+            cfg['by_route'][route] = cfg['by_route'].get(route, 0) + 1
+            cfg['in_flight'] += 1
+            cfg['peak_in_flight'] = max(cfg['peak_in_flight'], cfg['in_flight'])
+        content = random.choice(cfg['recordings'][route])
+        latency = max(random.gauss(cfg['latency'], cfg['jitter']), 0.0) if cfg['jitter'] else cfg['latency']
+        usage = {"prompt_tokens": length // 4, "completion_tokens": len(content) // 4,
+                 "total_tokens": length // 4 + len(content) // 4}
+        try:
+            if body.get('stream'):
+                self._stream(body, content, latency, usage)
+            else:
+                time.sleep(latency)
+                self._send_json({
+                    "id": "mock", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get('model'),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": usage,
+                })
+        finally:
+            with cfg['lock']:
+                cfg['in_flight'] -= 1
+
+    def _stream(self, body, content, latency, usage):
+        # Spread the latency over the reply, like a model writing tokens
+        pieces = [content[i:i + 24] for i in range(0, len(content), 24)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, piece in enumerate(pieces):
+            time.sleep(latency / len(pieces))
+            self._chunk({"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body.get('model'),
+                         "choices": [{"index": 0, "delta": {"content": piece},
+                                      "finish_reason": "stop" if i == len(pieces) - 1 else None}]})
+        if body.get('stream_options', {}).get('include_usage'):
+            self._chunk({"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body.get('model'), "choices": [], "usage": usage})
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _chunk(self, payload):
+        self._write_chunk(f'data: {json.dumps(payload)}\n\n'.encode())
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(port=0, latency=0.0, jitter=0.0, uplink_mbps=None, recordings=None):
+    """Starts the mock in a background thread; returns (server, base_url, stats_dict)."""
+    config = {
+        'latency': latency, 'jitter': jitter,
+        'uplink_bytes_per_sec': uplink_mbps * 1e6 / 8 if uplink_mbps else None,
+        'recordings': dict(DEFAULT_RECORDINGS, **(recordings or {})),
+        'requests': 0, 'bytes_received': 0, 'by_route': {}, 'lock': threading.Lock(),
+        'in_flight': 0, 'peak_in_flight': 0,  # completions being answered right now, and the most at once
+    }
+    handler = type('ConfiguredMockOpenAI', (MockOpenAI,), {'config': config})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/v1', config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local OpenAI-compatible mock server')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=5.0, help='mean seconds per completion')
+    parser.add_argument('--jitter', type=float, default=1.0, help='standard deviation of the latency')
+    parser.add_argument('--uplink-mbps', type=float, help='throttle request bodies to this bandwidth')
+    parser.add_argument('--recordings', help='JSON file of recorded replies per route')
+    args = parser.parse_args()
+    recordings = json.load(open(args.recordings)) if args.recordings else None
+    server, url, _ = start(args.port, args.latency, args.jitter, args.uplink_mbps, recordings)
+    print(f'Mock OpenAI API on {url} (latency {args.latency}s ± {args.jitter}s)')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""gunicorn settings; `gunicorn NgrokTest:app` picks this file up from the working directory.
+
+The default profile is the one the app always ran with: sync workers, one request per process.
+Almost all of an analysis is spent waiting on OpenAI, so for classroom load run cooperative workers
+instead, which hold up to GUNICORN_WORKER_CONNECTIONS requests per process:
+
+    GUNICORN_WORKER_CLASS=gevent gunicorn NgrokTest:app
+
+The gevent worker monkey-patches the standard library before it imports the app, so the app is
+never preloaded in the master. See mathocr/cooperative.py for what runs off the loop.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 200))
+# Long enough for a sharded multi-page analysis; a gevent worker only times out if its loop is stuck
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = 5
+preload_app = False
+
+# httpcore imports trio when it is installed, and trio needs select.epoll, which gevent's patching
+# removes; importing it here, in the master, loads it before a gevent worker patches anything
+import httpcore  # noqa: E402,F401
@@ -0,0 +1 @@
+"""Subsystems of the math OCR app; NgrokTest.py builds the Flask app and routes on top of them."""
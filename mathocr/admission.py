@@ -0,0 +1,241 @@
+"""Admission control for OpenAI calls: one concurrency limit and token budget per host.
+
+Every OpenAI call goes through call_openai(), which first takes a slot from a limiter shared by all
+workers on the host through the local SQLite database: at most ADMISSION_MAX_CONCURRENCY calls in
+flight and a token bucket refilled at ADMISSION_TOKENS_PER_MINUTE (estimated prompt + image +
+max completion tokens, corrected with the real usage afterwards). Waiting calls in one worker are
+admitted round-robin by user, so one student's ten uploads cannot starve the rest of the class.
+A call that cannot be admitted within ADMISSION_MAX_WAIT seconds fails with UpstreamBusyError,
+which the routes turn into a 429. Either limit is disabled by setting it to 0.
+"""
+from flask import session, has_request_context
+import os
+import time
+from collections import OrderedDict
+import threading
+import uuid
+
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.stats import STATS_PROVIDERS
+
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get('ADMISSION_MAX_CONCURRENCY', 8))
+ADMISSION_TOKENS_PER_MINUTE = int(os.environ.get('ADMISSION_TOKENS_PER_MINUTE', 500000))
+ADMISSION_MAX_WAIT = float(os.environ.get('ADMISSION_MAX_WAIT', 30))
+ADMISSION_JOB_MAX_WAIT = float(os.environ.get('ADMISSION_JOB_MAX_WAIT', 600))
+ADMISSION_LEASE = 600  # seconds before a slot left behind by a dead worker is reclaimed
+ADMISSION_FAIRNESS_MEMORY = 3600  # seconds a user's last admission still counts in the round-robin order
+IMAGE_TOKEN_ESTIMATE = 765  # a high-detail 768x1024 page: 4 tiles * 170 + 85
+LOW_DETAIL_TOKEN_ESTIMATE = 85  # any low-detail image
+
+# Who the current upstream call is for; set by job workers and fan-out threads, which have no session
+upstream_context = threading.local()
+
+
+class UpstreamBusyError(Exception):
+    """An OpenAI call was not admitted in time."""
+    status = 429
+
+    def __init__(self, message='The tutor is busy with other students right now. Please try again in a minute.',
+                 retry_after=30):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def upstream_user(default='anonymous'):
+    user = getattr(upstream_context, 'user', None)
+    if user is None and has_request_context():
+        user = session.get('user')
+    return user or default
+
+
+def estimate_tokens(kwargs):
+    text_chars = image_tokens = 0
+    for message in kwargs.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content or []:
+            if part.get('type') == 'image_url':
+                low = part['image_url'].get('detail') == 'low'
+                image_tokens += LOW_DETAIL_TOKEN_ESTIMATE if low else IMAGE_TOKEN_ESTIMATE
+            else:
+                text_chars += len(part.get('text', ''))
+    return text_chars // 4 + image_tokens + kwargs.get('max_completion_tokens', 0)
+
+
+def count_image_bytes(kwargs):
+    # Decoded size of the data: URLs sent in this call
+    total = 0
+    for message in kwargs.get('messages', []):
+        content = message.get('content')
+        for part in content if isinstance(content, list) else []:
+            if part.get('type') == 'image_url':
+                url = part['image_url']['url']
+                total += (len(url) - url.find(',') - 1) * 3 // 4
+    return total
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency=ADMISSION_MAX_CONCURRENCY, tokens_per_minute=ADMISSION_TOKENS_PER_MINUTE):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self._cond = threading.Condition()
+        self._waiting = OrderedDict()  # user -> tickets in arrival order
+        self._last_admitted = OrderedDict()  # user -> monotonic time of their last admission, oldest first
+        self._next_ticket = 0
+        self._schema_ready = False
+        self.admitted = 0
+        self.rejected = {'queue': 0, 'concurrency': 0, 'tokens': 0}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.refunded_tokens = 0
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS upstream_slots (id TEXT PRIMARY KEY, pid INTEGER, user TEXT, '
+                     'tokens INTEGER, acquired REAL NOT NULL, expires REAL NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS upstream_budget (id INTEGER PRIMARY KEY, tokens REAL NOT NULL, '
+                     'updated REAL NOT NULL)')
+        self._schema_ready = True
+
+    def _available_tokens(self, conn, now):
+        row = conn.execute('SELECT tokens, updated FROM upstream_budget WHERE id = 1').fetchone()
+        if row is None:
+            return float(self.tokens_per_minute)
+        return min(float(self.tokens_per_minute), row[0] + (now - row[1]) * self.tokens_per_minute / 60)
+
+    @blocking
+    def _try_acquire(self, user, tokens):
+        """Takes a slot and the tokens in one transaction; returns (slot_id, None) or (None, blocking_limit)."""
+        conn = db()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM upstream_slots WHERE expires < ?', (now,))
+            if self.max_concurrency > 0:
+                in_flight = conn.execute('SELECT COUNT(*) FROM upstream_slots').fetchone()[0]
+                if in_flight >= self.max_concurrency:
+                    conn.execute('COMMIT')
+                    return None, 'concurrency'
+            if self.tokens_per_minute > 0:
+                available = self._available_tokens(conn, now)
+                # A call larger than the whole bucket waits for a full bucket instead of forever
+                if available < min(tokens, self.tokens_per_minute):
+                    conn.execute('COMMIT')
+                    return None, 'tokens'
+                conn.execute('INSERT OR REPLACE INTO upstream_budget (id, tokens, updated) VALUES (1, ?, ?)',
+                             (available - tokens, now))
+            slot_id = uuid.uuid4().hex
+            conn.execute('INSERT INTO upstream_slots (id, pid, user, tokens, acquired, expires) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (slot_id, os.getpid(), user, tokens, now, now + ADMISSION_LEASE))
+            conn.execute('COMMIT')
+            return slot_id, None
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _my_turn(self, user, ticket):
+        # The next caller is the oldest ticket of the waiting user admitted longest ago
+        next_user = min(self._waiting, key=lambda u: (self._last_admitted.get(u, 0.0), self._waiting[u][0]))
+        return next_user == user and self._waiting[user][0] == ticket
+
+    def _remember_admission(self, user):
+        # Called under _cond. Users idle for ADMISSION_FAIRNESS_MEMORY are forgotten; they would be
+        # first in line anyway, and the dict stays as small as the set of recently active users.
+        now = time.monotonic()
+        self._last_admitted[user] = now
+        self._last_admitted.move_to_end(user)
+        while next(iter(self._last_admitted.values())) < now - ADMISSION_FAIRNESS_MEMORY:
+            self._last_admitted.popitem(last=False)
+
+    def acquire(self, user, tokens, max_wait, quiet=False):
+        self._init_schema()
+        started = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._waiting.setdefault(user, []).append(ticket)
+        blocked_by = None
+        try:
+            while True:
+                with self._cond:
+                    while not self._my_turn(user, ticket):
+                        remaining = max_wait - (time.monotonic() - started)
+                        if remaining <= 0:
+                            raise UpstreamBusyError()
+                        self._cond.wait(min(remaining, 0.25))
+                slot_id, blocked_by = self._try_acquire(user, tokens)
+                waited = time.monotonic() - started
+                if slot_id is not None:
+                    with self._cond:
+                        self.admitted += 1
+                        self.wait_total += waited
+                        self.wait_max = max(self.wait_max, waited)
+                        self._remember_admission(user)
+                    return slot_id
+                if waited >= max_wait:
+                    raise UpstreamBusyError()
+                # Slots freed by other workers are only seen by polling
+                with self._cond:
+                    self._cond.wait(min(max_wait - waited, 0.05 if blocked_by == 'concurrency' else 0.25))
+        except UpstreamBusyError:
+            if quiet:
+                raise
+            with self._cond:
+                self.rejected[blocked_by or 'queue'] += 1
+            print(f"⚠️ Upstream call for {user} rejected after {max_wait:.1f}s ({blocked_by or 'queue'})")
+            raise
+        finally:
+            with self._cond:
+                tickets = self._waiting[user]
+                tickets.remove(ticket)
+                if not tickets:
+                    del self._waiting[user]
+                self._cond.notify_all()
+
+    def release(self, slot_id, estimated_tokens, usage=None):
+        total = getattr(usage, 'total_tokens', None)
+        # Give back what the estimate over-reserved (or charge what it under-reserved)
+        refund = estimated_tokens - total if total is not None and self.tokens_per_minute > 0 else None
+        self._release_slot(slot_id, refund)
+        with self._cond:
+            if refund is not None:
+                self.refunded_tokens += refund
+            self._cond.notify_all()
+
+    @blocking
+    def _release_slot(self, slot_id, refund):
+        conn = db()
+        conn.execute('DELETE FROM upstream_slots WHERE id = ?', (slot_id,))
+        if refund is not None:
+            conn.execute('UPDATE upstream_budget SET tokens = MIN(?, tokens + ?) WHERE id = 1',
+                         (self.tokens_per_minute, refund))
+
+    def stats(self):
+        self._init_schema()
+        conn = db()
+        now = time.time()
+        in_flight = conn.execute('SELECT COUNT(*) FROM upstream_slots WHERE expires >= ?', (now,)).fetchone()[0]
+        with self._cond:
+            waiting = {user: len(tickets) for user, tickets in self._waiting.items()}
+        return {
+            'max_concurrency': self.max_concurrency,
+            'tokens_per_minute': self.tokens_per_minute,
+            'in_flight': in_flight,
+            'tokens_available': round(self._available_tokens(conn, now)) if self.tokens_per_minute > 0 else None,
+            'waiting': sum(waiting.values()),
+            'waiting_users': len(waiting),
+            'admitted': self.admitted,
+            'rejected': dict(self.rejected),
+            'avg_queue_seconds': round(self.wait_total / self.admitted, 3) if self.admitted else 0.0,
+            'max_queue_seconds': round(self.wait_max, 3),
+            'refunded_tokens': self.refunded_tokens,
+        }
+
+
+admission = AdmissionController()
+STATS_PROVIDERS['admission'] = admission.stats
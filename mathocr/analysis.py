@@ -0,0 +1,286 @@
+"""The analysis pipeline: uploads to deduplicated pages, pages to model calls, replies to questions.
+
+ANALYZE_MODE=fanout sends each group of ANALYZE_SHARD_SIZE files as its own upstream call, at most
+ANALYZE_CONCURRENCY at a time per worker, and merges the per-shard answers. A failing shard only
+drops its own files. Clients can also pick the mode per request with the form field "mode".
+"""
+import os
+import json
+import time
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.datastructures import FileStorage
+
+from mathocr.admission import IMAGE_TOKEN_ESTIMATE, UpstreamBusyError, upstream_context, upstream_user
+from mathocr.cache import analysis_cache_key, cached_analysis, dedupe_by_number, file_digest, store_analysis
+from mathocr.config import ANALYZE_MODEL
+from mathocr.crops import analysis_pages
+from mathocr.history import analysis_history
+from mathocr.images import prepare_image
+from mathocr.jobs import JOB_DIR, job_queue
+from mathocr.openai_client import get_openai_client
+from mathocr.pages import EXACT_PAGE_DEDUPE, dedupe_stats, page_fingerprint, page_index, same_page
+from mathocr.parsing import ANALYSIS_SCHEMA, ModelReplyError, create_structured_completion, parse_model_json
+from mathocr.pdf import rasterize_pdf
+from mathocr.uploads import UploadError, data_url, source_size
+
+ANALYZE_MODE = os.environ.get('ANALYZE_MODE', 'single')
+ANALYZE_SHARD_SIZE = int(os.environ.get('ANALYZE_SHARD_SIZE', 1))
+ANALYZE_CONCURRENCY = int(os.environ.get('ANALYZE_CONCURRENCY', 4))
+_analyze_pool = ThreadPoolExecutor(max_workers=ANALYZE_CONCURRENCY, thread_name_prefix='analyze')
+
+
+class AnalysisError(Exception):
+    """The model reply could not be turned into a list of questions."""
+
+
+def _file_pages(file):
+    """Returns (pages, bytes_in, bytes_out) for one upload; pages are (name, mime, data) images.
+
+    A PDF that cannot be rendered raises UploadError, so the request fails instead of the model
+    being sent only the file name.
+    """
+    bytes_in = bytes_out = 0
+    file.seek(0)
+    if file.content_type.startswith('image/'):
+        mime, data, original_size = prepare_image(file)
+        bytes_in, bytes_out = original_size, source_size(data)
+        pages = [(file.filename, mime, data)]
+    elif file.mimetype == 'application/pdf' or file.filename.lower().endswith('.pdf'):
+        try:
+            rendered, total_pages = rasterize_pdf(file)
+        except TimeoutError as e:
+            print(f"PDF error for {file.filename}: {str(e)}")
+            raise UploadError(f'{file.filename} took too long to read; try uploading fewer pages at once') from e
+        except Exception as e:
+            print(f"PDF error for {file.filename}: {str(e)}")
+            raise UploadError(f'Could not read {file.filename}; check that the PDF opens') from e
+        if total_pages > len(rendered):
+            print(f"⚠️ {file.filename}: only {len(rendered)} of {total_pages} pages analyzed")
+        pages = [(label, 'image/jpeg', data) for label, data in rendered]
+    else:
+        pages = []
+    return pages, bytes_in, bytes_out
+
+
+def _page_parts(name, mime, data):
+    return [
+        {"type": "text", "text": f"Image file: {name}"},
+        {"type": "image_url", "image_url": {"url": data_url(mime, data), "detail": "high"}},
+    ]
+
+
+def collect_pages(files, user=None, analysis_id=None):
+    """Preprocesses the uploads and drops duplicate pages.
+
+    Returns (per_file, reused_questions, page_prints, report): per_file holds
+    (names, parts, bytes_in, bytes_out) for the pages still to be analyzed,
+    reused_questions come from the user's earlier analyses of the same pages, and
+    page_prints maps each analyzed page name to its fingerprint for PageIndex.
+    With an analysis_id and a user, the pages to be analyzed are kept for question crops,
+    and so are reused pages, whose questions are tagged with that analysis_id.
+    Each upload is closed once its pages are encoded.
+    """
+    per_file, reused, page_prints, kept = [], [], {}, []
+    report = {'pages': 0, 'duplicates': 0, 'reused': 0, 'bytes_saved': 0}
+    for file in files:
+        pages, bytes_in, bytes_out = _file_pages(file)
+        if not pages:
+            file.close()
+            per_file.append(([file.filename], [{"type": "text", "text": f"[PDF file: {file.filename}]"}], 0, 0))
+            continue
+        names, parts = [], []
+        for name, mime, data in pages:
+            report['pages'] += 1
+            if EXACT_PAGE_DEDUPE:
+                page = page_fingerprint(data)
+                if any(same_page(page, earlier) for earlier in kept):
+                    print(f"♻️ {name}: duplicate of an earlier page, skipped")
+                    report['duplicates'] += 1
+                    report['bytes_saved'] += source_size(data)
+                    continue
+                kept.append(page)
+                match = page_index.find(user, page) if user is not None else None
+                if match is not None:
+                    print(f"♻️ {name}: seen before, reusing its questions")
+                    questions = [dict(q, image_file=name) for q in json.loads(match)]
+                    if analysis_id is not None:
+                        # Kept again under this analysis, whose page and boxes the follow-ups will look up
+                        analysis_pages.save_page(analysis_id, name, data, user)
+                        analysis_pages.remember(analysis_id, questions)
+                    reused.extend(questions)
+                    report['reused'] += 1
+                    report['bytes_saved'] += source_size(data)
+                    continue
+                page_prints[name] = page
+            names.append(name)
+            if analysis_id is not None and user is not None:
+                analysis_pages.save_page(analysis_id, name, data, user)
+            parts.extend(_page_parts(name, mime, data))
+        del pages, data
+        file.close()
+        if names:
+            per_file.append((names, parts, bytes_in, bytes_out))
+    dedupe_stats.record(report)
+    return per_file, reused, page_prints, report
+
+
+def _analysis_prompt(file_names):
+    return f""" 
+        Analyze the math problems in these files: {', '.join(file_names)}
+        For each question you find:
+        1. Extract the question number (use what's in the image)
+        2. Write the question with math formatted using $ for inline math like $x^2$ and $$ for display math
+        3. Copy the student's work exactly as written (use $ for their math too)
+        4. Check if it's "correct", "partial", or "incorrect". Be balanced: 'correct' if fully right, 'partial' if mostly right but minor errors, 'incorrect' if major mistakes.
+        5. Explain any errors you see
+        6. Provide the correct solution with clear steps (separate steps with <br>)
+        7. Note which image file this is from
+        8. Give error_bbox: the box around the student's working for this question on that image, as fractions of the image width and height (x, y is the top-left corner, all values between 0 and 1), or null if you cannot locate it
+        Ensure each unique question number appears only once, even if in multiple files. Deduplicate by question number.
+        Return ONLY a JSON array (no extra text): 
+        [{{
+            "number": "1",
+            "question": "Solve $2x + 5 = 15$",
+            "student_original": "Student wrote: $2x = 10$ <br> $x = 5$",
+            "status": "correct",
+            "error": "No errors found",
+            "correct_solution": "Subtract 5 from both sides: $2x = 10$ <br> Divide by 2: $x = 5$ <br> Answer: $x = 5$",
+            "image_file": "{file_names[0] if file_names else 'image.jpg'}",
+            "error_bbox": {{"x": 0.05, "y": 0.1, "width": 0.6, "height": 0.15}}
+        }}]
+        """
+
+
+def analysis_messages(file_names, file_contents):
+    return [{
+        "role": "user",
+        "content": [{"type": "text", "text": _analysis_prompt(file_names)}] + file_contents
+    }]
+
+
+def run_analysis(client, file_names, file_contents):
+    """One upstream call over the given content parts; returns the deduplicated questions."""
+    response = create_structured_completion(
+        client, 'analyze', 'analysis', ANALYSIS_SCHEMA,
+        model=ANALYZE_MODEL,
+        messages=analysis_messages(file_names, file_contents),
+        max_completion_tokens=9000,
+        temperature=0.3
+    )
+
+    try:
+        questions = parse_model_json('analyze', response.choices[0].message.content, key='questions')
+    except ModelReplyError as e:
+        raise AnalysisError('Could not understand AI response. Please try again.') from e
+    # Deduplicate questions by number
+    return dedupe_by_number([q for q in questions if 'number' in q])
+
+
+def run_sharded_analysis(client, per_file, on_shard=None):
+    """Fans per_file [(names, parts, ...)] out in shards; returns (questions, shard_reports).
+
+    on_shard(names, questions) is called for every shard that succeeds.
+    """
+    shards = [per_file[i:i + ANALYZE_SHARD_SIZE] for i in range(0, len(per_file), ANALYZE_SHARD_SIZE)]
+    user = upstream_user()
+    max_wait = getattr(upstream_context, 'max_wait', None)
+
+    def run(shard):
+        names = [name for entry in shard for name in entry[0]]
+        parts = [part for entry in shard for part in entry[1]]
+        start = time.perf_counter()
+        upstream_context.user, upstream_context.max_wait = user, max_wait
+        try:
+            questions, error, upstream_error = run_analysis(client, names, parts), None, None
+            if on_shard is not None:
+                on_shard(names, questions)
+        except Exception as e:
+            questions, error = [], str(e)
+            upstream_error = e if isinstance(e, UpstreamBusyError) else None
+        finally:
+            upstream_context.user = upstream_context.max_wait = None
+        report = {'files': names, 'seconds': round(time.perf_counter() - start, 2),
+                  'questions': len(questions), 'error': error}
+        print(f"🧩 Shard {', '.join(names)}: {report['seconds']}s, {len(questions)} questions"
+              + (f", error: {error}" if error else ""))
+        return questions, report, upstream_error
+
+    results = list(_analyze_pool.map(run, shards))
+    upstream_errors = [upstream_error for _, _, upstream_error in results if upstream_error is not None]
+    if len(upstream_errors) == len(shards):
+        # Nothing got through upstream: answer like the single-call path would
+        raise upstream_errors[0]
+    questions = dedupe_by_number([q for shard_questions, _, _ in results for q in shard_questions])
+    return questions, [report for _, report, _ in results]
+
+
+def analyze_files(api_key, files, mode=ANALYZE_MODE):
+    """The whole /analyze pipeline for a list of FileStorage uploads; returns (result, http_status)."""
+    # Identical file sets (same page content, same model and prompt) reuse the stored result
+    digests = [file_digest(file) for file in files]
+    cache_key = analysis_cache_key(digests)
+    questions = cached_analysis(cache_key, digests, files)
+    user = upstream_user(default=None)
+    upload_names = [file.filename for file in files]
+    if questions is not None:
+        return {'questions': questions, 'history_id': analysis_history.add(user, upload_names, questions)}, 200
+
+    client = get_openai_client(api_key)
+    analysis_id = uuid.uuid4().hex
+    per_file, reused, page_prints, dedupe = collect_pages(files, user, analysis_id)
+    bytes_in = sum(entry[2] for entry in per_file)
+    bytes_out = sum(entry[3] for entry in per_file)
+    if bytes_in:
+        print(f"🗜️ Images: {bytes_in / 1024:.0f} KB -> {bytes_out / 1024:.0f} KB ({(bytes_in - bytes_out) / 1024:.0f} KB saved)")
+
+    def remember(names, questions):
+        analysis_pages.remember(analysis_id, questions)
+        page_index.remember(user, page_prints, names, questions)
+
+    shards = None
+    if not per_file:
+        unique_questions, failed = [], []
+    elif mode == 'fanout' and len(per_file) > 1:
+        unique_questions, shards = run_sharded_analysis(client, per_file, on_shard=remember)
+        failed = [shard for shard in shards if shard['error']]
+        if len(failed) == len(shards) and not reused:
+            return {'error': failed[0]['error'], 'shards': shards}, 500
+    else:
+        file_names = [name for entry in per_file for name in entry[0]]
+        file_contents = [part for entry in per_file for part in entry[1]]
+        unique_questions = run_analysis(client, file_names, file_contents)
+        remember(file_names, unique_questions)
+        failed = []
+    unique_questions = dedupe_by_number(reused + unique_questions)
+
+    print(f"✅ Parsed {len(unique_questions)} unique questions")
+    if not failed:
+        store_analysis(cache_key, digests, files, unique_questions)
+    result = {'questions': unique_questions,
+              'history_id': analysis_history.add(user, upload_names, unique_questions)}
+    if shards is not None:
+        result['shards'] = shards
+    if dedupe['duplicates'] or dedupe['reused']:
+        skipped = dedupe['duplicates'] + dedupe['reused']
+        result['dedupe'] = dict(dedupe, image_tokens_saved=skipped * IMAGE_TOKEN_ESTIMATE)
+    return result, 200
+
+
+@job_queue.handler('analyze')
+def _analyze_job(job_id, payload):
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        return {'error': 'OpenAI API key not configured.'}
+    files = [FileStorage(stream=open(f['path'], 'rb'), filename=f['name'], content_type=f['content_type'])
+             for f in payload['files']]
+    try:
+        result, status = analyze_files(api_key, files, payload.get('mode', ANALYZE_MODE))
+    except (AnalysisError, UploadError) as e:
+        result = {'error': str(e)}
+    finally:
+        for file in files:
+            file.close()
+        shutil.rmtree(os.path.join(JOB_DIR, job_id), ignore_errors=True)
+    return result
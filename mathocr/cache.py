@@ -0,0 +1,271 @@
+"""Caches for analysis results and other model answers: in process, in SQLite or in Postgres."""
+import os
+import json
+import hashlib
+import time
+from collections import OrderedDict
+from PIL import Image, ImageOps
+import threading
+
+from mathocr.config import ANALYZE_MODEL, ANALYZE_PROMPT_VERSION
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.stats import STATS_PROVIDERS
+
+
+class LRUCache:
+    """In-process LRU cache with size and TTL eviction."""
+
+    def __init__(self, max_entries=256, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """On-disk cache in the local SQLite database, shared by all workers on the host."""
+
+    def __init__(self, max_entries=5000, ttl=30 * 24 * 3600, table='result_cache'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        db().execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                     f'created REAL NOT NULL, last_used REAL NOT NULL)')
+        db().execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_last_used ON {table} (last_used)')
+
+    @blocking
+    def get(self, key):
+        now = time.time()
+        row = db().execute(f'SELECT value, created FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl and now - row[1] > self.ttl:
+            db().execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            return None
+        db().execute(f'UPDATE {self.table} SET last_used = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    @blocking
+    def set(self, key, value):
+        now = time.time()
+        conn = db()
+        conn.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, created, last_used) VALUES (?, ?, ?, ?)',
+                     (key, json.dumps(value), now, now))
+        conn.execute(f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} '
+                     f'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def __len__(self):
+        return db().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+
+class PostgresCache:
+    """Cache stored in Postgres (DATABASE_URL), shared across hosts."""
+
+    def __init__(self, dsn, max_entries=50000, ttl=30 * 24 * 3600, table='result_cache'):
+        from psycopg2.pool import ThreadedConnectionPool
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.table = table
+        self._pool = ThreadedConnectionPool(1, 4, dsn)
+        self._run(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                  f'created DOUBLE PRECISION NOT NULL, last_used DOUBLE PRECISION NOT NULL)')
+        self._run(f'CREATE INDEX IF NOT EXISTS idx_{table}_last_used ON {table} (last_used)')
+
+    @blocking
+    def _run(self, sql, params=(), fetch=False):
+        conn = self._pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchone() if fetch else None
+        finally:
+            self._pool.putconn(conn)
+
+    def get(self, key):
+        now = time.time()
+        row = self._run(f'SELECT value, created FROM {self.table} WHERE key = %s', (key,), fetch=True)
+        if row is None:
+            return None
+        if self.ttl and now - row[1] > self.ttl:
+            self._run(f'DELETE FROM {self.table} WHERE key = %s', (key,))
+            return None
+        self._run(f'UPDATE {self.table} SET last_used = %s WHERE key = %s', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        self._run(f'INSERT INTO {self.table} (key, value, created, last_used) VALUES (%s, %s, %s, %s) '
+                  f'ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, created = EXCLUDED.created, '
+                  f'last_used = EXCLUDED.last_used', (key, json.dumps(value), now, now))
+        self._run(f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} '
+                  f'ORDER BY last_used DESC OFFSET %s)', (self.max_entries,))
+
+    def __len__(self):
+        return self._run(f'SELECT COUNT(*) FROM {self.table}', fetch=True)[0]
+
+
+class ResultCache:
+    """Wraps a cache backend with hit/miss counters. Backend errors count as misses."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        error = False
+        try:
+            value = self.backend.get(key) if self.backend is not None else None
+        except Exception as e:
+            print(f"Cache error: {str(e)}")
+            error = True
+            value = None
+        with self._lock:
+            self.errors += error
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            print(f"Cache error: {str(e)}")
+            with self._lock:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            hits, misses, errors = self.hits, self.misses, self.errors
+        lookups = hits + misses
+        return {
+            'backend': type(self.backend).__name__ if self.backend is not None else None,
+            'entries': len(self.backend) if self.backend is not None else 0,
+            'hits': hits,
+            'misses': misses,
+            'errors': errors,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def make_cache_backend(kind, max_entries, ttl, table):
+    if kind == 'memory':
+        return LRUCache(max_entries=max_entries, ttl=ttl)
+    if kind == 'sqlite':
+        return SQLiteCache(max_entries=max_entries, ttl=ttl, table=table)
+    if kind == 'postgres':
+        return PostgresCache(os.environ['DATABASE_URL'], max_entries=max_entries, ttl=ttl, table=table)
+    return None  # 'none' disables caching
+
+
+# RESULT_CACHE_BACKEND: memory (default) | sqlite | postgres | none
+analysis_cache = ResultCache(make_cache_backend(
+    os.environ.get('RESULT_CACHE_BACKEND', 'memory'),
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 256)),
+    ttl=int(os.environ.get('RESULT_CACHE_TTL', 7 * 24 * 3600)),
+    table='result_cache'))
+STATS_PROVIDERS['analysis_cache'] = analysis_cache.stats
+
+
+@blocking
+def file_digest(file):
+    """SHA-256 of an upload's content; leaves the stream rewound.
+
+    Single images hash as their upright RGB pixels, so a page re-saved, re-compressed or stripped
+    of its metadata still hits the cache. Anything else (PDFs, multi-frame images, files Pillow
+    cannot decode) hashes as its bytes, read in chunks.
+    """
+    file.seek(0)
+    try:
+        with Image.open(file) as img:
+            if getattr(img, 'n_frames', 1) == 1:
+                ImageOps.exif_transpose(img, in_place=True)
+                img = img.convert('RGB')
+                h = hashlib.sha256(f'rgb|{img.width}x{img.height}|'.encode())
+                h.update(img.tobytes())
+                file.seek(0)
+                return h.hexdigest()
+    except Exception:
+        pass
+    file.seek(0)
+    h = hashlib.sha256()
+    for chunk in iter(lambda: file.read(1024 * 1024), b''):
+        h.update(chunk)
+    file.seek(0)
+    return h.hexdigest()
+
+
+def analysis_cache_key(digests):
+    # Order-independent key over the file set, plus model and prompt revision
+    h = hashlib.sha256(f'{ANALYZE_MODEL}|{ANALYZE_PROMPT_VERSION}'.encode())
+    for digest in sorted(digests):
+        h.update(digest.encode())
+    return h.hexdigest()
+
+
+def cached_analysis(cache_key, digests, files):
+    # Stored questions for this file set, with image_file renamed to the names used in this upload.
+    # Their analysis_id is dropped: its pages belong to whoever ran that analysis, so a cache hit
+    # gets text-only follow-ups and the viewer shows the local file.
+    cached = analysis_cache.get(cache_key)
+    if cached is None:
+        return None
+    names = {digest: file.filename for digest, file in zip(digests, files)}
+    renamed = {cached['files'][d]: names[d] for d in cached['files'] if d in names}
+    questions = []
+    for q in cached['questions']:
+        q = {key: value for key, value in q.items() if key != 'analysis_id'}
+        q['image_file'] = renamed.get(q.get('image_file'), q.get('image_file'))
+        questions.append(q)
+    print(f"⚡ Cache hit: {len(questions)} questions")
+    return questions
+
+
+def store_analysis(cache_key, digests, files, questions):
+    analysis_cache.set(cache_key, {
+        'questions': questions,
+        'files': {digest: file.filename for digest, file in zip(digests, files)},
+    })
+
+
+def dedupe_by_number(items):
+    seen = set()
+    unique = []
+    for item in items:
+        if item['number'] not in seen:
+            seen.add(item['number'])
+            unique.append(item)
+    return unique
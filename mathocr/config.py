@@ -0,0 +1,5 @@
+"""Model and prompt revision the analysis pipeline runs with; the caches key their entries on both."""
+
+# Bump ANALYZE_PROMPT_VERSION whenever the prompt in mathocr/analysis.py or the image pipeline changes
+ANALYZE_MODEL = 'gpt-5.1'
+ANALYZE_PROMPT_VERSION = '5'
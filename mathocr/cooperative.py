@@ -0,0 +1,50 @@
+"""Running blocking work off the event loop under gunicorn's gevent worker.
+
+Under gunicorn's gevent worker (GUNICORN_WORKER_CLASS=gevent, see gunicorn.conf.py) the standard
+library is monkey-patched before this module is imported and every request is a greenlet, so one
+process can hold hundreds of analyses that are only waiting on OpenAI. Code that blocks outside
+the patched sockets and locks - SQLite statements that may wait for the write lock, psycopg2,
+Pillow, ReportLab - would stall every greenlet in the process, so it is marked @blocking (or called
+through offload()) and runs on gevent's pool of native threads. Without gevent both are no-ops.
+"""
+import os
+import threading
+import functools
+
+OFFLOAD_THREADS = int(os.environ.get('OFFLOAD_THREADS', 16))
+
+try:
+    from gevent import monkey as _gevent_monkey
+    COOPERATIVE = _gevent_monkey.is_module_patched('threading')
+except ImportError:
+    COOPERATIVE = False
+
+# threading.local is per greenlet once patched; this one stays per native thread
+native_local = _gevent_monkey.get_original('threading', 'local') if COOPERATIVE else threading.local
+_offload_pool = None
+_offload_pid = None
+
+
+def offload(fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs), on a native thread when running under gevent."""
+    global _offload_pool, _offload_pid
+    if not COOPERATIVE:
+        return fn(*args, **kwargs)
+    if _offload_pid != os.getpid():
+        import gevent
+        _offload_pool = gevent.get_hub().threadpool
+        _offload_pool.maxsize = max(_offload_pool.maxsize, OFFLOAD_THREADS)
+        _offload_pid = os.getpid()
+    # Nested calls from a pool thread run in place
+    return _offload_pool.apply(fn, args, kwargs)
+
+
+def blocking(fn):
+    """Marks a function that blocks without yielding; under gevent it is always offloaded."""
+    if not COOPERATIVE:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return offload(fn, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,185 @@
+"""Analyzed pages and question boxes, kept so follow-ups can attach a crop of the working.
+
+Every page sent to the model is kept for ANALYSIS_PAGE_TTL under the analysis id of the request,
+together with the box the model gave around each question's working (error_bbox). A follow-up on
+/reanalyze then attaches only that region, downscaled to a low-detail image (a flat 85 tokens), so
+the model can read the handwriting again without whole pages being resent at high detail. Pages are
+stored with the user who ran the analysis and are only returned to that user.
+"""
+import os
+import io
+import re
+import time
+from PIL import Image, ImageOps
+import threading
+
+from mathocr.admission import IMAGE_TOKEN_ESTIMATE, LOW_DETAIL_TOKEN_ESTIMATE
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.images import IMAGE_JPEG_QUALITY
+from mathocr.stats import STATS_PROVIDERS
+
+ANALYSIS_PAGE_TTL = int(os.environ.get('ANALYSIS_PAGE_TTL', 7 * 24 * 3600))
+REANALYZE_CROPS = os.environ.get('REANALYZE_CROPS', '1') == '1'
+ANALYSIS_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+CROP_PADDING = 0.03  # fraction of the page kept around a question's box
+CROP_MIN_SIZE = 0.12  # boxes smaller than this fraction of the page are widened around their centre
+CROP_MAX_SIDE = 512  # low detail: the API scales the image to fit 512x512 anyway
+PAGE_STORE_MAX_SIDE = 2048
+PAGE_SWEEP_INTERVAL = 3600
+
+
+class AnalysisPages:
+    """Pages and per-question boxes of recent analyses, for cropping follow-ups."""
+
+    def __init__(self):
+        self.pages_stored = 0
+        self.regions_stored = 0
+        self.crops = 0
+        self.crop_misses = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS analysis_pages (analysis_id TEXT NOT NULL, name TEXT NOT NULL, '
+                     'width INTEGER NOT NULL, height INTEGER NOT NULL, data BLOB NOT NULL, created REAL NOT NULL, '
+                     'user TEXT, PRIMARY KEY (analysis_id, name))')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_analysis_pages_created ON analysis_pages (created)')
+        conn.execute('CREATE TABLE IF NOT EXISTS analysis_regions (analysis_id TEXT NOT NULL, number TEXT NOT NULL, '
+                     'image_file TEXT NOT NULL, x REAL, y REAL, width REAL, height REAL, created REAL NOT NULL, '
+                     'PRIMARY KEY (analysis_id, number))')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_analysis_regions_created ON analysis_regions (created)')
+        self._schema_ready = True
+
+    @blocking
+    def save_page(self, analysis_id, name, data, user):
+        """Keeps user's page exactly as the model saw it (encoded bytes or a file, whose position is restored)."""
+        position = None if isinstance(data, bytes) else data.tell()
+        try:
+            with Image.open(io.BytesIO(data) if position is None else data) as img:
+                width, height = img.size
+                if position is None and img.format == 'JPEG' and max(img.size) <= PAGE_STORE_MAX_SIDE:
+                    stored = data
+                else:
+                    # A page sent as uploaded: keep a bounded copy, the boxes are scaled to it when cropping
+                    img.draft('L', (PAGE_STORE_MAX_SIDE, PAGE_STORE_MAX_SIDE))
+                    img = ImageOps.exif_transpose(img).convert('L')
+                    img.thumbnail((PAGE_STORE_MAX_SIDE, PAGE_STORE_MAX_SIDE))
+                    out = io.BytesIO()
+                    img.save(out, 'JPEG', quality=IMAGE_JPEG_QUALITY)
+                    stored = out.getvalue()
+            self._init_schema()
+            now = time.time()
+            db().execute('INSERT OR REPLACE INTO analysis_pages (analysis_id, name, width, height, data, created, '
+                         'user) VALUES (?, ?, ?, ?, ?, ?, ?)', (analysis_id, name, width, height, stored, now, user))
+            with self._lock:
+                self.pages_stored += 1
+            self._maybe_sweep(now)
+        except Exception as e:
+            print(f"⚠️ Could not keep page {name} for follow-ups: {str(e)}")
+        finally:
+            if position is not None:
+                data.seek(position)
+
+    @blocking
+    def remember(self, analysis_id, questions):
+        """Tags the questions with analysis_id and stores the box of each one."""
+        rows = []
+        for q in questions:
+            q['analysis_id'] = analysis_id
+            box = q.get('error_bbox')
+            try:
+                box = [float(box[k]) for k in ('x', 'y', 'width', 'height')] if isinstance(box, dict) else None
+            except (KeyError, TypeError, ValueError):
+                box = None
+            if box is not None and (box[2] <= 0 or box[3] <= 0):
+                box = None
+            rows.append((analysis_id, str(q.get('number')), str(q.get('image_file') or ''),
+                         *(box or (None,) * 4), time.time()))
+        if not rows:
+            return
+        try:
+            self._init_schema()
+            db().executemany('INSERT OR REPLACE INTO analysis_regions (analysis_id, number, image_file, x, y, '
+                             'width, height, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            with self._lock:
+                self.regions_stored += len(rows)
+        except Exception as e:
+            print(f"⚠️ Could not keep question boxes: {str(e)}")
+
+    def page(self, analysis_id, name, user):
+        """(jpeg_bytes, (width, height) the model saw) of one of user's stored pages, or None."""
+        if user is None or not ANALYSIS_ID_PATTERN.match(str(analysis_id or '')):
+            return None
+        self._init_schema()
+        rows = db().execute('SELECT name, data, width, height FROM analysis_pages WHERE analysis_id = ? AND user = ?',
+                            (analysis_id, user)).fetchall()
+        # The model sometimes names the image loosely; a single-page analysis has only one candidate
+        row = next((r for r in rows if r[0] == name), rows[0] if len(rows) == 1 else None)
+        return (row[1], (row[2], row[3])) if row else None
+
+    @blocking
+    def crop(self, analysis_id, number, user):
+        """Low-detail JPEG of the question's working on user's page, or None when it is not known."""
+        crop = None
+        if ANALYSIS_ID_PATTERN.match(str(analysis_id or '')):
+            self._init_schema()
+            region = db().execute('SELECT image_file, x, y, width, height FROM analysis_regions '
+                                  'WHERE analysis_id = ? AND number = ?', (analysis_id, str(number))).fetchone()
+            page = self.page(analysis_id, region[0], user) if region and region[1] is not None else None
+            if page is not None:
+                crop = _crop_region(page[0], page[1], region[1:])
+        with self._lock:
+            if crop is None:
+                self.crop_misses += 1
+            else:
+                self.crops += 1
+        return crop
+
+    def _maybe_sweep(self, now):
+        if now - self._last_sweep < PAGE_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        conn = db()
+        conn.execute('DELETE FROM analysis_pages WHERE created < ?', (now - ANALYSIS_PAGE_TTL,))
+        conn.execute('DELETE FROM analysis_regions WHERE created < ?', (now - ANALYSIS_PAGE_TTL,))
+
+    def stats(self):
+        return {
+            'pages_stored': self.pages_stored,
+            'boxes_stored': self.regions_stored,
+            'crops_attached': self.crops,
+            'crops_unavailable': self.crop_misses,
+            'image_tokens_saved_estimate': self.crops * (IMAGE_TOKEN_ESTIMATE - LOW_DETAIL_TOKEN_ESTIMATE),
+        }
+
+
+def _crop_region(data, seen_size, box):
+    # Boxes are fractions of the page; larger values are taken as pixels of the image the model saw
+    x, y, w, h = box
+    if max(x + w, y + h) > 1.5:
+        x, w = x / seen_size[0], w / seen_size[0]
+        y, h = y / seen_size[1], h / seen_size[1]
+    if w < CROP_MIN_SIZE:
+        x, w = x + w / 2 - CROP_MIN_SIZE / 2, CROP_MIN_SIZE
+    if h < CROP_MIN_SIZE:
+        y, h = y + h / 2 - CROP_MIN_SIZE / 2, CROP_MIN_SIZE
+    left, top = max(x - CROP_PADDING, 0.0), max(y - CROP_PADDING, 0.0)
+    right, bottom = min(x + w + CROP_PADDING, 1.0), min(y + h + CROP_PADDING, 1.0)
+    if right <= left or bottom <= top:
+        return None
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.crop((int(left * img.width), int(top * img.height),
+                        max(int(right * img.width), 1), max(int(bottom * img.height), 1)))
+        img.thumbnail((CROP_MAX_SIDE, CROP_MAX_SIDE))
+        out = io.BytesIO()
+        img.save(out, 'JPEG', quality=IMAGE_JPEG_QUALITY)
+    return out.getvalue()
+
+
+analysis_pages = AnalysisPages()
+STATS_PROVIDERS['question_crops'] = analysis_pages.stats
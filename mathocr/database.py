@@ -0,0 +1,31 @@
+"""The local SQLite database shared by the caches, stores and queues of every worker on the host.
+
+Under gevent the greenlets of the event loop share that thread's connection; that is safe because
+every explicit transaction and every write that can wait for the lock runs in a @blocking function.
+"""
+import os
+import sqlite3
+
+from mathocr.cooperative import blocking, native_local
+
+DB_PATH = os.environ.get('MATH_OCR_DB', '/tmp/math_ocr.db')
+
+_db_local = native_local()
+
+def db():
+    # One SQLite connection per thread (and per process, so forked gunicorn workers never share one)
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or _db_local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+
+@blocking
+def db_write(sql, params=(), many=False):
+    """Runs one write statement (once per row of params if many) in autocommit mode; returns rows changed."""
+    conn = db()
+    return (conn.executemany(sql, params) if many else conn.execute(sql, params)).rowcount
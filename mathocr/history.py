@@ -0,0 +1,104 @@
+"""Past analyses of each logged-in user, for the sidebar.
+
+Every finished analysis of a logged-in user is saved under session['user'], so reopening it from
+the sidebar is one indexed SQLite read instead of another model call. The questions are stored as
+zlib-compressed JSON; the listing reads only the small summary columns. The newest
+ANALYSIS_HISTORY_PER_USER entries are kept per user.
+"""
+import os
+import re
+import json
+import time
+import threading
+import zlib
+import uuid
+
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.stats import STATS_PROVIDERS
+
+ANALYSIS_HISTORY_PER_USER = int(os.environ.get('ANALYSIS_HISTORY_PER_USER', 200))
+HISTORY_PAGE_SIZE = 50
+HISTORY_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class AnalysisHistory:
+    def __init__(self):
+        self.saved = 0
+        self.reads = 0
+        self.bytes_raw = 0
+        self.bytes_stored = 0
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS analysis_history (id TEXT PRIMARY KEY, user TEXT NOT NULL, '
+                     'title TEXT NOT NULL, files TEXT NOT NULL, correct INTEGER NOT NULL, partial INTEGER NOT NULL, '
+                     'incorrect INTEGER NOT NULL, questions BLOB NOT NULL, created REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_analysis_history_user_created ON analysis_history (user, created)')
+        self._schema_ready = True
+
+    @blocking
+    def add(self, user, file_names, questions):
+        """Saves an analysis for user; returns its history id, or None when there is nothing to keep."""
+        if user is None or not questions:
+            return None
+        raw = json.dumps(questions).encode()
+        packed = zlib.compress(raw, 6)
+        counts = [sum(q.get('status') == status for q in questions) for status in ('correct', 'partial', 'incorrect')]
+        title = file_names[0] if len(file_names) == 1 else f'{file_names[0]} +{len(file_names) - 1} more'
+        history_id = uuid.uuid4().hex
+        try:
+            self._init_schema()
+            conn = db()
+            conn.execute('INSERT INTO analysis_history (id, user, title, files, correct, partial, incorrect, '
+                         'questions, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (history_id, user, title, json.dumps(file_names), *counts, packed, time.time()))
+            conn.execute('DELETE FROM analysis_history WHERE user = ? AND id NOT IN (SELECT id FROM analysis_history '
+                         'WHERE user = ? ORDER BY created DESC LIMIT ?)', (user, user, ANALYSIS_HISTORY_PER_USER))
+        except Exception as e:
+            print(f"⚠️ Could not save analysis history: {str(e)}")
+            return None
+        with self._lock:
+            self.saved += 1
+            self.bytes_raw += len(raw)
+            self.bytes_stored += len(packed)
+        return history_id
+
+    def list(self, user, before=None, limit=HISTORY_PAGE_SIZE):
+        """The user's analyses newest first, without their questions; pass the last 'created' as before to page."""
+        self._init_schema()
+        rows = db().execute('SELECT id, title, files, correct, partial, incorrect, created FROM analysis_history '
+                            'WHERE user = ? AND created < ? ORDER BY created DESC LIMIT ?',
+                            (user, before if before is not None else float('inf'), limit)).fetchall()
+        return [{'id': row[0], 'title': row[1], 'files': json.loads(row[2]),
+                 'counts': {'correct': row[3], 'partial': row[4], 'incorrect': row[5]}, 'created': row[6]}
+                for row in rows]
+
+    def get(self, user, history_id):
+        """One of the user's analyses with its questions, or None."""
+        if not HISTORY_ID_PATTERN.match(history_id or ''):
+            return None
+        self._init_schema()
+        row = db().execute('SELECT title, files, questions, created FROM analysis_history WHERE id = ? AND user = ?',
+                           (history_id, user)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self.reads += 1
+        return {'id': history_id, 'title': row[0], 'files': json.loads(row[1]),
+                'questions': json.loads(zlib.decompress(row[2])), 'created': row[3]}
+
+    def stats(self):
+        return {
+            'saved': self.saved,
+            'reopened': self.reads,
+            'compression_ratio': round(self.bytes_raw / self.bytes_stored, 2) if self.bytes_stored else None,
+        }
+
+
+analysis_history = AnalysisHistory()
+STATS_PROVIDERS['history'] = analysis_history.stats
@@ -0,0 +1,118 @@
+"""Preprocessing of uploaded images before they are sent upstream.
+
+Images are normalised before upload: EXIF rotation applied, paper margins cropped, converted to
+grayscale and downscaled to what the model actually looks at with detail "high" (fit inside
+2048x2048, then shortest side at most 768), then re-encoded as JPEG.
+"""
+import os
+import io
+from PIL import Image, ImageOps
+import threading
+
+from mathocr.cooperative import blocking
+from mathocr.stats import STATS_PROVIDERS
+from mathocr.uploads import source_size
+
+IMAGE_PREPROCESS = os.environ.get('IMAGE_PREPROCESS', '1') == '1'
+IMAGE_MAX_SIDE = int(os.environ.get('IMAGE_MAX_SIDE', 2048))
+IMAGE_MAX_SHORT_SIDE = int(os.environ.get('IMAGE_MAX_SHORT_SIDE', 768))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+IMAGE_CROP_THRESHOLD = 48  # ink darkness (0-255, after autocontrast) that counts as content when cropping
+IMAGE_CROP_PADDING = 0.02  # padding kept around the cropped content, as a fraction of the page size
+
+
+class ImageStats:
+    def __init__(self):
+        self.images = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def record(self, bytes_in, bytes_out, failed=False):
+        with self._lock:
+            self.images += 1
+            self.failures += failed
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        return {
+            'images': self.images,
+            'failures': self.failures,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'bytes_saved': self.bytes_in - self.bytes_out,
+        }
+
+
+image_stats = ImageStats()
+STATS_PROVIDERS['images'] = image_stats.stats
+
+
+def _crop_margins(img):
+    # Bounding box of anything darker than the paper, padded a little
+    ink = ImageOps.invert(ImageOps.autocontrast(img)).point(lambda p: 255 if p > IMAGE_CROP_THRESHOLD else 0)
+    bbox = ink.getbbox()
+    if not bbox:
+        return img
+    pad_x, pad_y = int(img.width * IMAGE_CROP_PADDING), int(img.height * IMAGE_CROP_PADDING)
+    return img.crop((max(bbox[0] - pad_x, 0), max(bbox[1] - pad_y, 0),
+                     min(bbox[2] + pad_x, img.width), min(bbox[3] + pad_y, img.height)))
+
+
+def _downscale(img):
+    scale = min(1.0, IMAGE_MAX_SIDE / max(img.size), IMAGE_MAX_SHORT_SIDE / min(img.size))
+    if scale < 1.0:
+        img = img.resize((max(int(img.width * scale), 1), max(int(img.height * scale), 1)), Image.LANCZOS)
+    return img
+
+
+def preprocess_image(source):
+    """Returns (mime_type, jpeg_bytes) for image bytes or a binary file. Raises if Pillow cannot decode them."""
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        # JPEG only: let the decoder downscale by a power of two, keeping headroom for the margin crop
+        draft_side = IMAGE_MAX_SHORT_SIDE * 3 // 2
+        img.draft('L', (draft_side, draft_side))
+        ImageOps.exif_transpose(img, in_place=True)  # no copy of the full-size decode when upright
+        img = img.convert('L')
+        # Other formats decode at full size: shrink as far before cropping, so the crop's copies are small
+        factor = min(img.size) // draft_side
+        if factor >= 2:
+            img = img.reduce(factor)
+        return 'image/jpeg', encode_page(img)
+
+
+def encode_page(img):
+    # Grayscale page image -> cropped, downscaled JPEG bytes
+    img = _downscale(_crop_margins(img))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+@blocking
+def prepare_image(file):
+    # Returns (mime_type, source, original_size) ready to be base64 encoded for the vision model; the
+    # source is the re-encoded JPEG bytes, or the upload's own stream (rewound) when it is sent as-is
+    file.seek(0)
+    size = source_size(file.stream)
+    mime = file.mimetype or 'image/jpeg'
+    if not IMAGE_PREPROCESS:
+        image_stats.record(size, size)
+        return mime, file.stream, size
+    try:
+        out_mime, out = preprocess_image(file.stream)
+    except Exception as e:
+        # Unsupported or corrupt image: send it untouched under its real type
+        print(f"Image preprocessing failed for {file.filename}: {str(e)}")
+        image_stats.record(size, size, failed=True)
+        file.seek(0)
+        return mime, file.stream, size
+    if len(out) >= size:
+        # Already small (e.g. a compressed scan) - re-encoding would only add bytes
+        image_stats.record(size, size)
+        file.seek(0)
+        return mime, file.stream, size
+    image_stats.record(size, len(out))
+    return out_mime, out, size
@@ -0,0 +1,194 @@
+"""A persistent background job queue, shared by the gunicorn workers on the host.
+
+Analyses submitted to /jobs/analyze are persisted in the local SQLite database and executed by a
+small pool of worker threads in every app process, so a slow upstream call no longer pins a
+request worker. Claiming a job is a single write transaction, which makes the queue safe to share
+between gunicorn workers; a job whose worker died (stale heartbeat) is requeued on the next poll.
+Job kinds are registered with @job_queue.handler(kind).
+"""
+import os
+import json
+import time
+import threading
+import shutil
+import uuid
+
+from mathocr.admission import ADMISSION_JOB_MAX_WAIT, upstream_context
+from mathocr.cooperative import blocking
+from mathocr.database import db, db_write
+from mathocr.stats import STATS_PROVIDERS
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_DIR = os.environ.get('JOB_DIR', '/tmp/math_ocr_jobs')
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_STALE_AFTER = 120  # seconds without a heartbeat before a running job is considered orphaned
+JOB_HEARTBEAT = 15
+JOB_RETENTION = 24 * 3600
+
+
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self.handlers = {}
+        self.completed = 0
+        self.failed = 0
+        self._wake = threading.Event()
+        self._started_pid = None
+        self._lock = threading.Lock()
+        self._last_maintenance = 0.0
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, user TEXT, kind TEXT NOT NULL, '
+                     'status TEXT NOT NULL, payload TEXT NOT NULL, result TEXT, error TEXT, attempts INTEGER DEFAULT 0, '
+                     'created REAL NOT NULL, started REAL, finished REAL, heartbeat REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created)')
+        self._schema_ready = True
+
+    def handler(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def start(self):
+        # Lazily start this process's workers (after fork, never in a preloading master)
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._init_schema()
+            for i in range(self.workers):
+                threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def submit(self, kind, payload, user=None, job_id=None, result=None):
+        self._init_schema()
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        status = 'queued' if result is None else 'done'
+        db_write('INSERT INTO jobs (id, user, kind, status, payload, result, created, started, finished) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (job_id, user, kind, status, json.dumps(payload),
+                  None if result is None else json.dumps(result), now,
+                  None if result is None else now, None if result is None else now))
+        self.start()
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id):
+        self._init_schema()
+        row = db().execute('SELECT id, user, kind, status, result, error, attempts, created, started, finished '
+                           'FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'user', 'kind', 'status', 'result', 'error', 'attempts', 'created', 'started', 'finished')
+        job = dict(zip(keys, row))
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    @blocking
+    def _claim(self):
+        conn = db()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT id, kind, payload, user FROM jobs WHERE status = 'queued' "
+                               "ORDER BY created LIMIT 1").fetchone()
+            if row:
+                conn.execute("UPDATE jobs SET status = 'running', started = ?, heartbeat = ?, "
+                             "attempts = attempts + 1 WHERE id = ?", (now, now, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row
+
+    def _maintenance(self):
+        now = time.time()
+        if now - self._last_maintenance < JOB_HEARTBEAT:
+            return
+        self._last_maintenance = now
+        self._requeue_stale(now)
+
+    @blocking
+    def _requeue_stale(self, now):
+        conn = db()
+        stale = now - JOB_STALE_AFTER
+        conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND heartbeat < ? "
+                     "AND attempts < ?", (stale, JOB_MAX_ATTEMPTS))
+        conn.execute("UPDATE jobs SET status = 'failed', error = 'Worker lost too many times', finished = ? "
+                     "WHERE status = 'running' AND heartbeat < ?", (now, stale))
+        for (job_id,) in conn.execute('SELECT id FROM jobs WHERE finished < ?', (now - JOB_RETENTION,)).fetchall():
+            shutil.rmtree(os.path.join(JOB_DIR, job_id), ignore_errors=True)
+        conn.execute('DELETE FROM jobs WHERE finished < ?', (now - JOB_RETENTION,))
+
+    def _worker(self):
+        while True:
+            try:
+                self._maintenance()
+                job = self._claim()
+            except Exception as e:
+                print(f"Job queue error: {str(e)}")
+                job = None
+            if job is None:
+                self._wake.wait(timeout=1.0)
+                self._wake.clear()
+                continue
+            self._run(*job)
+
+    def _run(self, job_id, kind, payload, user):
+        done = threading.Event()
+
+        def heartbeat():
+            while not done.wait(JOB_HEARTBEAT):
+                db_write('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time(), job_id))
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        # Upstream calls made by the job queue behind the submitting user, and may wait longer
+        upstream_context.user, upstream_context.max_wait = user, ADMISSION_JOB_MAX_WAIT
+        try:
+            result = self.handlers[kind](job_id, json.loads(payload))
+            error = result.get('error') if isinstance(result, dict) else None
+        except Exception as e:
+            print(f"Job {job_id} failed: {str(e)}")
+            result, error = None, str(e)
+        finally:
+            done.set()
+            upstream_context.user = upstream_context.max_wait = None
+        status = 'failed' if error else 'done'
+        db_write('UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? WHERE id = ?',
+                 (status, None if result is None else json.dumps(result), error, time.time(), job_id))
+        with self._lock:
+            if error:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def stats(self):
+        self._init_schema()
+        conn = db()
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        oldest = conn.execute("SELECT MIN(created) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        waits = conn.execute('SELECT AVG(started - created), MAX(started - created) FROM jobs '
+                             'WHERE started IS NOT NULL AND started > ?', (time.time() - 3600,)).fetchone()
+        return {
+            'queue_depth': counts.get('queued', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_queued_seconds': round(time.time() - oldest, 1) if oldest else 0.0,
+            'avg_wait_seconds_1h': round(waits[0] or 0.0, 2),
+            'max_wait_seconds_1h': round(waits[1] or 0.0, 2),
+            'workers_per_process': self.workers,
+            'completed_here': self.completed,
+            'failed_here': self.failed,
+        }
+
+
+job_queue = JobQueue()
+STATS_PROVIDERS['jobs'] = job_queue.stats
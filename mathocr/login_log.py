@@ -0,0 +1,180 @@
+"""Logins, in an append-only indexed SQLite table.
+
+One writer thread per process (a greenlet under gevent, whose inserts are offloaded) drains a queue
+and writes in batches. The legacy JSON file (LOG_FILE) is imported once and renamed.
+"""
+import os
+import json
+import hashlib
+import sqlite3
+import time
+from datetime import datetime
+import threading
+import queue
+import atexit
+
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.stats import STATS_PROVIDERS
+
+# Legacy JSON login log - imported into the login table on first start
+LOG_FILE = os.environ.get('LOGIN_LOG_FILE', '/tmp/login_logs.json')
+LOGIN_BATCH_SIZE = 500
+
+
+class LoginLog:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._started_pid = None
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def start(self):
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            conn = db()
+            conn.execute('CREATE TABLE IF NOT EXISTS logins (id INTEGER PRIMARY KEY, username TEXT NOT NULL, '
+                         'timestamp TEXT NOT NULL, ip TEXT, user_agent TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_logins_username ON logins (username, timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_logins_timestamp ON logins (timestamp)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_logins_ip ON logins (ip, timestamp)')
+            conn.execute('CREATE TABLE IF NOT EXISTS login_migrations (digest TEXT PRIMARY KEY, rows INTEGER NOT NULL, '
+                         'migrated TEXT NOT NULL)')
+            try:
+                self._migrate_json()
+            except Exception as e:
+                # Logins keep working; a file left as .migrating is picked up again on the next start
+                print(f"Login log migration error: {str(e)}")
+            threading.Thread(target=self._writer, name='login-writer', daemon=True).start()
+            self._started_pid = os.getpid()
+
+    def _migrate_json(self):
+        # Renaming first means normally only one process imports the file, even with several workers
+        # starting. A .migrating file already there was left by a process that died mid-import (or is
+        # being imported right now): it is imported again, and the file's digest, recorded in the same
+        # transaction as its rows, makes sure its logins land only once.
+        migrating = LOG_FILE + '.migrating'
+        try:
+            os.rename(LOG_FILE, migrating)
+        except FileNotFoundError:
+            if not os.path.exists(migrating):
+                return
+            print(f"📦 Resuming the interrupted import of {migrating}")
+        try:
+            with open(migrating, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return  # another process finished it
+        logins, damaged = _parse_legacy_logins(raw)
+        rows = [(str(login.get('username', '')), str(login.get('timestamp', '')), login.get('ip'),
+                 login.get('user_agent')) for login in logins]
+        if rows:
+            try:
+                self._insert(rows, migration=hashlib.sha256(raw).hexdigest())
+            except sqlite3.IntegrityError:
+                rows = []  # imported before the process that renamed it died
+        # A damaged file is kept as .corrupt for inspection; whatever could be read was imported
+        done = LOG_FILE + ('.corrupt' if damaged else '.migrated')
+        if damaged and os.path.exists(done):
+            done += f'.{int(time.time())}'
+        try:
+            os.replace(migrating, done)
+        except FileNotFoundError:
+            pass
+        if damaged:
+            print(f"⚠️ {LOG_FILE} was damaged: salvaged {len(rows)} logins, original kept as {done}")
+        else:
+            print(f"📦 Migrated {len(rows)} logins from {LOG_FILE}")
+
+    @blocking
+    def _insert(self, rows, migration=None):
+        conn = db()
+        conn.execute('BEGIN')
+        try:
+            if migration is not None:
+                conn.execute('INSERT INTO login_migrations (digest, rows, migrated) VALUES (?, ?, ?)',
+                             (migration, len(rows), datetime.utcnow().isoformat()))
+            conn.executemany('INSERT INTO logins (username, timestamp, ip, user_agent) VALUES (?, ?, ?, ?)', rows)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def record(self, username, timestamp, ip, user_agent):
+        self.start()
+        self._queue.put((username, timestamp, ip, user_agent))
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < LOGIN_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._insert(batch)
+                self.written += len(batch)
+            except Exception as e:
+                print(f"Login log error: {str(e)}")
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+
+    def stats(self):
+        return {'pending': self._queue.qsize(), 'written_here': self.written}
+
+
+def _parse_legacy_logins(raw):
+    """(login dicts, damaged) from the legacy JSON log; a corrupt or truncated file yields every whole entry."""
+    try:
+        logins = json.loads(raw)
+        if isinstance(logins, list):
+            return [login for login in logins if isinstance(login, dict)], False
+    except ValueError:
+        pass
+    # Entry by entry: decode each complete object in the array and stop at the first broken one
+    text = raw.decode('utf-8', errors='replace')
+    decoder = json.JSONDecoder()
+    logins, pos = [], text.find('[') + 1
+    while 0 < pos < len(text):
+        while pos < len(text) and text[pos] in ' \t\r\n,':
+            pos += 1
+        try:
+            entry, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            break
+        if isinstance(entry, dict):
+            logins.append(entry)
+    return logins, True
+
+
+def login_filter_sql(args):
+    """WHERE clause and params for the username-prefix / date-range / IP filters in a query string."""
+    clauses, params = [], []
+    username = args.get('username', '').strip()
+    if username:
+        # Prefix match written as a range so it can use idx_logins_username
+        clauses.append('username >= ? AND username < ?')
+        params += [username, username + '\uffff']
+    if args.get('from'):
+        clauses.append('timestamp >= ?')
+        params.append(args['from'])
+    if args.get('to'):
+        # A bare date includes the whole day
+        clauses.append('timestamp <= ?')
+        params.append(args['to'] + 'T99' if len(args['to']) == 10 else args['to'])
+    if args.get('ip'):
+        clauses.append('ip = ?')
+        params.append(args['ip'].strip())
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+login_log = LoginLog()
+STATS_PROVIDERS['login_log'] = login_log.stats
+atexit.register(login_log.flush)
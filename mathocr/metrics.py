@@ -0,0 +1,217 @@
+"""Token, cost and latency accounting for every OpenAI call and every route.
+
+Records only touch in-memory deltas under one lock; every METRICS_FLUSH_INTERVAL seconds a worker
+adds its deltas to the shared SQLite totals, so /metrics shows host-wide counters whichever gunicorn
+worker answers the scrape. Users are not a Prometheus label (unbounded cardinality); per-user spend
+goes to the usage_daily rollup served by /metrics/costs.
+"""
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime
+import threading
+import atexit
+
+from mathocr.config import ANALYZE_MODEL
+from mathocr.cooperative import blocking
+from mathocr.database import db
+
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+# USD per 1M tokens (input, output)
+MODEL_PRICES = {'gpt-5.1': (float(os.environ.get('PRICE_INPUT_PER_1M', 1.25)),
+                            float(os.environ.get('PRICE_OUTPUT_PER_1M', 10.0)))}
+
+# name -> (type, help) for the /metrics exposition
+METRICS = {
+    'openai_requests_total': ('counter', 'OpenAI calls by route, model and outcome'),
+    'openai_request_duration_seconds': ('histogram', 'OpenAI call latency after admission, retries included'),
+    'openai_tokens_total': ('counter', 'Tokens billed by OpenAI'),
+    'openai_cost_usd_total': ('counter', 'Estimated OpenAI spend from MODEL_PRICES'),
+    'openai_image_bytes_total': ('counter', 'Image bytes sent upstream (before base64)'),
+    'model_parse_duration_seconds': ('histogram', 'Time spent parsing model replies'),
+    'http_request_duration_seconds': ('histogram', 'Route latency until the response headers'),
+}
+
+
+def usage_cost(model, prompt_tokens, completion_tokens):
+    price_in, price_out = MODEL_PRICES.get(model, MODEL_PRICES[ANALYZE_MODEL])
+    return (prompt_tokens * price_in + completion_tokens * price_out) / 1e6
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' '))
+                    for key, value in labels.items())
+
+
+def _metric_family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def _exposition_order(row):
+    # Families together, then each series' buckets in increasing le (+Inf last), then _count and _sum
+    name, labels = row[0], row[1]
+    match = re.search(r'(?:^|,)le="([^"]+)"$', labels)
+    if match is None:
+        return _metric_family(name), labels, name, 0.0
+    return _metric_family(name), labels[:match.start()], name, float(match.group(1))
+
+
+class UsageMeter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (metric, labels) -> delta since the last flush
+        self._daily = {}  # (day, user, route, model) -> [calls, prompt, completion, cost, image_bytes]
+        self._last_flush = time.monotonic()
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS metric_values (name TEXT NOT NULL, labels TEXT NOT NULL, '
+                     'value REAL NOT NULL, PRIMARY KEY (name, labels))')
+        conn.execute('CREATE TABLE IF NOT EXISTS usage_daily (day TEXT NOT NULL, user TEXT NOT NULL, '
+                     'route TEXT NOT NULL, model TEXT NOT NULL, calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, '
+                     'completion_tokens INTEGER NOT NULL, cost_usd REAL NOT NULL, image_bytes INTEGER NOT NULL, '
+                     'PRIMARY KEY (day, user, route, model))')
+        self._schema_ready = True
+
+    def _add(self, name, labels, value=1):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def _observe(self, name, labels, seconds):
+        prefix = labels + ',' if labels else ''
+        for bound in LATENCY_BUCKETS:
+            # Empty buckets are written as 0 too: a series missing its lower buckets skews histogram_quantile()
+            self._add(name + '_bucket', f'{prefix}le="{bound}"', int(seconds <= bound))
+        self._add(name + '_bucket', f'{prefix}le="+Inf"')
+        self._add(name + '_sum', labels, seconds)
+        self._add(name + '_count', labels)
+
+    def _rollup(self, user, route, model):
+        key = (datetime.utcnow().strftime('%Y-%m-%d'), user or 'anonymous', route, model)
+        row = self._daily.get(key)
+        if row is None:
+            row = self._daily[key] = [0, 0, 0, 0.0, 0]
+        return row
+
+    def record_call(self, route, model, user, outcome, seconds, image_bytes=0):
+        labels = _labels(route=route, model=model)
+        with self._lock:
+            self._add('openai_requests_total', _labels(route=route, model=model, outcome=outcome))
+            self._observe('openai_request_duration_seconds', labels, seconds)
+            if image_bytes:
+                self._add('openai_image_bytes_total', labels, image_bytes)
+            row = self._rollup(user, route, model)
+            row[0] += 1
+            row[4] += image_bytes
+        self._maybe_flush()
+
+    def record_usage(self, route, model, user, usage):
+        if usage is None:
+            return
+        prompt, completion = usage.prompt_tokens or 0, usage.completion_tokens or 0
+        cost = usage_cost(model, prompt, completion)
+        with self._lock:
+            self._add('openai_tokens_total', _labels(route=route, model=model, kind='prompt'), prompt)
+            self._add('openai_tokens_total', _labels(route=route, model=model, kind='completion'), completion)
+            self._add('openai_cost_usd_total', _labels(route=route, model=model), cost)
+            row = self._rollup(user, route, model)
+            row[1] += prompt
+            row[2] += completion
+            row[3] += cost
+
+    def record_parse(self, route, seconds):
+        with self._lock:
+            self._observe('model_parse_duration_seconds', _labels(route=route), seconds)
+
+    def record_request(self, endpoint, method, status, seconds):
+        with self._lock:
+            self._observe('http_request_duration_seconds',
+                          _labels(endpoint=endpoint, method=method, status=status), seconds)
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            values, self._values = self._values, {}
+            daily, self._daily = self._daily, {}
+            self._last_flush = time.monotonic()
+        if not values and not daily:
+            return
+        self._init_schema()
+        self._write(values, daily)
+
+    @blocking
+    def _write(self, values, daily):
+        conn = db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT INTO metric_values (name, labels, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value',
+                             [(name, labels, value) for (name, labels), value in values.items()])
+            conn.executemany('INSERT INTO usage_daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (day, user, route, model) DO UPDATE SET calls = calls + excluded.calls, '
+                             'prompt_tokens = prompt_tokens + excluded.prompt_tokens, '
+                             'completion_tokens = completion_tokens + excluded.completion_tokens, '
+                             'cost_usd = cost_usd + excluded.cost_usd, image_bytes = image_bytes + excluded.image_bytes',
+                             [key + tuple(row) for key, row in daily.items()])
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            conn.execute('ROLLBACK')
+            print(f"⚠️ Could not flush metrics: {str(e)}")
+
+    def exposition(self):
+        """The shared totals in the Prometheus text format."""
+        self.flush()
+        self._init_schema()
+        rows = db().execute('SELECT name, labels, value FROM metric_values').fetchall()
+        lines, family = [], None
+        for name, labels, value in sorted(rows, key=_exposition_order):
+            base = _metric_family(name)
+            if base != family:
+                family = base
+                kind, help_text = METRICS.get(base, ('untyped', ''))
+                lines.append(f'# HELP {base} {help_text}')
+                lines.append(f'# TYPE {base} {kind}')
+            # repr() keeps every digit; {:g} would round large counters to 6 significant digits
+            value = repr(float(value))
+            lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def daily_costs(self, day_from, day_to):
+        """Per-user spend between two YYYY-MM-DD days (inclusive), most expensive first."""
+        self.flush()
+        self._init_schema()
+        rows = db().execute('SELECT day, user, route, calls, prompt_tokens, completion_tokens, cost_usd, image_bytes '
+                            'FROM usage_daily WHERE day BETWEEN ? AND ?', (day_from, day_to)).fetchall()
+        users = {}
+        for day, user, route, calls, prompt, completion, cost, image_bytes in rows:
+            entry = users.setdefault((day, user), {'day': day, 'user': user, 'calls': 0, 'prompt_tokens': 0,
+                                                   'completion_tokens': 0, 'cost_usd': 0.0, 'image_bytes': 0,
+                                                   'routes': {}})
+            entry['calls'] += calls
+            entry['prompt_tokens'] += prompt
+            entry['completion_tokens'] += completion
+            entry['cost_usd'] += cost
+            entry['image_bytes'] += image_bytes
+            entry['routes'][route] = entry['routes'].get(route, 0.0) + cost
+        result = sorted(users.values(), key=lambda entry: (entry['day'], -entry['cost_usd']))
+        for entry in result:
+            entry['cost_usd'] = round(entry['cost_usd'], 6)
+            entry['routes'] = {route: round(cost, 6) for route, cost in entry['routes'].items()}
+        return result
+
+
+usage_meter = UsageMeter()
+atexit.register(usage_meter.flush)
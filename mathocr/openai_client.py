@@ -0,0 +1,89 @@
+"""OpenAI clients shared by every route of a worker process, over one keep-alive connection pool."""
+import os
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+import threading
+
+from mathocr.stats import STATS_PROVIDERS
+
+
+class OpenAIClientRegistry:
+    """Process-wide OpenAI clients sharing one keep-alive connection pool.
+
+    Clients are created lazily on first use and keyed by process id, so a gunicorn
+    worker forked from a preloaded master never reuses the master's sockets.
+    """
+
+    def __init__(self):
+        self.max_connections = int(os.environ.get('OPENAI_POOL_MAX_CONNECTIONS', 20))
+        self.max_keepalive = int(os.environ.get('OPENAI_POOL_MAX_KEEPALIVE', 10))
+        self.keepalive_expiry = float(os.environ.get('OPENAI_POOL_KEEPALIVE_EXPIRY', 60))
+        self.timeout = float(os.environ.get('OPENAI_TIMEOUT', 180))
+        self.connect_timeout = float(os.environ.get('OPENAI_CONNECT_TIMEOUT', 10))
+        self._clients = {}
+        self._http_clients = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def get(self, api_key):
+        client = self._clients.get(api_key) if self._pid == os.getpid() else None
+        if client is None:
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Forked: drop the parent's clients without closing its sockets
+                    self._clients, self._http_clients = {}, []
+                    self._pid = os.getpid()
+                    self.requests = self.new_connections = 0
+                client = self._clients.get(api_key)
+                if client is None:
+                    http_client = DefaultHttpxClient(
+                        limits=httpx.Limits(max_connections=self.max_connections,
+                                            max_keepalive_connections=self.max_keepalive,
+                                            keepalive_expiry=self.keepalive_expiry),
+                        timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                        event_hooks={'request': [self._on_request]})
+                    # Retries are done by call_openai(), which also knows the route deadline
+                    client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+                    self._http_clients.append(http_client)
+                    self._clients[api_key] = client
+        return client
+
+    def _on_request(self, req):
+        with self._lock:
+            self.requests += 1
+        req.extensions['trace'] = self._trace
+
+    def _trace(self, event_name, info):
+        # httpcore only emits connect_tcp events when it has to open a new connection
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.new_connections += 1
+
+    def stats(self):
+        open_connections = idle_connections = 0
+        for http_client in self._http_clients:
+            pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+            for conn in getattr(pool, 'connections', []):
+                open_connections += 1
+                idle_connections += conn.is_idle()
+        return {
+            'pid': os.getpid(),
+            'clients': len(self._clients),
+            'max_connections': self.max_connections,
+            'max_keepalive': self.max_keepalive,
+            'open_connections': open_connections,
+            'idle_connections': idle_connections,
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reuse_ratio': round(1 - self.new_connections / self.requests, 3) if self.requests else 0.0,
+        }
+
+
+openai_clients = OpenAIClientRegistry()
+STATS_PROVIDERS['openai_pool'] = openai_clients.stats
+
+
+def get_openai_client(api_key):
+    return openai_clients.get(api_key)
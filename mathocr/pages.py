@@ -0,0 +1,228 @@
+"""Duplicate pages: exact-content dedupe within an upload, and reuse of pages analyzed before.
+
+Pages (an uploaded image or a rendered PDF page) are deduplicated on the SHA-256 of the bytes sent
+to the model, after preprocessing: a page identical to an earlier one in the same upload is dropped
+before the upstream call, and pages that were analyzed on their own (a single-page upload or a
+fan-out shard) are kept per user for PHASH_INDEX_TTL so a later upload of the same page reuses its
+questions. Two students' sheets for the same printed worksheet differ only in a little handwriting,
+which a perceptual hash cannot see, so similar-looking pages are never merged by default. With
+PHASH_NEAR_MATCH=1 a page within PHASH_MAX_DISTANCE bits of the difference hash of another is also
+treated as the same page, but only once a pixel comparison of the two confirms it.
+EXACT_PAGE_DEDUPE=0 turns page dedupe off altogether.
+"""
+import os
+import io
+import json
+import hashlib
+import time
+from PIL import Image, ImageChops
+import threading
+import zlib
+
+from mathocr.admission import IMAGE_TOKEN_ESTIMATE
+from mathocr.config import ANALYZE_MODEL, ANALYZE_PROMPT_VERSION
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.images import IMAGE_PREPROCESS
+from mathocr.stats import STATS_PROVIDERS
+
+EXACT_PAGE_DEDUPE = os.environ.get('EXACT_PAGE_DEDUPE', '1') == '1'
+PHASH_NEAR_MATCH = os.environ.get('PHASH_NEAR_MATCH', '0') == '1'
+PHASH_SIZE = 16  # 256-bit hashes
+PHASH_MAX_DISTANCE = int(os.environ.get('PHASH_MAX_DISTANCE', 12))
+PHASH_INDEX_PER_USER = int(os.environ.get('PHASH_INDEX_PER_USER', 200))
+PHASH_INDEX_TTL = int(os.environ.get('PHASH_INDEX_TTL', 7 * 24 * 3600))
+PIXEL_CHECK_SIDE = 768  # long side of the greyscale copy compared pixel by pixel
+PIXEL_CHECK_TOLERANCE = 48  # grey levels a pixel may move (JPEG noise) and still count as unchanged
+PIXEL_CHECK_MAX_CHANGED = 20  # changed pixels allowed; a single handwritten digit changes hundreds
+
+
+@blocking
+def page_digest(data):
+    """SHA-256 hex of encoded image bytes or of a file (whose position is restored)."""
+    if isinstance(data, bytes):
+        return hashlib.sha256(data).hexdigest()
+    position = data.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: data.read(1024 * 1024), b''):
+        digest.update(chunk)
+    data.seek(position)
+    return digest.hexdigest()
+
+
+@blocking
+def page_hash(data):
+    """Difference hash of encoded image bytes or file as an int, or None when it cannot be decoded."""
+    position = None if isinstance(data, bytes) else data.tell()
+    try:
+        img = Image.open(io.BytesIO(data) if position is None else data)
+        img.draft('L', (PHASH_SIZE * 8, PHASH_SIZE * 8))
+        img = img.convert('L').resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BILINEAR)
+    except Exception as e:
+        print(f"⚠️ Could not hash page: {str(e)}")
+        return None
+    finally:
+        if position is not None:
+            data.seek(position)
+    pixels = img.tobytes()
+    value = 0
+    for row in range(PHASH_SIZE):
+        offset = row * (PHASH_SIZE + 1)
+        for col in range(PHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+@blocking
+def page_pixels(data):
+    """(width, height, greyscale bytes) of the page at PIXEL_CHECK_SIDE, or None when it cannot be decoded."""
+    position = None if isinstance(data, bytes) else data.tell()
+    try:
+        with Image.open(io.BytesIO(data) if position is None else data) as img:
+            img.draft('L', (PIXEL_CHECK_SIDE, PIXEL_CHECK_SIDE))
+            img = img.convert('L')
+            img.thumbnail((PIXEL_CHECK_SIDE, PIXEL_CHECK_SIDE), Image.BILINEAR)
+            return img.width, img.height, img.tobytes()
+    except Exception as e:
+        print(f"⚠️ Could not read page pixels: {str(e)}")
+        return None
+    finally:
+        if position is not None:
+            data.seek(position)
+
+
+def _near(a, b):
+    return (a ^ b).bit_count() <= PHASH_MAX_DISTANCE
+
+
+def _same_pixels(a, b):
+    # Both pages at the same size, and almost no pixel moved by more than JPEG noise would move it
+    if a is None or b is None or a[:2] != b[:2]:
+        return False
+    left = Image.frombytes('L', a[:2], a[2])
+    right = Image.frombytes('L', b[:2], b[2])
+    changed = ImageChops.difference(left, right).point(lambda v: 255 if v > PIXEL_CHECK_TOLERANCE else 0)
+    return changed.histogram()[255] <= PIXEL_CHECK_MAX_CHANGED
+
+
+class PageIndex:
+    """Recent single-page analysis results per user, keyed by the page's SHA-256."""
+
+    def __init__(self):
+        self.stored = 0
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS page_index (id INTEGER PRIMARY KEY, user TEXT NOT NULL, '
+                     'digest TEXT NOT NULL, hash TEXT, pixels BLOB, version TEXT NOT NULL, questions TEXT NOT NULL, '
+                     'created REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_page_index_user_digest ON page_index (user, digest)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_page_index_user_created ON page_index (user, created)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_page_index_created ON page_index (created)')
+        self._schema_ready = True
+
+    def find(self, user, page):
+        """Questions of the user's earlier analysis of this page, or None."""
+        self._init_schema()
+        since = time.time() - PHASH_INDEX_TTL
+        row = db().execute('SELECT questions FROM page_index WHERE user = ? AND digest = ? AND version = ? '
+                           'AND created > ? ORDER BY created DESC LIMIT 1',
+                           (user, page['digest'], _page_version(), since)).fetchone()
+        if row is not None or not PHASH_NEAR_MATCH or page.get('hash') is None:
+            return row[0] if row else None
+        rows = db().execute('SELECT hash, pixels, questions FROM page_index WHERE user = ? AND version = ? '
+                            'AND created > ? AND hash IS NOT NULL ORDER BY created DESC LIMIT ?',
+                            (user, _page_version(), since, PHASH_INDEX_PER_USER)).fetchall()
+        for h, pixels, questions in rows:
+            if _near(page['hash'], int(h, 16)) and _same_pixels(page['pixels'], _unpack_pixels(pixels)):
+                return questions
+        return None
+
+    @blocking
+    def remember(self, user, pages, names, questions):
+        # Only pages analyzed on their own have questions that belong to them alone
+        if user is None or len(names) != 1 or pages.get(names[0]) is None or not questions:
+            return
+        page = pages[names[0]]
+        self._init_schema()
+        now = time.time()
+        conn = db()
+        conn.execute('INSERT INTO page_index (user, digest, hash, pixels, version, questions, created) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (user, page['digest'], None if page.get('hash') is None else format(page['hash'], 'x'),
+                      _pack_pixels(page.get('pixels')), _page_version(), json.dumps(questions), now))
+        conn.execute('DELETE FROM page_index WHERE user = ? AND id NOT IN (SELECT id FROM page_index '
+                     'WHERE user = ? ORDER BY created DESC LIMIT ?)', (user, user, PHASH_INDEX_PER_USER))
+        conn.execute('DELETE FROM page_index WHERE created < ?', (now - PHASH_INDEX_TTL,))
+        self.stored += 1
+
+
+def _pack_pixels(pixels):
+    if pixels is None:
+        return None
+    return pixels[0].to_bytes(2, 'big') + pixels[1].to_bytes(2, 'big') + zlib.compress(pixels[2], 6)
+
+
+def _unpack_pixels(blob):
+    if blob is None:
+        return None
+    return int.from_bytes(blob[:2], 'big'), int.from_bytes(blob[2:4], 'big'), zlib.decompress(blob[4:])
+
+
+def _page_version():
+    return f'{ANALYZE_MODEL}:{ANALYZE_PROMPT_VERSION}:{IMAGE_PREPROCESS}'
+
+
+class DedupeStats:
+    def __init__(self):
+        self.pages = 0
+        self.duplicates = 0
+        self.reused = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def record(self, report):
+        with self._lock:
+            self.pages += report['pages']
+            self.duplicates += report['duplicates']
+            self.reused += report['reused']
+            self.bytes_saved += report['bytes_saved']
+
+    def stats(self):
+        saved = self.duplicates + self.reused
+        return {
+            'enabled': EXACT_PAGE_DEDUPE,
+            'near_match': PHASH_NEAR_MATCH,
+            'pages': self.pages,
+            'duplicates_dropped': self.duplicates,
+            'reused_from_index': self.reused,
+            'images_saved': saved,
+            'image_tokens_saved_estimate': saved * IMAGE_TOKEN_ESTIMATE,
+            'bytes_saved': self.bytes_saved,
+            'indexed_pages_stored': page_index.stored,
+        }
+
+
+page_index = PageIndex()
+dedupe_stats = DedupeStats()
+STATS_PROVIDERS['image_dedupe'] = dedupe_stats.stats
+
+
+def page_fingerprint(data):
+    """What pages are compared on: the content digest, plus the hash and pixels with PHASH_NEAR_MATCH."""
+    page = {'digest': page_digest(data)}
+    if PHASH_NEAR_MATCH:
+        page['hash'] = page_hash(data)
+        page['pixels'] = page_pixels(data) if page['hash'] is not None else None
+    return page
+
+
+def same_page(a, b):
+    """True for identical pages, and with PHASH_NEAR_MATCH for near matches the pixel check confirms."""
+    if a['digest'] == b['digest']:
+        return True
+    return (PHASH_NEAR_MATCH and a.get('hash') is not None and b.get('hash') is not None
+            and _near(a['hash'], b['hash']) and _same_pixels(a['pixels'], b['pixels']))
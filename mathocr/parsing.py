@@ -0,0 +1,209 @@
+"""Structured replies from the model: the JSON schemas, and parsing that salvages what it can.
+
+Replies are requested with JSON-schema structured outputs when the API accepts them (the first
+rejection turns them off for the process). Whatever comes back is parsed by parse_model_json(),
+which salvages every complete question from a truncated or malformed array instead of failing the
+whole call, and counts each outcome so the wasted-call rate is visible under /stats.
+"""
+import os
+import json
+import time
+from openai import BadRequestError
+import threading
+
+from mathocr.metrics import usage_meter
+from mathocr.stats import STATS_PROVIDERS
+from mathocr.upstream import call_openai
+
+STRUCTURED_OUTPUTS = os.environ.get('STRUCTURED_OUTPUTS', '1') == '1'
+
+QUESTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "number": {"type": "string"},
+        "question": {"type": "string"},
+        "student_original": {"type": "string"},
+        "status": {"type": "string", "enum": ["correct", "partial", "incorrect"]},
+        "error": {"type": "string"},
+        "correct_solution": {"type": "string"},
+        "image_file": {"type": "string"},
+        "error_bbox": {
+            "type": ["object", "null"],
+            "properties": {"x": {"type": "number"}, "y": {"type": "number"},
+                           "width": {"type": "number"}, "height": {"type": "number"}},
+            "required": ["x", "y", "width", "height"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["number", "question", "student_original", "status", "error", "correct_solution",
+                 "image_file", "error_bbox"],
+    "additionalProperties": False,
+}
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {"questions": {"type": "array", "items": QUESTION_SCHEMA}},
+    "required": ["questions"],
+    "additionalProperties": False,
+}
+REANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "status": {"type": "string", "enum": ["correct", "partial", "incorrect"]},
+        "error": {"type": "string"},
+        "correct_solution": {"type": "string"},
+        "response": {"type": "string"},
+    },
+    "required": ["status", "error", "correct_solution", "response"],
+    "additionalProperties": False,
+}
+PRACTICE_SCHEMA = {
+    "type": "object",
+    "properties": {"practice_questions": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"number": {"type": "string"}, "question": {"type": "string"}},
+        "required": ["number", "question"],
+        "additionalProperties": False,
+    }}},
+    "required": ["practice_questions"],
+    "additionalProperties": False,
+}
+
+
+class ModelReplyError(Exception):
+    """Nothing usable could be parsed from a model reply."""
+
+
+class JSONArrayStream:
+    """Incrementally pulls complete objects out of a JSON array as its text arrives.
+
+    Anything before the opening '[' (such as a ```json fence) is ignored, and an object that
+    fails to parse is skipped rather than ending the stream.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.object_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        objects = []
+        text = self.text
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == '\\':
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch in '[{':
+                if ch == '[' or self.depth > 0:
+                    if self.depth == 1 and ch == '{':
+                        self.object_start = i
+                    self.depth += 1
+            elif ch in ']}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 1 and ch == '}' and self.object_start is not None:
+                    try:
+                        objects.append(json.loads(text[self.object_start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self.object_start = None
+        self.pos = len(text)
+        return objects
+
+
+class ParseStats:
+    OUTCOMES = ('parsed', 'salvaged', 'failed')
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, outcome):
+        with self._lock:
+            route_counts = self.counts.setdefault(route, dict.fromkeys(self.OUTCOMES, 0))
+            route_counts[outcome] += 1
+
+    def stats(self):
+        result = {'structured_outputs': STRUCTURED_OUTPUTS}
+        for route, counts in self.counts.items():
+            total = sum(counts.values())
+            result[route] = dict(counts, wasted_call_rate=round(counts['failed'] / total, 3) if total else 0.0)
+        return result
+
+
+parse_stats = ParseStats()
+STATS_PROVIDERS['parsing'] = parse_stats.stats
+
+
+def create_structured_completion(client, route, schema_name, schema, **kwargs):
+    """chat.completions.create() asking for a JSON-schema reply when the API supports it."""
+    global STRUCTURED_OUTPUTS
+    if STRUCTURED_OUTPUTS:
+        try:
+            return call_openai(
+                client, route,
+                response_format={"type": "json_schema",
+                                 "json_schema": {"name": schema_name, "strict": True, "schema": schema}},
+                **kwargs)
+        except BadRequestError as e:
+            if 'response_format' not in str(e) and 'json_schema' not in str(e):
+                raise
+            print(f"Structured outputs unavailable, falling back to plain JSON: {str(e)}")
+            STRUCTURED_OUTPUTS = False
+    return call_openai(client, route, **kwargs)
+
+
+def parse_model_json(route, text, key=None, expect=list):
+    """Parses a model reply into a list (or dict) of results.
+
+    Accepts a bare value, a structured-output wrapper object ({key: [...]}), or either one
+    surrounded by code fences or prose. For lists, complete objects are salvaged from a
+    truncated or broken array. Raises ModelReplyError when nothing usable is found.
+    """
+    started = time.perf_counter()
+    try:
+        return _parse_model_json(route, text, key, expect)
+    finally:
+        usage_meter.record_parse(route, time.perf_counter() - started)
+
+
+def _parse_model_json(route, text, key, expect):
+    text = (text or '').strip()
+    cleaned = text.replace('```json', '').replace('```', '').strip()
+    opener, closer = ('[', ']') if expect is list else ('{', '}')
+    candidates = [cleaned]
+    start, end = cleaned.find(opener), cleaned.rfind(closer)
+    if start != -1 and end > start:
+        candidates.append(cleaned[start:end + 1])
+    if expect is list and key:
+        start, end = cleaned.find('{'), cleaned.rfind('}')
+        if start != -1 and end > start:
+            candidates.append(cleaned[start:end + 1])
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if key and isinstance(value, dict) and key in value:
+            value = value[key]
+        if isinstance(value, expect):
+            parse_stats.record(route, 'parsed')
+            return value
+    if expect is list:
+        salvaged = [item for item in JSONArrayStream().feed(cleaned) if isinstance(item, dict)]
+        if salvaged:
+            print(f"⚠️ {route}: salvaged {len(salvaged)} objects from a malformed reply")
+            parse_stats.record(route, 'salvaged')
+            return salvaged
+    parse_stats.record(route, 'failed')
+    print(f"Could not parse {route} reply: {text[:500]}")
+    raise ModelReplyError(f'Could not parse the {route} reply')
@@ -0,0 +1,101 @@
+"""Rasterizing uploaded PDFs into page images.
+
+PDFs are split into pages inside a small process pool (MuPDF is not thread-safe, and a crashed or
+bloated renderer must not take the gunicorn worker down with it). Each worker opens the spooled
+file itself, so the upload is never copied between processes, and renders at most one page at a
+time with a bounded pixel count. Scanned pages that are a single full-page image are extracted
+as-is instead of being re-rendered.
+"""
+import os
+from PIL import Image
+import threading
+import multiprocessing
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from mathocr.images import IMAGE_MAX_SHORT_SIDE, encode_page, preprocess_image
+
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+PDF_MAX_PAGES = int(os.environ.get('PDF_MAX_PAGES', 30))
+PDF_MAX_PAGE_PIXELS = int(os.environ.get('PDF_MAX_PAGE_PIXELS', 4_000_000))
+PDF_TIMEOUT = float(os.environ.get('PDF_TIMEOUT', 120))
+PDF_FULL_PAGE_IMAGE = 0.9  # fraction of the page an embedded image must cover to be used directly
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+def _get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            max_tasks_per_child=50)
+        return _pdf_pool
+
+
+def _pdf_page_count(path):
+    import pymupdf
+    with pymupdf.open(path) as doc:
+        return doc.page_count
+
+
+def _pdf_page_image(doc, page):
+    import pymupdf
+    # Scanned page: a single image covering the page can be used without rendering
+    images = page.get_images(full=True)
+    if len(images) == 1:
+        rects = page.get_image_rects(images[0][0])
+        if rects and rects[0].get_area() >= PDF_FULL_PAGE_IMAGE * page.rect.get_area():
+            try:
+                return preprocess_image(doc.extract_image(images[0][0])['image'])[1]
+            except Exception:
+                pass  # unusual codec (JBIG2, JPX...) - render instead
+    # Render in grayscale at roughly the resolution the model keeps, capped in pixels
+    zoom = IMAGE_MAX_SHORT_SIDE * 3 / 2 / min(page.rect.width, page.rect.height)
+    zoom = min(zoom, (PDF_MAX_PAGE_PIXELS / page.rect.get_area()) ** 0.5)
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace='gray', alpha=False)
+    img = Image.frombytes('L', (pix.width, pix.height), pix.samples)
+    del pix
+    return encode_page(img)
+
+
+def _pdf_render_pages(path, page_numbers):
+    # Runs in the PDF pool; returns [(page_number, jpeg_bytes)]
+    import pymupdf
+    results = []
+    with pymupdf.open(path) as doc:
+        for n in page_numbers:
+            results.append((n, _pdf_page_image(doc, doc[n])))
+    return results
+
+
+def rasterize_pdf(file):
+    """Returns ([(label, jpeg_bytes)], total_pages) for an uploaded PDF, one entry per page.
+
+    Raises TimeoutError when the whole PDF takes longer than PDF_TIMEOUT, and the renderer's
+    exception when the PDF cannot be opened.
+    """
+    deadline = time.monotonic() + PDF_TIMEOUT
+    with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+        file.seek(0)
+        shutil.copyfileobj(file.stream, tmp)
+        tmp.flush()
+        pool = _get_pdf_pool()
+        total = pool.submit(_pdf_page_count, tmp.name).result(timeout=max(0, deadline - time.monotonic()))
+        pages = list(range(min(total, PDF_MAX_PAGES)))
+        # Contiguous page ranges, one per worker, all under the one deadline
+        size = max(-(-len(pages) // PDF_WORKERS), 1)
+        futures = [pool.submit(_pdf_render_pages, tmp.name, pages[i:i + size])
+                   for i in range(0, len(pages), size)]
+        _, pending = wait(futures, timeout=max(0, deadline - time.monotonic()))
+        if pending:
+            for future in pending:
+                future.cancel()
+            raise TimeoutError(f'{file.filename} took more than {PDF_TIMEOUT:g}s to render')
+        rendered = [page for future in futures for page in future.result()]
+    rendered.sort()
+    return [(f"{file.filename} (page {n + 1})", data) for n, data in rendered], total
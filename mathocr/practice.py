@@ -0,0 +1,177 @@
+"""A bank of generated practice questions per concept, topped up in the background.
+
+Practice questions are kept per concept signature (the normalized text of the original question)
+and reused across the class. A request is answered from the bank for every concept that has at
+least PRACTICE_BANK_MIN_VARIANTS fresh variants, least-served first; only the remaining concepts
+are generated inline. Concepts below PRACTICE_BANK_TARGET_VARIANTS are topped up by a background job.
+"""
+import os
+import json
+import hashlib
+import sqlite3
+import time
+import threading
+
+from mathocr.cache import dedupe_by_number
+from mathocr.database import db, db_write
+from mathocr.jobs import job_queue
+from mathocr.metrics import MODEL_PRICES
+from mathocr.openai_client import get_openai_client
+from mathocr.parsing import PRACTICE_SCHEMA, create_structured_completion, parse_model_json
+from mathocr.reanalysis import normalize_text
+from mathocr.stats import STATS_PROVIDERS
+
+PRACTICE_BANK_MIN_VARIANTS = int(os.environ.get('PRACTICE_BANK_MIN_VARIANTS', 3))
+PRACTICE_BANK_TARGET_VARIANTS = int(os.environ.get('PRACTICE_BANK_TARGET_VARIANTS', 5))
+PRACTICE_BANK_TTL = int(os.environ.get('PRACTICE_BANK_TTL', 30 * 24 * 3600))
+PRACTICE_TOKENS_PER_QUESTION = 400  # estimate used until real usage has been observed
+
+
+def _practice_signature(question):
+    return hashlib.sha256(normalize_text(question.get('question')).casefold().encode()).hexdigest()[:32]
+
+
+def run_practice_generation(client, error_questions):
+    """Generates one practice question per error question and adds them to the bank."""
+    prompt = f"""
+    Generate practice questions for these problems with mistakes: {json.dumps(error_questions, indent=2)}
+    CRITICAL INSTRUCTIONS:
+    1. Use the EXACT SAME question numbers as originals
+    2. Create MODIFIED versions (similar concept, different values)
+    3. Target the specific errors/concepts
+    4. Format math with $LaTeX$
+    5. Ensure each question number appears only once. No duplicates. If multiple for same number, combine into one.
+    6. Ensure terms are not repeated in the question text; each mathematical term appears only once.
+    Return JSON array: [{{"number": "number", "question": "modified with $LaTeX$"}}]
+    """
+
+    response = create_structured_completion(
+        client, 'practice', 'practice', PRACTICE_SCHEMA,
+        model="gpt-5.1",
+        messages=[{"role": "user", "content": prompt}],
+        max_completion_tokens=2000,
+        temperature=0.7
+    )
+    practice_questions = parse_model_json('practice', response.choices[0].message.content,
+                                          key='practice_questions')
+    practice_questions = dedupe_by_number([pq for pq in practice_questions if 'number' in pq])
+    practice_bank.add(error_questions, practice_questions, getattr(response, 'usage', None))
+    return practice_questions
+
+
+class PracticeBank:
+    def __init__(self):
+        self.requested = 0
+        self.hits = 0
+        self.generated = 0
+        self.tokens_per_question = PRACTICE_TOKENS_PER_QUESTION
+        self.input_share = 0.8  # share of tokens that are prompt tokens, refined from usage
+        self._lock = threading.Lock()
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        conn = db()
+        conn.execute('CREATE TABLE IF NOT EXISTS practice_bank (id INTEGER PRIMARY KEY, signature TEXT NOT NULL, '
+                     'question TEXT NOT NULL, created REAL NOT NULL, served INTEGER NOT NULL DEFAULT 0)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_practice_bank_signature ON practice_bank (signature, created)')
+        self._schema_ready = True
+
+    def fresh_counts(self, signatures):
+        self._init_schema()
+        if not signatures:
+            return {}
+        marks = ','.join('?' * len(signatures))
+        rows = db().execute(f'SELECT signature, COUNT(*) FROM practice_bank WHERE signature IN ({marks}) '
+                            f'AND created > ? GROUP BY signature',
+                            list(signatures) + [time.time() - PRACTICE_BANK_TTL]).fetchall()
+        return dict(rows)
+
+    def take(self, error_questions):
+        """Returns ({number: practice_question} served from the bank, [error questions still to generate])."""
+        self._init_schema()
+        counts = self.fresh_counts({_practice_signature(q) for q in error_questions})
+        served, missing = {}, []
+        conn = db()
+        for q in error_questions:
+            signature = _practice_signature(q)
+            row = None
+            if counts.get(signature, 0) >= PRACTICE_BANK_MIN_VARIANTS:
+                row = conn.execute('SELECT id, question FROM practice_bank WHERE signature = ? AND created > ? '
+                                   'ORDER BY served, RANDOM() LIMIT 1',
+                                   (signature, time.time() - PRACTICE_BANK_TTL)).fetchone()
+            if row:
+                db_write('UPDATE practice_bank SET served = served + 1 WHERE id = ?', (row[0],))
+                served[q['number']] = {'number': q['number'], 'question': row[1]}
+            else:
+                missing.append(q)
+        with self._lock:
+            self.requested += len(error_questions)
+            self.hits += len(served)
+        return served, missing
+
+    def add(self, error_questions, practice_questions, usage=None):
+        self._init_schema()
+        by_number = {q['number']: _practice_signature(q) for q in error_questions}
+        now = time.time()
+        rows = [(by_number[pq['number']], pq['question'], now) for pq in practice_questions
+                if pq.get('number') in by_number and pq.get('question')]
+        if rows:
+            db_write('INSERT INTO practice_bank (signature, question, created) VALUES (?, ?, ?)', rows, many=True)
+        with self._lock:
+            self.generated += len(rows)
+            if usage is not None and rows and usage.total_tokens:
+                # Moving average of what one generated question really costs
+                self.tokens_per_question = 0.8 * self.tokens_per_question + 0.2 * usage.total_tokens / len(rows)
+                self.input_share = usage.prompt_tokens / usage.total_tokens
+
+    def schedule_topup(self, error_questions, user=None):
+        # One background top-up per concept set every 10 minutes at most (the job id is the dedupe key)
+        counts = self.fresh_counts({_practice_signature(q) for q in error_questions})
+        short = [q for q in error_questions if counts.get(_practice_signature(q), 0) < PRACTICE_BANK_TARGET_VARIANTS]
+        if not short:
+            return
+        key = hashlib.sha256(''.join(sorted(_practice_signature(q) for q in short)).encode()).hexdigest()[:24]
+        try:
+            # Runs as the requesting user, so its spend is billed to them in /metrics/costs
+            job_queue.submit('practice_topup', {'questions': short}, user=user,
+                             job_id=f'topup-{key}-{int(time.time() // 600)}')
+        except sqlite3.IntegrityError:
+            pass
+
+    def stats(self):
+        self._init_schema()
+        saved_tokens = self.hits * self.tokens_per_question
+        price_in, price_out = MODEL_PRICES['gpt-5.1']
+        price = (self.input_share * price_in + (1 - self.input_share) * price_out) / 1e6
+        return {
+            'bank_size': db().execute('SELECT COUNT(*) FROM practice_bank').fetchone()[0],
+            'questions_requested': self.requested,
+            'served_from_bank': self.hits,
+            'generated': self.generated,
+            'hit_rate': round(self.hits / self.requested, 3) if self.requested else 0.0,
+            'tokens_saved_estimate': int(saved_tokens),
+            'cost_saved_usd_estimate': round(saved_tokens * price, 4),
+        }
+
+
+practice_bank = PracticeBank()
+STATS_PROVIDERS['practice_bank'] = practice_bank.stats
+
+
+@job_queue.handler('practice_topup')
+def _practice_topup_job(job_id, payload):
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        return {'error': 'OpenAI API key not configured.'}
+    client = get_openai_client(api_key)
+    added = 0
+    for _ in range(PRACTICE_BANK_TARGET_VARIANTS):
+        counts = practice_bank.fresh_counts({_practice_signature(q) for q in payload['questions']})
+        short = [q for q in payload['questions']
+                 if counts.get(_practice_signature(q), 0) < PRACTICE_BANK_TARGET_VARIANTS]
+        if not short:
+            break
+        added += len(run_practice_generation(client, short))
+    return {'added': added}
@@ -0,0 +1,154 @@
+"""Practice papers rendered to paginated PDFs on the server.
+
+Practice papers are typeset server-side with reportlab: LaTeX is converted to Unicode text with
+<super>/<sub> markup and drawn as vector glyphs from an embedded TrueType font, and the flowing
+layout paginates on its own. Rendered PDFs are cached by a hash of the question set.
+"""
+import os
+import io
+import re
+from datetime import datetime
+from markupsafe import escape
+
+from mathocr.cache import LRUCache, ResultCache
+from mathocr.cooperative import blocking
+from mathocr.stats import STATS_PROVIDERS
+
+PRACTICE_PDF_FONT = os.environ.get('PRACTICE_PDF_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+practice_pdf_cache = ResultCache(LRUCache(max_entries=int(os.environ.get('PRACTICE_PDF_CACHE_ENTRIES', 64)),
+                                          ttl=24 * 3600))
+STATS_PROVIDERS['practice_pdf_cache'] = practice_pdf_cache.stats
+
+LATEX_SYMBOLS = {
+    'times': '×', 'cdot': '·', 'div': '÷', 'pm': '±', 'mp': '∓', 'leq': '≤', 'le': '≤', 'geq': '≥', 'ge': '≥',
+    'neq': '≠', 'ne': '≠', 'approx': '≈', 'infty': '∞', 'pi': 'π', 'theta': 'θ', 'alpha': 'α', 'beta': 'β',
+    'gamma': 'γ', 'delta': 'δ', 'Delta': 'Δ', 'lambda': 'λ', 'mu': 'μ', 'sigma': 'σ', 'Sigma': 'Σ', 'phi': 'φ',
+    'omega': 'ω', 'degree': '°', 'circ': '°', 'angle': '∠', 'triangle': '△', 'perp': '⊥', 'parallel': '∥',
+    'rightarrow': '→', 'to': '→', 'Rightarrow': '⇒', 'leftarrow': '←', 'in': '∈', 'cup': '∪', 'cap': '∩',
+    'sum': 'Σ', 'int': '∫', 'sqrt': '√', 'ldots': '…', 'dots': '…', 'cdots': '⋯', 'quad': '  ', 'qquad': '    ',
+    'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'log': 'log', 'ln': 'ln', 'lim': 'lim',
+}
+_font_name = None
+
+
+def _pdf_font():
+    # DejaVu Sans if installed (widest math coverage), else the Vera font bundled with reportlab
+    global _font_name
+    if _font_name is None:
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        import reportlab
+        path = PRACTICE_PDF_FONT
+        if not os.path.exists(path):
+            path = os.path.join(os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')
+        pdfmetrics.registerFont(TTFont('PracticeSans', path))
+        _font_name = 'PracticeSans'
+    return _font_name
+
+
+def _latex_group(tex, i):
+    # Returns (content, next_index) for a {...} group or a single token at tex[i]
+    if i >= len(tex):
+        return '', i
+    if tex[i] == '{':
+        depth = 0
+        for j in range(i, len(tex)):
+            depth += {'{': 1, '}': -1}.get(tex[j], 0)
+            if depth == 0:
+                return tex[i + 1:j], j + 1
+        return tex[i + 1:], len(tex)
+    if tex[i] == '\\':
+        j = i + 1
+        while j < len(tex) and tex[j].isalpha():
+            j += 1
+        return tex[i:max(j, i + 2)], max(j, i + 2)
+    return tex[i], i + 1
+
+
+def _latex_operand(tex):
+    # Fraction parts only need brackets when they are more than a single number or symbol
+    markup = _latex_to_markup(tex)
+    return markup if re.fullmatch(r'\s*[\w.]+\s*', tex) else f'({markup})'
+
+
+def _latex_to_markup(tex):
+    """Converts a LaTeX math fragment to reportlab paragraph markup."""
+    out = []
+    i = 0
+    while i < len(tex):
+        ch = tex[i]
+        if ch == '\\':
+            j = i + 1
+            while j < len(tex) and tex[j].isalpha():
+                j += 1
+            name = tex[i + 1:j] or tex[i + 1:i + 2]
+            i = j if j > i + 1 else i + 2
+            if name == 'frac':
+                num, i = _latex_group(tex, i)
+                den, i = _latex_group(tex, i)
+                out.append(f'{_latex_operand(num)}/{_latex_operand(den)}')
+            elif name == 'sqrt':
+                arg, i = _latex_group(tex, i)
+                out.append(f'√({_latex_to_markup(arg)})')
+            elif name in ('left', 'right', 'displaystyle', 'mathrm', 'text', 'mathbf', 'textbf'):
+                continue
+            elif name in (',', ';', ' ', '!'):
+                out.append(' ')
+            elif name in ('{', '}', '%', '$', '#'):
+                out.append(escape(name))
+            else:
+                out.append(escape(LATEX_SYMBOLS.get(name, name)))
+        elif ch in '^_':
+            arg, i = _latex_group(tex, i + 1)
+            tag = 'super' if ch == '^' else 'sub'
+            out.append(f'<{tag}>{_latex_to_markup(arg)}</{tag}>')
+        elif ch in '{}':
+            i += 1
+        else:
+            out.append(escape(ch))
+            i += 1
+    return ''.join(out)
+
+
+def _text_to_markup(text):
+    # Plain text with $...$ / $$...$$ math and <br> line breaks -> paragraph markup
+    parts = re.split(r'(\$\$.+?\$\$|\$.+?\$)', str(text or ''), flags=re.S)
+    out = []
+    for part in parts:
+        if part.startswith('$$') and part.endswith('$$') and len(part) > 4:
+            out.append(f'<br/>{_latex_to_markup(part[2:-2])}<br/>')
+        elif part.startswith('$') and part.endswith('$') and len(part) > 2:
+            out.append(_latex_to_markup(part[1:-1]))
+        else:
+            for k, line in enumerate(re.split(r'<br\s*/?>', part)):
+                out.append(('<br/>' if k else '') + str(escape(line)))
+    return ''.join(out)
+
+
+@blocking
+def render_practice_pdf(practice_questions, title='Practice Paper'):
+    """Returns the PDF bytes for a list of {"number", "question"} dicts."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle
+    from reportlab.lib.units import mm
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, KeepTogether
+    font = _pdf_font()
+    title_style = ParagraphStyle('title', fontName=font, fontSize=20, leading=26, alignment=1, spaceAfter=4)
+    subtitle_style = ParagraphStyle('subtitle', fontName=font, fontSize=10, leading=14, alignment=1,
+                                    textColor='#6b7280', spaceAfter=18)
+    number_style = ParagraphStyle('number', fontName=font, fontSize=11, leading=15, textColor='#667eea')
+    question_style = ParagraphStyle('question', fontName=font, fontSize=12, leading=18)
+    story = [Paragraph(escape(title), title_style),
+             Paragraph(f'Practice questions based on areas needing improvement · {datetime.utcnow():%Y-%m-%d}',
+                       subtitle_style)]
+    for pq in practice_questions:
+        story.append(KeepTogether([
+            Paragraph(f"Question {escape(pq.get('number', ''))}", number_style),
+            Paragraph(_text_to_markup(pq.get('question')), question_style),
+            Spacer(1, 35 * mm),  # working space
+        ]))
+    out = io.BytesIO()
+    doc = SimpleDocTemplate(out, pagesize=A4, leftMargin=20 * mm, rightMargin=20 * mm,
+                            topMargin=20 * mm, bottomMargin=20 * mm, title=title)
+    doc.build(story)
+    return out.getvalue()
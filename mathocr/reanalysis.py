@@ -0,0 +1,109 @@
+"""Follow-up questions on an analyzed question: memoized answers and collapsed duplicate calls."""
+import os
+import hashlib
+import threading
+
+from mathocr.cache import ResultCache, make_cache_backend
+from mathocr.parsing import REANALYSIS_SCHEMA, create_structured_completion, parse_model_json
+from mathocr.stats import STATS_PROVIDERS
+from mathocr.uploads import data_url
+
+REANALYZE_PROMPT_VERSION = '2'
+reanalysis_cache = ResultCache(make_cache_backend(
+    os.environ.get('REANALYZE_CACHE_BACKEND', 'memory'),
+    max_entries=int(os.environ.get('REANALYZE_CACHE_MAX_ENTRIES', 2048)),
+    ttl=int(os.environ.get('REANALYZE_CACHE_TTL', 24 * 3600)),
+    table='reanalysis_cache'))
+STATS_PROVIDERS['reanalysis_cache'] = reanalysis_cache.stats
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one; followers get the leader's result or error."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+                self.leaders += 1
+            else:
+                self.followers += 1
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'upstream_calls': self.leaders, 'collapsed': self.followers}
+
+
+reanalysis_flight = SingleFlight()
+STATS_PROVIDERS['reanalysis_single_flight'] = reanalysis_flight.stats
+
+
+def normalize_text(value):
+    return ' '.join(str(value or '').split())
+
+
+def reanalysis_key(data, crop=None):
+    # Whitespace-insensitive over every field the prompt uses; the free-text query is also case-insensitive
+    fields = [normalize_text(data.get(k)) for k in ('question', 'student_original', 'error', 'correct_solution')]
+    fields.append(normalize_text(data.get('user_query')).casefold())
+    h = hashlib.sha256(f'gpt-5.1|{REANALYZE_PROMPT_VERSION}'.encode())
+    for field in fields:
+        h.update(b'\0' + field.encode())
+    if crop is not None:
+        h.update(b'\0' + hashlib.sha256(crop).digest())
+    return h.hexdigest()
+
+
+def run_reanalysis(client, data, crop=None):
+    """crop is an optional JPEG of the student's working, attached at low detail."""
+    image_note = ("The attached image is the student's handwritten working for this question; "
+                  "read it again instead of relying only on the transcription above.") if crop is not None else ""
+    prompt = f"""
+    Re-analyze this question based on user query: "{data['user_query']}"
+    Original: Question: {data['question']}
+    Student: {data['student_original']}
+    Previous error: {data['error']}
+    Previous correct: {data['correct_solution']}
+    {image_note}
+    Provide updated:
+    - status: "correct|partial|incorrect"
+    - error: updated description
+    - correct_solution: updated steps <br> separated
+    - response: brief response to user query
+    Format ALL with LaTeX $
+    Return JSON: {{"status": "", "error": "", "correct_solution": "", "response": ""}}
+    """
+
+    response = create_structured_completion(
+        client, 'reanalyze', 'reanalysis', REANALYSIS_SCHEMA,
+        model="gpt-5.1",
+        messages=[{"role": "user", "content": prompt if crop is None else [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": data_url('image/jpeg', crop), "detail": "low"}},
+        ]}],
+        max_completion_tokens=2000,
+        temperature=0.3
+    )
+
+    return parse_model_json('reanalyze', response.choices[0].message.content, expect=dict)
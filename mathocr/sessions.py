@@ -0,0 +1,226 @@
+"""Server-side Flask sessions in SQLite or Postgres, behind a per-process read cache.
+
+SESSION_BACKEND picks where Flask sessions live:
+  sqlite (default)  the local SQLite database, shared by every worker on the host
+  postgres          SESSION_DATABASE_URL (or DATABASE_URL), shared across hosts
+  cookie            Flask's signed cookie; nothing is stored server-side
+  filesystem        the previous Flask-Session files in /tmp/flask_sessions
+Server-side sessions are read through a per-process cache for SESSION_CACHE_TTL seconds (so a
+change made by another worker can be that stale), written back only when they change or pass half
+their SESSION_LIFETIME, and deleted after expiry by a sweeper thread in every worker.
+"""
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from werkzeug.datastructures import CallbackDict
+import os
+import re
+import time
+from datetime import datetime
+import threading
+import secrets
+
+from mathocr.cache import LRUCache
+from mathocr.cooperative import blocking
+from mathocr.database import db
+from mathocr.stats import STATS_PROVIDERS
+
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_LIFETIME = int(os.environ.get('SESSION_LIFETIME', 7 * 24 * 3600))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 30))
+SESSION_SWEEP_INTERVAL = int(os.environ.get('SESSION_SWEEP_INTERVAL', 600))
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{32,64}$')
+
+
+class SQLiteSessionStore:
+    def __init__(self, table='sessions'):
+        self.table = table
+        self._schema_ready = False
+
+    def _conn(self):
+        conn = db()
+        if not self._schema_ready:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                         f'expires REAL NOT NULL)')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_expires ON {self.table} (expires)')
+            self._schema_ready = True
+        return conn
+
+    def load(self, sid):
+        return self._conn().execute(f'SELECT data, expires FROM {self.table} WHERE id = ? AND expires > ?',
+                                    (sid, time.time())).fetchone()
+
+    @blocking
+    def save(self, sid, data, expires):
+        self._conn().execute(f'INSERT OR REPLACE INTO {self.table} (id, data, expires) VALUES (?, ?, ?)',
+                             (sid, data, expires))
+
+    @blocking
+    def delete(self, sid):
+        self._conn().execute(f'DELETE FROM {self.table} WHERE id = ?', (sid,))
+
+    @blocking
+    def sweep(self):
+        return self._conn().execute(f'DELETE FROM {self.table} WHERE expires <= ?', (time.time(),)).rowcount
+
+
+class PostgresSessionStore:
+    """Sessions in Postgres; the connection pool is created per process on first use."""
+
+    def __init__(self, dsn, table='flask_sessions'):
+        self.dsn = dsn
+        self.table = table
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @blocking
+    def _run(self, sql, params=(), fetch=False):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    from psycopg2.pool import ThreadedConnectionPool
+                    self._pool = ThreadedConnectionPool(1, 8, self.dsn)
+                    self._pid = os.getpid()
+                    self._run(f'CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                              f'expires DOUBLE PRECISION NOT NULL)')
+                    self._run(f'CREATE INDEX IF NOT EXISTS idx_{self.table}_expires ON {self.table} (expires)')
+        conn = self._pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchone() if fetch else cur.rowcount
+        finally:
+            self._pool.putconn(conn)
+
+    def load(self, sid):
+        return self._run(f'SELECT data, expires FROM {self.table} WHERE id = %s AND expires > %s',
+                         (sid, time.time()), fetch=True)
+
+    def save(self, sid, data, expires):
+        self._run(f'INSERT INTO {self.table} (id, data, expires) VALUES (%s, %s, %s) '
+                  f'ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, expires = EXCLUDED.expires',
+                  (sid, data, expires))
+
+    def delete(self, sid):
+        self._run(f'DELETE FROM {self.table} WHERE id = %s', (sid,))
+
+    def sweep(self):
+        return self._run(f'DELETE FROM {self.table} WHERE expires <= %s', (time.time(),))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires=0.0):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.modified = False
+
+
+class StoreSessionInterface(SessionInterface):
+    """Server-side sessions in a store; the cookie only carries a random session id."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+        self.cache = LRUCache(max_entries=10000, ttl=SESSION_CACHE_TTL)
+        self.loads = 0
+        self.cache_hits = 0
+        self.saves = 0
+        self.deletes = 0
+        self.swept = 0
+        self._sweeper_pid = None
+        self._lock = threading.Lock()
+
+    def _start_sweeper(self):
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid != os.getpid():
+                threading.Thread(target=self._sweep_forever, name='session-sweeper', daemon=True).start()
+                self._sweeper_pid = os.getpid()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                removed = self.store.sweep()
+                self.swept += removed
+                if removed:
+                    print(f"🧹 Removed {removed} expired sessions")
+            except Exception as e:
+                print(f"Session sweep error: {str(e)}")
+            time.sleep(SESSION_SWEEP_INTERVAL)
+
+    def open_session(self, app, request):
+        self._start_sweeper()
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and SESSION_ID_PATTERN.match(sid):
+            row = self.cache.get(sid) if SESSION_CACHE_TTL > 0 else None
+            if row is None:
+                row = self.store.load(sid)
+                self.loads += 1
+                if row is not None and SESSION_CACHE_TTL > 0:
+                    self.cache.set(sid, row)
+            else:
+                self.cache_hits += 1
+            if row is not None and row[1] > time.time():
+                return ServerSession(self.serializer.loads(row[0]), sid=sid, expires=row[1])
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain, path = self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if not session.new and session.modified:
+                self.store.delete(session.sid)
+                self.cache.delete(session.sid)
+                self.deletes += 1
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        now = time.time()
+        # Unchanged sessions are only rewritten to extend their expiry, at most once per half lifetime
+        if not (session.modified or session.new or session.expires - now < SESSION_LIFETIME / 2):
+            return
+        expires = now + SESSION_LIFETIME
+        data = self.serializer.dumps(dict(session))
+        self.store.save(session.sid, data, expires)
+        self.cache.set(session.sid, (data, expires))
+        self.saves += 1
+        response.set_cookie(name, session.sid, expires=datetime.utcfromtimestamp(expires), domain=domain,
+                            path=path, httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+    def stats(self):
+        return {
+            'backend': SESSION_BACKEND,
+            'loads': self.loads,
+            'cache_hits': self.cache_hits,
+            'cache_hit_ratio': round(self.cache_hits / (self.cache_hits + self.loads), 3)
+            if self.cache_hits + self.loads else 0.0,
+            'saves': self.saves,
+            'deletes': self.deletes,
+            'swept': self.swept,
+        }
+
+
+def configure_sessions(app, backend=SESSION_BACKEND):
+    if backend == 'cookie':
+        app.session_interface = SecureCookieSessionInterface()
+    elif backend == 'filesystem':
+        from flask_session import Session
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = '/tmp/flask_sessions'
+        os.makedirs(app.config['SESSION_FILE_DIR'], exist_ok=True)
+        Session(app)
+    else:
+        if backend == 'postgres':
+            store = PostgresSessionStore(os.environ.get('SESSION_DATABASE_URL') or os.environ['DATABASE_URL'])
+        else:
+            store = SQLiteSessionStore()
+        app.session_interface = StoreSessionInterface(store)
+        STATS_PROVIDERS['sessions'] = app.session_interface.stats
+    return app.session_interface
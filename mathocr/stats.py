@@ -0,0 +1,4 @@
+"""Registry of the subsystem counters served by /stats."""
+
+# name -> callable returning a dict; every subsystem registers its counters here for /stats
+STATS_PROVIDERS = {}
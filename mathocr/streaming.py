@@ -0,0 +1,60 @@
+"""Streamed analysis: questions parsed out of the reply as it arrives, sent as Server-Sent Events."""
+import json
+import time
+import threading
+
+from mathocr.analysis import analysis_messages
+from mathocr.config import ANALYZE_MODEL
+from mathocr.parsing import ANALYSIS_SCHEMA, JSONArrayStream, create_structured_completion
+from mathocr.stats import STATS_PROVIDERS
+
+
+class StreamStats:
+    def __init__(self):
+        self.streams = 0
+        self.first_question_total = 0.0
+        self.first_question_max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, time_to_first_question):
+        with self._lock:
+            self.streams += 1
+            self.first_question_total += time_to_first_question
+            self.first_question_max = max(self.first_question_max, time_to_first_question)
+
+    def stats(self):
+        return {
+            'streams': self.streams,
+            'avg_time_to_first_question': round(self.first_question_total / self.streams, 2) if self.streams else 0.0,
+            'max_time_to_first_question': round(self.first_question_max, 2),
+        }
+
+
+stream_stats = StreamStats()
+STATS_PROVIDERS['analyze_stream'] = stream_stats.stats
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_analysis(client, file_names, file_contents, started):
+    """Yields (question, seconds_since_started) as the model writes each question out."""
+    response = create_structured_completion(
+        client, 'analyze', 'analysis', ANALYSIS_SCHEMA,
+        model=ANALYZE_MODEL,
+        messages=analysis_messages(file_names, file_contents),
+        max_completion_tokens=9000,
+        temperature=0.3,
+        stream=True
+    )
+    parser = JSONArrayStream()
+    seen = set()
+    for chunk in response:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        for q in parser.feed(chunk.choices[0].delta.content):
+            # Same by-number dedupe as the non-streaming path
+            if isinstance(q, dict) and 'number' in q and q['number'] not in seen:
+                seen.add(q['number'])
+                yield q, time.perf_counter() - started
@@ -0,0 +1,278 @@
+"""Uploaded files: spooled while a request is parsed, or stored resumably by content hash.
+
+Each uploaded file is parsed into a spooled temporary file that moves to UPLOAD_SPOOL_DIR once it
+passes UPLOAD_SPOOL_THRESHOLD, so a worker holds at most that much of an upload in memory. Images
+are decoded straight from that file, and data: URLs are base64-encoded from it chunk by chunk into
+one buffer, so the raw bytes, the encoded bytes and the str are never all alive at once. Uploads
+are closed as soon as their pages are encoded.
+
+The page shrinks images in the browser and sends every file in UPLOAD_CHUNK_SIZE chunks to a store
+keyed by the user and the file's SHA-256: an interrupted upload resumes with the chunks still
+missing, and a file the user already sent is not sent again. An id only ever finds its own user's
+upload, so knowing a file's hash gives no access to someone else's copy. Chunks and finished files
+live in a directory per user under UPLOAD_DIR, shared by the workers on the host, and are removed
+UPLOAD_TTL after they were last used. The
+analysis routes take stored files through the form field "uploads", a JSON list of
+{"id": sha256, "name": filename}, alongside or instead of multipart "files".
+"""
+from flask import Request, current_app
+import os
+import base64
+import io
+import re
+import hashlib
+import time
+import threading
+import shutil
+import tempfile
+from werkzeug.datastructures import FileStorage
+
+from mathocr.cooperative import blocking
+from mathocr.database import db, db_write
+from mathocr.stats import STATS_PROVIDERS
+
+UPLOAD_SPOOL_THRESHOLD = int(os.environ.get('UPLOAD_SPOOL_THRESHOLD', 256 * 1024))
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR') or None  # None: the system temp directory
+BASE64_CHUNK = 3 * 256 * 1024  # a multiple of 3, so chunks encode without padding
+
+
+class SpoolingRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='rb+', dir=UPLOAD_SPOOL_DIR)
+
+
+def source_size(source):
+    """Size in bytes of a bytes object or of a seekable file from its current position."""
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    position = source.tell()
+    size = source.seek(0, io.SEEK_END) - position
+    source.seek(position)
+    return size
+
+
+def data_url(mime, source):
+    """data: URL of bytes or a binary file (read from its current position), encoded in chunks."""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)  # shares the buffer, no copy
+    prefix = f'data:{mime};base64,'.encode('ascii')
+    out = bytearray(len(prefix) + -(-source_size(source) // 3) * 4)
+    out[:len(prefix)] = prefix
+    end = len(prefix)
+    for chunk in iter(lambda: source.read(BASE64_CHUNK), b''):
+        encoded = base64.b64encode(chunk)
+        out[end:end + len(encoded)] = encoded
+        end += len(encoded)
+    return str(memoryview(out)[:end], 'ascii')
+
+
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', '/tmp/math_ocr_uploads')
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 512 * 1024))
+UPLOAD_TTL = int(os.environ.get('UPLOAD_TTL', 24 * 3600))
+UPLOAD_SWEEP_INTERVAL = 600
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# Bytes of uploads a user may have registered at once; they count until swept, UPLOAD_TTL after last use
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', 512 * 1024 * 1024))
+CLIENT_IMAGE_COMPRESSION = os.environ.get('CLIENT_IMAGE_COMPRESSION', '1') == '1'
+CLIENT_IMAGE_QUALITY = 0.9  # the server re-encodes anyway; this only has to avoid visible artefacts
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class UploadStore:
+    def __init__(self, root=UPLOAD_DIR, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.files = 0
+        self.files_skipped = 0
+        self.chunks_received = 0
+        self.chunks_skipped = 0
+        self.bytes_received = 0
+        self.bytes_skipped = 0
+        self.original_bytes = 0
+        self.stored_bytes = 0
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._schema_ready = False
+
+    def _init_schema(self):
+        if self._schema_ready:
+            return
+        db().execute('CREATE TABLE IF NOT EXISTS uploads (id TEXT NOT NULL, user TEXT NOT NULL, name TEXT NOT NULL, '
+                     'content_type TEXT NOT NULL, size INTEGER NOT NULL, chunk_size INTEGER NOT NULL, '
+                     'complete INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, last_used REAL NOT NULL, '
+                     'PRIMARY KEY (id, user))')
+        db().execute('CREATE INDEX IF NOT EXISTS idx_uploads_last_used ON uploads (last_used)')
+        db().execute('CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user)')
+        self._schema_ready = True
+
+    def _user_dir(self, user):
+        return os.path.join(self.root, hashlib.sha256(user.encode()).hexdigest()[:32])
+
+    def _dir(self, upload_id, user):
+        return os.path.join(self._user_dir(user), upload_id)
+
+    def _row(self, upload_id, user):
+        if not UPLOAD_ID_PATTERN.match(upload_id or ''):
+            raise UploadError('Invalid upload id')
+        if not user:
+            raise UploadError('Not logged in', 401)
+        self._init_schema()
+        return db().execute('SELECT size, chunk_size, complete, content_type FROM uploads WHERE id = ? AND user = ?',
+                            (upload_id, user)).fetchone()
+
+    def _missing(self, upload_id, user, size, chunk_size):
+        present = set(os.listdir(self._dir(upload_id, user)))
+        return [i for i in range(max(-(-size // chunk_size), 1)) if f'{i}.part' not in present]
+
+    def begin(self, upload_id, user, name, content_type, size, original_size=None):
+        """Registers one of user's uploads (or finds it); returns what the client still has to send."""
+        if not isinstance(size, int) or not 0 < size <= current_app.config['MAX_CONTENT_LENGTH']:
+            raise UploadError('Invalid file size')
+        self._maybe_sweep()
+        row = self._row(upload_id, user)
+        now = time.time()
+        if row and row[0] != size:
+            raise UploadError('Upload id does not match the file size', 409)
+        if row and row[2] and os.path.exists(os.path.join(self._dir(upload_id, user), 'file')):
+            db_write('UPDATE uploads SET last_used = ? WHERE id = ? AND user = ?', (now, upload_id, user))
+            missing = []
+        else:
+            if row is None:
+                used = db().execute('SELECT COALESCE(SUM(size), 0) FROM uploads WHERE user = ?',
+                                    (user,)).fetchone()[0]
+                if used + size > UPLOAD_QUOTA_BYTES:
+                    raise UploadError('Upload quota exceeded; try again later', 429)
+                db_write('INSERT OR IGNORE INTO uploads (id, user, name, content_type, size, chunk_size, created, '
+                         'last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (upload_id, user, name, content_type, size, self.chunk_size, now, now))
+                row = self._row(upload_id, user)
+            elif row[2]:
+                # Marked complete but the file is gone (cleaned up by hand): take it again
+                db_write('UPDATE uploads SET complete = 0, last_used = ? WHERE id = ? AND user = ?',
+                         (now, upload_id, user))
+            os.makedirs(self._dir(upload_id, user), exist_ok=True)
+            missing = self._missing(upload_id, user, size, row[1])
+        skipped = size - sum(min(row[1], size - i * row[1]) for i in missing)
+        with self._lock:
+            self.files += 1
+            self.files_skipped += not missing
+            self.chunks_skipped += max(-(-size // row[1]), 1) - len(missing)
+            self.bytes_skipped += skipped
+            self.original_bytes += original_size if isinstance(original_size, int) and original_size > size else size
+            self.stored_bytes += size
+        return {'id': upload_id, 'chunk_size': row[1], 'missing': missing, 'complete': not missing}
+
+    def put_chunk(self, upload_id, user, index, stream):
+        """Stores chunk index of user's upload from stream; assembles the file once every chunk is there."""
+        row = self._row(upload_id, user)
+        if row is None:
+            raise UploadError('Unknown upload; start it again', 404)
+        size, chunk_size, complete = row[0], row[1], row[2]
+        # Every chunk counts as use, so a slow upload is not swept while it is still arriving
+        db_write('UPDATE uploads SET last_used = ? WHERE id = ? AND user = ?', (time.time(), upload_id, user))
+        if complete:
+            return {'complete': True}
+        expected = min(chunk_size, size - index * chunk_size)
+        if index < 0 or expected <= 0:
+            raise UploadError('Chunk index out of range')
+        directory = self._dir(upload_id, user)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as tmp:
+            received = 0
+            for block in iter(lambda: stream.read(64 * 1024), b''):
+                received += len(block)
+                if received > expected:
+                    break
+                tmp.write(block)
+        if received != expected:
+            os.unlink(tmp.name)
+            raise UploadError(f'Chunk {index} should be {expected} bytes')
+        os.replace(tmp.name, os.path.join(directory, f'{index}.part'))
+        with self._lock:
+            self.chunks_received += 1
+            self.bytes_received += received
+        missing = self._missing(upload_id, user, size, chunk_size)
+        if not missing:
+            self._assemble(upload_id, user, size, chunk_size)
+        return {'complete': not missing, 'missing': len(missing)}
+
+    @blocking
+    def _assemble(self, upload_id, user, size, chunk_size):
+        directory = self._dir(upload_id, user)
+        target = os.path.join(directory, 'file')
+        digest = hashlib.sha256()
+        out = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as out:
+                for i in range(max(-(-size // chunk_size), 1)):
+                    with open(os.path.join(directory, f'{i}.part'), 'rb') as part:
+                        for block in iter(lambda: part.read(1024 * 1024), b''):
+                            digest.update(block)
+                            out.write(block)
+        except FileNotFoundError:
+            # Another worker assembled it first and removed the chunks (or the directory itself)
+            if out is not None and os.path.exists(out.name):
+                os.unlink(out.name)
+            if os.path.exists(target):
+                return
+            raise UploadError('Upload incomplete; start it again', 409)
+        if digest.hexdigest() != upload_id:
+            os.unlink(out.name)
+            shutil.rmtree(directory, ignore_errors=True)
+            db_write('DELETE FROM uploads WHERE id = ? AND user = ?', (upload_id, user))
+            raise UploadError('Upload did not match its checksum; start it again', 409)
+        os.replace(out.name, target)
+        for name in os.listdir(directory):
+            if name.endswith('.part'):
+                os.unlink(os.path.join(directory, name))
+        db_write('UPDATE uploads SET complete = 1, last_used = ? WHERE id = ? AND user = ?',
+                 (time.time(), upload_id, user))
+
+    def open(self, upload_id, user, name=None):
+        """user's stored file as a FileStorage, like one from request.files."""
+        row = self._row(upload_id, user)
+        path = os.path.join(self._dir(upload_id, user), 'file')
+        if row is None or not row[2] or not os.path.exists(path):
+            raise UploadError('Uploaded file has expired; please upload it again', 404)
+        db_write('UPDATE uploads SET last_used = ? WHERE id = ? AND user = ?', (time.time(), upload_id, user))
+        return FileStorage(stream=open(path, 'rb'), filename=name or upload_id, content_type=row[3])
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < UPLOAD_SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        self.sweep(now - UPLOAD_TTL)
+
+    @blocking
+    def sweep(self, before):
+        self._init_schema()
+        expired = db().execute('SELECT id, user FROM uploads WHERE last_used < ?', (before,)).fetchall()
+        for upload_id, user in expired:
+            shutil.rmtree(self._dir(upload_id, user), ignore_errors=True)
+            try:
+                os.rmdir(self._user_dir(user))  # only once the user has no uploads left
+            except OSError:
+                pass
+        db().execute('DELETE FROM uploads WHERE last_used < ?', (before,))
+        return len(expired)
+
+    def stats(self):
+        return {
+            'files': self.files,
+            'files_already_stored': self.files_skipped,
+            'chunks_received': self.chunks_received,
+            'chunks_already_stored': self.chunks_skipped,
+            'bytes_received': self.bytes_received,
+            'bytes_skipped': self.bytes_skipped,
+            'bytes_saved_by_client_compression': self.original_bytes - self.stored_bytes,
+        }
+
+
+upload_store = UploadStore()
+STATS_PROVIDERS['uploads'] = upload_store.stats
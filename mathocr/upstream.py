@@ -0,0 +1,348 @@
+"""Calling OpenAI: deadlines, retries, hedging and a circuit breaker around every call.
+
+call_openai() is the one place OpenAI is called from. After admission it runs the call under a
+per-route deadline (queueing for admission is not counted), retries connection errors, timeouts,
+408/409/429 and 5xx replies with full-jitter exponential backoff (honouring Retry-After), and
+stops early through a per-process circuit breaker: OPENAI_BREAKER_THRESHOLD consecutive upstream
+failures open it for OPENAI_BREAKER_COOLDOWN seconds, after which one probe call decides whether
+it closes again. Calls on the OPENAI_HEDGE_ROUTES routes send a second copy of a request that is
+slower than the route's recent p95 and take whichever answer comes first. Analysis is not hedged
+by default because its long image prompts make a duplicate call expensive.
+"""
+import os
+import time
+import random
+from collections import deque
+import httpx
+from openai import APIConnectionError, APIResponseValidationError, APIStatusError, RateLimitError
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from mathocr.admission import (ADMISSION_MAX_WAIT, UpstreamBusyError, admission, count_image_bytes,
+                               estimate_tokens, upstream_context, upstream_user)
+from mathocr.config import ANALYZE_MODEL
+from mathocr.metrics import usage_meter
+from mathocr.openai_client import openai_clients
+from mathocr.stats import STATS_PROVIDERS
+
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 3))
+OPENAI_RETRY_BASE = 0.5
+OPENAI_RETRY_CAP = 8.0
+OPENAI_DEADLINES = {
+    'analyze': float(os.environ.get('OPENAI_DEADLINE_ANALYZE', 150)),
+    'reanalyze': float(os.environ.get('OPENAI_DEADLINE_REANALYZE', 45)),
+    'practice': float(os.environ.get('OPENAI_DEADLINE_PRACTICE', 60)),
+}
+OPENAI_DEFAULT_DEADLINE = 120
+OPENAI_HEDGE_ROUTES = {route for route in os.environ.get('OPENAI_HEDGE_ROUTES', 'reanalyze,practice').split(',') if route}
+OPENAI_HEDGE_AFTER = float(os.environ.get('OPENAI_HEDGE_AFTER', 10))  # until a route has enough latency samples
+OPENAI_HEDGE_MIN_SAMPLES = 20
+OPENAI_BREAKER_THRESHOLD = int(os.environ.get('OPENAI_BREAKER_THRESHOLD', 5))
+OPENAI_BREAKER_COOLDOWN = float(os.environ.get('OPENAI_BREAKER_COOLDOWN', 30))
+_hedge_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='openai-hedge')
+
+
+class UpstreamUnavailableError(UpstreamBusyError):
+    """OpenAI is failing or the circuit breaker is open."""
+    status = 503
+
+    def __init__(self, message='The AI service is having trouble right now. Please try again shortly.',
+                 retry_after=OPENAI_BREAKER_COOLDOWN):
+        super().__init__(message, retry_after=int(retry_after))
+
+
+class UpstreamTimeoutError(UpstreamUnavailableError):
+    """An OpenAI call ran past its route deadline."""
+    status = 504
+
+    def __init__(self, message='The AI took too long to answer. Please try again.', retry_after=5):
+        super().__init__(message, retry_after=retry_after)
+
+
+def _is_retryable(e):
+    if isinstance(e, APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(e, RateLimitError):
+        return getattr(e, 'code', None) != 'insufficient_quota'
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409) or e.status_code >= 500
+    return False
+
+
+def _answered(e):
+    # OpenAI replied, even if only to refuse the request or with a body the client could not read
+    return isinstance(e, (APIStatusError, APIResponseValidationError))
+
+
+def _retry_delay(e, attempt):
+    response = getattr(e, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), OPENAI_RETRY_CAP)
+    except ValueError:
+        pass
+    return random.uniform(0, min(OPENAI_RETRY_CAP, OPENAI_RETRY_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=OPENAI_BREAKER_THRESHOLD, cooldown=OPENAI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.state == 'open' and time.monotonic() - self.opened_at < self.cooldown
+
+    def reject(self):
+        """True (and counted) if the breaker is open, so a call can fail before it queues for admission."""
+        with self._lock:
+            if not self.is_open():
+                return False
+            self.rejected += 1
+            return True
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = 'half_open'
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Frees the half-open probe after a call that never reached OpenAI, without counting it either way."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print("✅ OpenAI circuit breaker closed")
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                print(f"⚠️ OpenAI circuit breaker opened after {self.failures} failures")
+
+    def stats(self):
+        return {
+            'state': 'open' if self.is_open() else ('closed' if self.state == 'closed' else 'half_open'),
+            'consecutive_failures': self.failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
+
+
+class UpstreamStats:
+    COUNTERS = ('calls', 'attempts', 'retries', 'hedged', 'hedge_wins', 'timeouts', 'failures')
+
+    def __init__(self):
+        self.routes = {}
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def count(self, route, counter, n=1):
+        with self._lock:
+            self.routes.setdefault(route, dict.fromkeys(self.COUNTERS, 0))[counter] += n
+
+    def latency(self, route, seconds):
+        with self._lock:
+            self.latencies.setdefault(route, deque(maxlen=200)).append(seconds)
+
+    def percentile(self, route, pct):
+        samples = sorted(self.latencies.get(route, ()))
+        return samples[min(len(samples) - 1, int(len(samples) * pct))] if samples else None
+
+    def hedge_delay(self, route):
+        if len(self.latencies.get(route, ())) < OPENAI_HEDGE_MIN_SAMPLES:
+            return OPENAI_HEDGE_AFTER
+        return self.percentile(route, 0.95)
+
+    def stats(self):
+        result = {'breaker': upstream_breaker.stats(), 'max_retries': OPENAI_MAX_RETRIES,
+                  'hedge_routes': sorted(OPENAI_HEDGE_ROUTES)}
+        for route, counts in self.routes.items():
+            p50, p95 = self.percentile(route, 0.5), self.percentile(route, 0.95)
+            result[route] = dict(counts, deadline=OPENAI_DEADLINES.get(route, OPENAI_DEFAULT_DEADLINE),
+                                 p50_seconds=round(p50, 2) if p50 is not None else None,
+                                 p95_seconds=round(p95, 2) if p95 is not None else None)
+        return result
+
+
+upstream_breaker = CircuitBreaker()
+upstream_stats = UpstreamStats()
+STATS_PROVIDERS['upstream'] = upstream_stats.stats
+
+
+def _with_retries(route, create, deadline):
+    """Calls create(timeout) until it succeeds, fails for good, or the deadline passes."""
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            upstream_stats.count(route, 'timeouts')
+            raise UpstreamTimeoutError()
+        if not upstream_breaker.allow():
+            upstream_stats.count(route, 'failures')
+            raise UpstreamUnavailableError()
+        upstream_stats.count(route, 'attempts')
+        started = time.monotonic()
+        try:
+            response = create(httpx.Timeout(remaining, connect=min(remaining, openai_clients.connect_timeout)))
+        except Exception as e:
+            if not _is_retryable(e):
+                if _answered(e):
+                    # OpenAI answered, so it is up even though it refused this request
+                    upstream_breaker.success()
+                else:
+                    # A local error (building the request, a bug) says nothing about OpenAI
+                    upstream_breaker.release()
+                raise
+            upstream_breaker.failure()
+            delay = _retry_delay(e, attempt)
+            if time.monotonic() + delay >= deadline:
+                upstream_stats.count(route, 'timeouts')
+                raise UpstreamTimeoutError() from e
+            if attempt >= OPENAI_MAX_RETRIES:
+                upstream_stats.count(route, 'failures')
+                print(f"⚠️ {route}: giving up after {attempt + 1} attempts: {str(e)}")
+                raise UpstreamUnavailableError() from e
+            attempt += 1
+            upstream_stats.count(route, 'retries')
+            print(f"⚠️ {route}: {type(e).__name__}, retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        upstream_breaker.success()
+        upstream_stats.latency(route, time.monotonic() - started)
+        return response
+
+
+def _admitted(route, create, deadline, slot_id, estimated_tokens):
+    # Runs one hedge leg and frees its admission slot with the real usage when it finishes
+    response = None
+    try:
+        response = _with_retries(route, create, deadline)
+        return response
+    finally:
+        admission.release(slot_id, estimated_tokens, getattr(response, 'usage', None))
+
+
+def _hedged(route, create, deadline, slot_id, user, estimated_tokens):
+    primary = _hedge_pool.submit(_admitted, route, create, deadline, slot_id, estimated_tokens)
+    try:
+        return primary.result(timeout=upstream_stats.hedge_delay(route))
+    except FuturesTimeoutError:
+        pass
+    legs = [primary]
+    try:
+        # Only hedge with spare capacity: never queue for a second slot
+        hedge_slot = admission.acquire(user, estimated_tokens, 0, quiet=True)
+        upstream_stats.count(route, 'hedged')
+        legs.append(_hedge_pool.submit(_admitted, route, create, deadline, hedge_slot, estimated_tokens))
+    except UpstreamBusyError:
+        pass
+    try:
+        for future in as_completed(legs, timeout=max(0, deadline - time.monotonic())):
+            if future.exception() is None:
+                if future is not primary:
+                    upstream_stats.count(route, 'hedge_wins')
+                return future.result()
+    except FuturesTimeoutError:
+        # A leg that ignores its timeout is left to finish in the background
+        upstream_stats.count(route, 'timeouts')
+        raise UpstreamTimeoutError()
+    return primary.result()
+
+
+def _stream_with_slot(stream, route, deadline, slot_id, estimated_tokens, on_done):
+    usage = None
+    outcome = 'ok'
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                usage = chunk.usage
+            yield chunk
+            if time.monotonic() > deadline:
+                upstream_stats.count(route, 'timeouts')
+                raise UpstreamTimeoutError()
+    except GeneratorExit:
+        outcome = 'cancelled'
+        raise
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        admission.release(slot_id, estimated_tokens, usage)
+        on_done(outcome, usage)
+        if hasattr(stream, 'close'):
+            stream.close()
+
+
+def call_openai(client, route, **kwargs):
+    """client.chat.completions.create() behind admission control, retries, deadline and breaker.
+
+    Streaming responses keep their admission slot until the stream has been consumed or closed;
+    only opening the stream is retried.
+    """
+    upstream_stats.count(route, 'calls')
+    if upstream_breaker.reject():
+        raise UpstreamUnavailableError()
+    user = upstream_user()
+    max_wait = getattr(upstream_context, 'max_wait', None) or ADMISSION_MAX_WAIT
+    estimated_tokens = estimate_tokens(kwargs)
+    model = kwargs.get('model', ANALYZE_MODEL)
+    image_bytes = count_image_bytes(kwargs)
+    stream = kwargs.get('stream', False)
+    if stream:
+        kwargs.setdefault('stream_options', {'include_usage': True})
+
+    def create(timeout):
+        response = client.chat.completions.create(timeout=timeout, **kwargs)
+        if not stream:
+            # Every completed attempt is billed, hedges included
+            usage_meter.record_usage(route, model, user, getattr(response, 'usage', None))
+        return response
+
+    def finished(outcome, usage=None):
+        if usage is not None:
+            usage_meter.record_usage(route, model, user, usage)
+        usage_meter.record_call(route, model, user, outcome, time.monotonic() - started, image_bytes)
+
+    slot_id = admission.acquire(user, estimated_tokens, max_wait)
+    started = time.monotonic()
+    deadline = started + OPENAI_DEADLINES.get(route, OPENAI_DEFAULT_DEADLINE)
+    try:
+        if not stream:
+            if route in OPENAI_HEDGE_ROUTES:
+                response = _hedged(route, create, deadline, slot_id, user, estimated_tokens)
+            else:
+                response = _admitted(route, create, deadline, slot_id, estimated_tokens)
+            finished('ok')
+            return response
+        response = _with_retries(route, create, deadline)
+    except Exception as e:
+        if stream:
+            admission.release(slot_id, estimated_tokens)
+        finished(type(e).__name__)
+        raise
+    return _stream_with_slot(response, route, deadline, slot_id, estimated_tokens, finished)
@@ -0,0 +1,46 @@
+"""The tests run against a throwaway database and directories, set before the app modules are imported."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix='math-ocr-tests-')
+os.environ['MATH_OCR_DB'] = os.path.join(_tmp, 'math_ocr.db')
+os.environ['LOGIN_LOG_FILE'] = os.path.join(_tmp, 'login_logs.json')
+os.environ['UPLOAD_DIR'] = os.path.join(_tmp, 'uploads')
+os.environ['JOB_DIR'] = os.path.join(_tmp, 'jobs')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app():
+    import NgrokTest
+    NgrokTest.app.config['TESTING'] = True
+    return NgrokTest.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """login(user, **values) makes client's session that user's (anonymous without one) and returns client."""
+    def login(user=None, **values):
+        with client.session_transaction() as session:
+            session.clear()
+            if user:
+                session['user'] = user
+                session['logged_in'] = True
+            session.update(values)
+        return client
+    return login
+
+
+@pytest.fixture
+def logged_in(login, request):
+    # A user of its own per test, so quotas and per-user rows never leak between tests
+    return login(f'tester-{request.node.name}')
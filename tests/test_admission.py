@@ -0,0 +1,28 @@
+"""Admission control: round-robin order between users and how long it remembers them."""
+from mathocr import admission
+from mathocr.admission import AdmissionController
+
+
+def _unlimited():
+    return AdmissionController(max_concurrency=0, tokens_per_minute=0)
+
+
+def test_user_admitted_longest_ago_goes_first():
+    controller = _unlimited()
+    for user in ('busy', 'quiet', 'busy'):
+        controller.release(controller.acquire(user, 100, max_wait=1), 100)
+    with controller._cond:
+        controller._waiting.update({'busy': [10], 'quiet': [11]})
+        assert controller._my_turn('quiet', 11)
+        assert not controller._my_turn('busy', 10)
+        controller._waiting.clear()
+
+
+def test_idle_users_are_forgotten(monkeypatch):
+    controller = _unlimited()
+    for user in ('a', 'b', 'c'):
+        controller.release(controller.acquire(user, 100, max_wait=1), 100)
+    assert list(controller._last_admitted) == ['a', 'b', 'c']
+    monkeypatch.setattr(admission, 'ADMISSION_FAIRNESS_MEMORY', 0)
+    controller.release(controller.acquire('b', 100, max_wait=1), 100)
+    assert list(controller._last_admitted) == ['b']
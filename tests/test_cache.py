@@ -0,0 +1,96 @@
+"""The result cache: eviction, expiry, the shared SQLite backend and content digests."""
+import io
+import threading
+import uuid
+
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from mathocr import cache
+from mathocr.cache import LRUCache, ResultCache, SQLiteCache, file_digest
+
+
+def _upload(fmt='PNG', **options):
+    img = Image.new('RGB', (64, 48), (250, 250, 250))
+    img.paste((20, 20, 20), (10, 10, 30, 20))
+    out = io.BytesIO()
+    img.save(out, fmt, **options)
+    return FileStorage(stream=io.BytesIO(out.getvalue()), filename=f'page.{fmt.lower()}')
+
+
+def test_lru_evicts_the_least_recently_used():
+    lru = LRUCache(max_entries=2, ttl=0)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    lru.get('a')
+    lru.set('c', 3)
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (1, 3)
+
+
+def test_lru_entries_expire(monkeypatch):
+    lru = LRUCache(ttl=60)
+    lru.set('a', 1)
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, 'time', lambda: now + 61)
+    assert lru.get('a') is None
+    assert len(lru) == 0
+
+
+def test_sqlite_entries_are_shared_and_expire(monkeypatch):
+    table = f'test_cache_{uuid.uuid4().hex}'
+    SQLiteCache(ttl=60, table=table).set('key', {'questions': [1]})
+    # A second instance, as in another worker on the host, sees the entry
+    assert SQLiteCache(ttl=60, table=table).get('key') == {'questions': [1]}
+    now = cache.time.time()
+    monkeypatch.setattr(cache.time, 'time', lambda: now + 61)
+    assert SQLiteCache(ttl=60, table=table).get('key') is None
+
+
+def test_sqlite_keeps_the_most_recently_used():
+    backend = SQLiteCache(max_entries=2, ttl=0, table=f'test_cache_{uuid.uuid4().hex}')
+    for key in 'abc':
+        backend.set(key, key)
+    assert len(backend) == 2
+    assert backend.get('a') is None
+
+
+def test_counters_add_up_across_threads():
+    counted = ResultCache(LRUCache())
+    counted.set('hit', 1)
+
+    def lookups():
+        for _ in range(500):
+            counted.get('hit')
+            counted.get('miss')
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = counted.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_ratio']) == (4000, 4000, 0.5)
+
+
+def test_backend_errors_count_as_misses():
+    class Broken:
+        def get(self, key):
+            raise OSError('disk full')
+    counted = ResultCache(Broken())
+    assert counted.get('key') is None
+    assert (counted.errors, counted.misses) == (1, 1)
+
+
+def test_re_encoded_page_has_the_same_digest():
+    assert file_digest(_upload()) == file_digest(_upload(compress_level=0))
+    assert file_digest(_upload()) == file_digest(_upload('TIFF'))
+    assert file_digest(_upload()) != file_digest(_upload('JPEG'))  # lossy: different pixels
+
+
+def test_digest_leaves_the_stream_rewound():
+    upload = _upload()
+    file_digest(upload)
+    assert upload.stream.tell() == 0
+    pdf = FileStorage(stream=io.BytesIO(b'%PDF-1.4 not an image'), filename='a.pdf')
+    assert len(file_digest(pdf)) == 64
+    assert pdf.stream.tell() == 0
@@ -0,0 +1,80 @@
+"""Stored pages and question crops are served only to the user who ran the analysis."""
+import io
+import uuid
+
+import pytest
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from mathocr.analysis import collect_pages
+from mathocr.cache import analysis_cache_key, cached_analysis, file_digest, store_analysis
+from mathocr.crops import analysis_pages
+from mathocr.database import db
+from mathocr.pages import page_index
+
+
+def _page():
+    out = io.BytesIO()
+    Image.new('RGB', (400, 600), (250, 250, 250)).save(out, 'PNG')
+    return out.getvalue()
+
+
+@pytest.fixture
+def analysis_id():
+    analysis_id = uuid.uuid4().hex
+    analysis_pages.save_page(analysis_id, 'a.png', _page(), 'crop-owner')
+    analysis_pages.remember(analysis_id, [{'number': '1', 'image_file': 'a.png',
+                                           'error_bbox': {'x': 0.1, 'y': 0.1, 'width': 0.5, 'height': 0.3}}])
+    return analysis_id
+
+
+def test_owner_gets_the_page(login, analysis_id):
+    reply = login('crop-owner').get(f'/analyses/{analysis_id}/page?name=a.png')
+    assert reply.status_code == 200
+    assert Image.open(io.BytesIO(reply.data)).size == (400, 600)
+
+
+def test_page_is_not_found_for_anyone_else(login, analysis_id):
+    assert login('crop-other').get(f'/analyses/{analysis_id}/page?name=a.png').status_code == 404
+    assert login().get(f'/analyses/{analysis_id}/page?name=a.png').status_code == 404
+
+
+def test_crop_only_for_the_owner(analysis_id):
+    assert analysis_pages.crop(analysis_id, '1', 'crop-owner') is not None
+    assert analysis_pages.crop(analysis_id, '1', 'crop-other') is None
+    assert analysis_pages.crop(analysis_id, '1', None) is None
+
+
+def test_pages_are_kept_only_for_a_logged_in_user():
+    owned, anonymous = uuid.uuid4().hex, uuid.uuid4().hex
+    for analysis_id, user in ((owned, 'crop-owner'), (anonymous, None)):
+        upload = FileStorage(stream=io.BytesIO(_page()), filename='a.png', content_type='image/png')
+        collect_pages([upload], user=user, analysis_id=analysis_id)
+    assert analysis_pages.page(owned, 'a.png', 'crop-owner') is not None
+    assert db().execute('SELECT COUNT(*) FROM analysis_pages WHERE analysis_id = ?', (anonymous,)).fetchone()[0] == 0
+
+
+def _upload():
+    return FileStorage(stream=io.BytesIO(_page()), filename='a.png', content_type='image/png')
+
+
+def test_reused_page_belongs_to_the_new_analysis():
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    _, _, page_prints, _ = collect_pages([_upload()], user='crop-reuser', analysis_id=first)
+    questions = [{'number': '1', 'image_file': 'a.png',
+                  'error_bbox': {'x': 0.1, 'y': 0.1, 'width': 0.5, 'height': 0.3}}]
+    analysis_pages.remember(first, questions)
+    page_index.remember('crop-reuser', page_prints, ['a.png'], questions)
+    _, reused, _, report = collect_pages([_upload()], user='crop-reuser', analysis_id=second)
+    assert report['reused'] == 1
+    assert [q['analysis_id'] for q in reused] == [second]
+    assert analysis_pages.crop(second, '1', 'crop-reuser') is not None
+
+
+def test_cache_hits_carry_no_analysis_id():
+    upload = _upload()
+    digests = [file_digest(upload)]
+    key = analysis_cache_key(digests)
+    store_analysis(key, digests, [upload], [{'number': '1', 'image_file': 'a.png', 'analysis_id': uuid.uuid4().hex}])
+    renamed = FileStorage(stream=io.BytesIO(_page()), filename='b.png', content_type='image/png')
+    assert cached_analysis(key, digests, [renamed]) == [{'number': '1', 'image_file': 'b.png'}]
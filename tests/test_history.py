@@ -0,0 +1,58 @@
+"""The analysis history sidebar: paging with the before cursor, per-user trimming and privacy."""
+import itertools
+
+import pytest
+
+from mathocr import history
+from mathocr.history import analysis_history
+
+QUESTIONS = [{'number': '1', 'status': 'correct'}, {'number': '2', 'status': 'incorrect'}]
+
+
+@pytest.fixture
+def saved(logged_in, monkeypatch):
+    # Five analyses one second apart, oldest first
+    clock = itertools.count(1_700_000_000)
+    monkeypatch.setattr(history.time, 'time', lambda: float(next(clock)))
+    with logged_in.session_transaction() as session:
+        user = session['user']
+    return [analysis_history.add(user, [f'page{i}.png'], QUESTIONS) for i in range(5)]
+
+
+def test_before_cursor_pages_through_everything_once(logged_in, saved):
+    seen, query = [], {'limit': 2}
+    while True:
+        body = logged_in.get('/history', query_string=query).get_json()
+        seen += [entry['id'] for entry in body['analyses']]
+        if body['next_before'] is None:
+            break
+        query['before'] = body['next_before']
+    assert seen == saved[::-1]
+
+
+def test_last_full_page_still_offers_a_cursor(logged_in, saved):
+    body = logged_in.get('/history', query_string={'limit': 5}).get_json()
+    assert len(body['analyses']) == 5 and body['next_before'] == body['analyses'][-1]['created']
+    assert logged_in.get('/history', query_string={'limit': 5, 'before': body['next_before']}).get_json() == {
+        'analyses': [], 'next_before': None}
+
+
+def test_entries_carry_their_summary(logged_in, saved):
+    entry = logged_in.get('/history', query_string={'limit': 1}).get_json()['analyses'][0]
+    assert entry['title'] == 'page4.png' and entry['counts'] == {'correct': 1, 'partial': 0, 'incorrect': 1}
+    assert logged_in.get(f"/history/{entry['id']}").get_json()['questions'] == QUESTIONS
+
+
+def test_only_the_newest_are_kept(logged_in, saved, monkeypatch):
+    monkeypatch.setattr(history, 'ANALYSIS_HISTORY_PER_USER', 3)
+    with logged_in.session_transaction() as session:
+        newest = analysis_history.add(session['user'], ['page5.png'], QUESTIONS)
+    ids = [entry['id'] for entry in logged_in.get('/history').get_json()['analyses']]
+    assert ids == [newest] + saved[:2:-1]
+
+
+def test_history_is_private(login, saved):
+    other = login('history-other')
+    assert other.get('/history').get_json()['analyses'] == []
+    assert other.get(f'/history/{saved[0]}').status_code == 404
+    assert login().get('/history').status_code == 401
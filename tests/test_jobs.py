@@ -0,0 +1,34 @@
+"""Background job status is answered only to the user or anonymous session that submitted the job."""
+import uuid
+
+from mathocr.jobs import job_queue
+
+RESULT = {'questions': [{'number': '1'}], 'count': 1}
+
+
+def _finished_job(user=None):
+    return job_queue.submit('analyze', {}, user=user, job_id=uuid.uuid4().hex, result=RESULT)
+
+
+def test_owner_reads_the_result(login):
+    job_id = _finished_job('job-owner')
+    reply = login('job-owner').get(f'/jobs/{job_id}')
+    assert reply.status_code == 200
+    assert reply.get_json()['result'] == RESULT
+
+
+def test_other_users_get_not_found(login):
+    job_id = _finished_job('job-owner')
+    assert login('job-other').get(f'/jobs/{job_id}').status_code == 404
+    assert login().get(f'/jobs/{job_id}').status_code == 404
+
+
+def test_anonymous_job_belongs_to_its_session(login):
+    job_id = _finished_job()
+    assert login(jobs=[job_id]).get(f'/jobs/{job_id}').status_code == 200
+    assert login().get(f'/jobs/{job_id}').status_code == 404
+    assert login('job-other', jobs=[job_id]).get(f'/jobs/{job_id}').status_code == 404
+
+
+def test_unknown_job_looks_the_same(login):
+    assert login('job-owner').get(f'/jobs/{uuid.uuid4().hex}').get_json() == {'error': 'Job not found'}
@@ -0,0 +1,91 @@
+"""Importing the legacy JSON login log: damaged files, interrupted imports and double imports."""
+import json
+import os
+
+import pytest
+
+from mathocr import login_log
+from mathocr.database import db
+
+
+def _entries(prefix, n):
+    return [{'username': f'{prefix}{i}', 'timestamp': f'2024-01-0{i + 1}T08:00:00', 'ip': '10.0.0.1',
+             'user_agent': 'test'} for i in range(n)]
+
+
+def _imported(prefix):
+    return [row[0] for row in db().execute('SELECT username FROM logins WHERE username LIKE ? ORDER BY username',
+                                           (prefix + '%',))]
+
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'login_logs.json')
+    monkeypatch.setattr(login_log, 'LOG_FILE', path)
+    return path
+
+
+def test_imports_the_legacy_file_once(log_file):
+    with open(log_file, 'w') as f:
+        json.dump(_entries('clean', 3), f)
+    login_log.LoginLog().start()
+    assert _imported('clean') == ['clean0', 'clean1', 'clean2']
+    assert not os.path.exists(log_file)
+    assert os.path.exists(log_file + '.migrated')
+    login_log.LoginLog().start()
+    assert len(_imported('clean')) == 3
+
+
+def test_truncated_file_is_salvaged_and_kept_as_corrupt(log_file):
+    text = json.dumps(_entries('trunc', 3))
+    with open(log_file, 'w') as f:
+        f.write(text[:text.rindex('{') + 12])  # cut off inside the third entry
+    login_log.LoginLog().start()
+    assert _imported('trunc') == ['trunc0', 'trunc1']
+    assert os.path.exists(log_file + '.corrupt')
+    assert not os.path.exists(log_file + '.migrating')
+
+
+def test_unreadable_file_is_kept_as_corrupt(log_file):
+    with open(log_file, 'wb') as f:
+        f.write(b'\x00\xffnot json')
+    login_log.LoginLog().start()
+    assert os.path.exists(log_file + '.corrupt')
+    assert not os.path.exists(log_file + '.migrating')
+
+
+def test_corrupt_file_does_not_overwrite_an_earlier_one(log_file):
+    for _ in range(2):
+        with open(log_file, 'w') as f:
+            f.write('[{"username": "again0"}, {"user')
+        login_log.LoginLog().start()
+    kept = [name for name in os.listdir(os.path.dirname(log_file)) if '.corrupt' in name]
+    assert len(kept) == 2
+
+
+def test_interrupted_import_is_resumed(log_file):
+    # A worker renamed the file and died before importing it
+    with open(log_file + '.migrating', 'w') as f:
+        json.dump(_entries('resumed', 2), f)
+    login_log.LoginLog().start()
+    assert _imported('resumed') == ['resumed0', 'resumed1']
+    assert os.path.exists(log_file + '.migrated')
+    assert not os.path.exists(log_file + '.migrating')
+
+
+def test_file_imported_before_a_crash_is_not_imported_again(log_file):
+    raw = json.dumps(_entries('crashed', 2))
+    with open(log_file, 'w') as f:
+        f.write(raw)
+    login_log.LoginLog().start()
+    # A worker imported it, then died before renaming it to .migrated
+    os.replace(log_file + '.migrated', log_file + '.migrating')
+    login_log.LoginLog().start()
+    assert _imported('crashed') == ['crashed0', 'crashed1']
+    assert os.path.exists(log_file + '.migrated')
+
+
+def test_parse_legacy_logins_skips_non_objects():
+    logins, damaged = login_log._parse_legacy_logins(b'[{"username": "a"}, 3, "x", {"username": "b"}]')
+    assert [login['username'] for login in logins] == ['a', 'b']
+    assert not damaged
@@ -0,0 +1,81 @@
+"""The login log pages: filtering /view-logs and exporting with /download-logs."""
+import gzip
+import json
+import re
+import uuid
+
+import pytest
+
+import NgrokTest
+from mathocr.login_log import login_log
+
+
+@pytest.fixture
+def logins():
+    # Four logins under a prefix of their own, so the filters only ever see this test's rows
+    prefix = f'log-{uuid.uuid4().hex[:8]}-'
+    login_log.start()
+    login_log._insert([(prefix + 'alice', '2024-02-01T08:00:00', '10.0.0.1', 'Firefox'),
+                       (prefix + 'alice', '2024-02-02T09:30:00', '10.0.0.2', 'Firefox'),
+                       (prefix + 'albert', '2024-02-01T23:59:00', '10.0.0.1', 'Safari'),
+                       (prefix + 'bob', '2024-02-03T07:00:00', '10.0.0.3', 'Chrome')])
+    return prefix
+
+
+def _shown(client, query):
+    html = client.get('/view-logs', query_string=query).get_data(as_text=True)
+    total = int(re.search(r'Total: (\d+)', html).group(1))
+    return total, re.findall(r'<strong>([^<]+)</strong>', html), html
+
+
+def test_username_is_a_prefix_filter(client, logins):
+    total, names, _ = _shown(client, {'username': logins + 'al'})
+    assert total == 3
+    assert sorted(set(names)) == [logins + 'albert', logins + 'alice']
+
+
+def test_a_bare_to_date_includes_the_whole_day(client, logins):
+    total, names, _ = _shown(client, {'username': logins, 'from': '2024-02-01', 'to': '2024-02-01'})
+    assert total == 2
+    assert sorted(names) == [logins + 'albert', logins + 'alice']
+
+
+def test_ip_filter(client, logins):
+    total, names, _ = _shown(client, {'username': logins, 'ip': ' 10.0.0.1 '})
+    assert total == 2
+    assert sorted(names) == [logins + 'albert', logins + 'alice']
+
+
+def test_sorting_and_pages(client, logins):
+    total, names, html = _shown(client, {'username': logins, 'sort': 'username', 'order': 'asc', 'per_page': 2})
+    assert total == 4
+    assert names == [logins + 'albert', logins + 'alice']
+    assert 'Page 1 of 2' in html
+    _, names, _ = _shown(client, {'username': logins, 'sort': 'username', 'order': 'asc', 'per_page': 2, 'page': 2})
+    assert names == [logins + 'alice', logins + 'bob']
+
+
+def test_filters_are_escaped_and_carried_to_the_export_links(client, logins):
+    total, _, html = _shown(client, {'username': logins + '"><script>', 'ip': '10.0.0.1'})
+    assert total == 0
+    assert '<script>' not in html
+    assert f'/download-logs?username={logins}%22%3E%3Cscript%3E&amp;ip=10.0.0.1' in html
+
+
+@pytest.mark.parametrize('fmt', ['json', 'jsonl', 'csv'])
+def test_gzip_export_round_trips(client, logins, monkeypatch, fmt):
+    monkeypatch.setattr(NgrokTest, 'LOGS_EXPORT_CHUNK', 64)  # several compressed chunks per export
+    query = {'username': logins, 'format': fmt}
+    plain = client.get('/download-logs', query_string=query)
+    packed = client.get('/download-logs', query_string=dict(query, gzip='1'))
+    assert packed.mimetype == 'application/gzip'
+    assert packed.headers['Content-Disposition'] == f'attachment; filename=math_ocr_logins.{fmt}.gz'
+    assert gzip.decompress(packed.data) == plain.data
+
+
+def test_export_keeps_the_filters(client, logins):
+    exported = client.get('/download-logs', query_string={'username': logins + 'al', 'ip': '10.0.0.1'})
+    assert [login['username'] for login in json.loads(exported.data)] == [logins + 'alice', logins + 'albert']
+    lines = client.get('/download-logs', query_string={'username': logins, 'format': 'csv'}).data.splitlines()
+    assert lines[0] == b'username,timestamp,ip,user_agent' and len(lines) == 5
+    assert client.get('/download-logs?format=xml').status_code == 400
@@ -0,0 +1,49 @@
+"""/metrics: metric names, labels and histogram layout, and the per-user spend under /metrics/costs."""
+from types import SimpleNamespace
+
+from mathocr.metrics import usage_cost, usage_meter
+
+
+def _series(text, name):
+    return [line for line in text.splitlines() if line.startswith(name + '{') or line.startswith(name + ' ')]
+
+
+def test_call_is_exposed_by_route_model_and_outcome(client):
+    usage_meter.record_call('test-metrics', 'gpt-5.1', 'metrics-user', 'ok', 0.3, image_bytes=1000)
+    usage_meter.record_usage('test-metrics', 'gpt-5.1', 'metrics-user',
+                             SimpleNamespace(prompt_tokens=1000, completion_tokens=200))
+    reply = client.get('/metrics')
+    assert reply.status_code == 200 and reply.mimetype == 'text/plain'
+    text = reply.get_data(as_text=True)
+    assert 'openai_requests_total{route="test-metrics",model="gpt-5.1",outcome="ok"} 1.0' in text
+    assert 'openai_image_bytes_total{route="test-metrics",model="gpt-5.1"} 1000.0' in text
+    assert 'openai_tokens_total{route="test-metrics",model="gpt-5.1",kind="prompt"} 1000.0' in text
+    assert 'openai_tokens_total{route="test-metrics",model="gpt-5.1",kind="completion"} 200.0' in text
+    assert 'metrics-user' not in text  # users are not a label
+    assert text.count('# TYPE openai_request_duration_seconds histogram') == 1
+
+
+def test_histogram_buckets_are_cumulative_and_ordered(client):
+    usage_meter.record_call('test-buckets', 'gpt-5.1', None, 'ok', 3.0)
+    text = client.get('/metrics').get_data(as_text=True)
+    buckets = [line for line in _series(text, 'openai_request_duration_seconds_bucket') if 'test-buckets' in line]
+    bounds = [line.split('le="')[1].split('"')[0] for line in buckets]
+    assert bounds[-1] == '+Inf' and [float(b) for b in bounds[:-1]] == sorted(float(b) for b in bounds[:-1])
+    counts = {bound: float(line.rsplit(' ', 1)[1]) for bound, line in zip(bounds, buckets)}
+    assert counts['2.5'] == 0.0 and counts['5'] == 1.0 and counts['+Inf'] == 1.0
+
+
+def test_label_values_are_escaped(client):
+    usage_meter.record_parse('test "quoted" \\ route', 0.01)
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'model_parse_duration_seconds_count{route="test \\"quoted\\" \\\\ route"} 1.0' in text
+
+
+def test_costs_per_user(client):
+    usage_meter.record_call('test-costs', 'gpt-5.1', 'costs-user', 'ok', 1.0)
+    usage_meter.record_usage('test-costs', 'gpt-5.1', 'costs-user',
+                             SimpleNamespace(prompt_tokens=2000, completion_tokens=500))
+    body = client.get('/metrics/costs?user=costs-user').get_json()
+    assert [row['user'] for row in body['users']] == ['costs-user']
+    assert body['users'][0]['routes'] == {'test-costs': round(usage_cost('gpt-5.1', 2000, 500), 6)}
+    assert client.get('/metrics/costs?from=yesterday').status_code == 400
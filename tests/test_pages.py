@@ -0,0 +1,73 @@
+"""Duplicate pages: exact digests by default, near matches only with PHASH_NEAR_MATCH and a pixel check."""
+import io
+import json
+
+import pytest
+from PIL import Image, ImageDraw
+
+from mathocr import pages
+
+
+def _worksheet(handwriting=False, compress_level=6):
+    # A printed worksheet; handwriting adds one small pencil answer to it
+    img = Image.new('L', (800, 1000), 255)
+    draw = ImageDraw.Draw(img)
+    for row in range(10):
+        draw.rectangle((60, 80 + row * 90, 740, 84 + row * 90), fill=0)
+        draw.rectangle((60, 100 + row * 90, 300, 120 + row * 90), fill=60)
+    if handwriting:
+        draw.rectangle((500, 400, 530, 430), fill=30)
+    out = io.BytesIO()
+    img.save(out, 'PNG', compress_level=compress_level)
+    return out.getvalue()
+
+
+@pytest.fixture
+def near_match(monkeypatch):
+    monkeypatch.setattr(pages, 'PHASH_NEAR_MATCH', True)
+
+
+def test_identical_pages_are_the_same():
+    assert pages.same_page(pages.page_fingerprint(_worksheet()), pages.page_fingerprint(_worksheet()))
+
+
+def test_similar_pages_are_not_merged_by_default():
+    blank, answered = pages.page_fingerprint(_worksheet()), pages.page_fingerprint(_worksheet(handwriting=True))
+    assert 'hash' not in blank
+    assert not pages.same_page(blank, answered)
+
+
+def test_near_match_needs_the_pixel_check(near_match):
+    blank, answered = pages.page_fingerprint(_worksheet()), pages.page_fingerprint(_worksheet(handwriting=True))
+    # The perceptual hashes alone would call two students' sheets the same page
+    assert pages._near(blank['hash'], answered['hash'])
+    assert not pages.same_page(blank, answered)
+
+
+def test_near_match_merges_a_re_encoded_page(near_match):
+    original, re_encoded = _worksheet(compress_level=1), _worksheet(compress_level=9)
+    assert original != re_encoded
+    assert pages.same_page(pages.page_fingerprint(original), pages.page_fingerprint(re_encoded))
+
+
+def test_page_index_is_per_user_and_exact():
+    page = pages.page_fingerprint(_worksheet())
+    questions = [{'number': '1', 'question': 'Solve $x+1=2$'}]
+    pages.page_index.remember('index-owner', {'a.png': page}, ['a.png'], questions)
+    assert json.loads(pages.page_index.find('index-owner', page)) == questions
+    assert pages.page_index.find('index-other', page) is None
+    assert pages.page_index.find('index-owner', pages.page_fingerprint(_worksheet(handwriting=True))) is None
+
+
+def test_page_index_near_match_is_pixel_checked(near_match):
+    blank = pages.page_fingerprint(_worksheet())
+    pages.page_index.remember('index-near', {'a.png': blank}, ['a.png'], [{'number': '1'}])
+    assert pages.page_index.find('index-near', pages.page_fingerprint(_worksheet(handwriting=True))) is None
+    assert pages.page_index.find('index-near', pages.page_fingerprint(_worksheet(compress_level=1))) is not None
+
+
+def test_only_single_page_analyses_are_remembered():
+    first, second = pages.page_fingerprint(_worksheet()), pages.page_fingerprint(_worksheet(handwriting=True))
+    pages.page_index.remember('index-multi', {'a.png': first, 'b.png': second}, ['a.png', 'b.png'],
+                              [{'number': '1'}])
+    assert pages.page_index.find('index-multi', first) is None
@@ -0,0 +1,39 @@
+"""Parsing model replies: streamed arrays, wrapper objects and salvaging truncated replies."""
+import json
+
+import pytest
+
+from mathocr.parsing import JSONArrayStream, ModelReplyError, parse_model_json, parse_stats
+
+QUESTIONS = [{'number': '1', 'question': 'x + 1 = 2'}, {'number': '2', 'question': 'Solve {a, b} "quoted" \\ [ ]'}]
+
+
+def test_stream_yields_objects_as_they_complete():
+    text = '```json\n' + json.dumps(QUESTIONS)
+    stream = JSONArrayStream()
+    seen = []
+    for i in range(0, len(text), 7):
+        seen.extend(stream.feed(text[i:i + 7]))
+    assert seen == QUESTIONS
+
+
+def test_stream_skips_a_broken_object():
+    assert JSONArrayStream().feed('[{"number": "1", oops}, {"number": "2"}]') == [{'number': '2'}]
+
+
+def test_truncated_array_is_salvaged():
+    text = json.dumps(QUESTIONS)
+    before = dict(parse_stats.counts.get('test-truncated', {}))
+    assert parse_model_json('test-truncated', text[:text.rindex('{') + 10]) == QUESTIONS[:1]
+    assert parse_stats.counts['test-truncated']['salvaged'] == before.get('salvaged', 0) + 1
+
+
+def test_wrapper_object_in_prose():
+    text = 'Here you go:\n```json\n' + json.dumps({'questions': QUESTIONS}) + '\n```'
+    assert parse_model_json('test-wrapper', text, key='questions') == QUESTIONS
+
+
+def test_nothing_usable_raises():
+    with pytest.raises(ModelReplyError):
+        parse_model_json('test-failed', 'I cannot read this page.')
+    assert parse_stats.counts['test-failed']['failed'] == 1
@@ -0,0 +1,53 @@
+"""Uploaded PDFs: pages are rendered, and a PDF that cannot be read fails the request."""
+import io
+
+import pymupdf
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from mathocr import analysis, pdf
+from mathocr.uploads import UploadError
+
+
+def _pdf(pages=2):
+    doc = pymupdf.open()
+    for n in range(pages):
+        doc.new_page(width=300, height=400).insert_text((50, 80), f'Question {n + 1}: solve x + {n} = 2')
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _upload(data, name='sheet.pdf'):
+    return FileStorage(stream=io.BytesIO(data), filename=name, content_type='application/pdf')
+
+
+def test_pages_are_rendered_in_order():
+    pages, total = pdf.rasterize_pdf(_upload(_pdf(3)))
+    assert total == 3
+    assert [label for label, _ in pages] == ['sheet.pdf (page 1)', 'sheet.pdf (page 2)', 'sheet.pdf (page 3)']
+    assert all(data[:2] == b'\xff\xd8' for _, data in pages)
+
+
+def test_one_deadline_for_the_whole_pdf(monkeypatch):
+    monkeypatch.setattr(pdf, 'PDF_TIMEOUT', 0)
+    with pytest.raises(TimeoutError):
+        pdf.rasterize_pdf(_upload(_pdf()))
+
+
+def test_unreadable_pdf_fails_the_request(client, monkeypatch):
+    def run_analysis(*args):
+        raise AssertionError('the model was called without the PDF')
+
+    monkeypatch.setattr(analysis, 'run_analysis', run_analysis)
+    reply = client.post('/analyze', data={'files': (io.BytesIO(b'%PDF-1.4 not really'), 'broken.pdf',
+                                                    'application/pdf')})
+    assert reply.status_code == 400
+    assert 'broken.pdf' in reply.get_json()['error']
+
+
+def test_slow_pdf_is_reported(monkeypatch):
+    monkeypatch.setattr(pdf, 'PDF_TIMEOUT', 0)
+    with pytest.raises(UploadError) as e:
+        analysis._file_pages(_upload(_pdf(), 'long.pdf'))
+    assert 'long.pdf took too long' in str(e.value)
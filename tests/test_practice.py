@@ -0,0 +1,86 @@
+"""The practice bank: serving from the bank, hit accounting and background top-ups."""
+import sqlite3
+import uuid
+
+import pytest
+
+from mathocr import practice
+from mathocr.practice import PRACTICE_BANK_MIN_VARIANTS, PRACTICE_BANK_TARGET_VARIANTS, PracticeBank
+
+
+def _questions(*numbers):
+    concept = uuid.uuid4().hex
+    return [{'number': n, 'question': f'Solve {concept} problem {n}'} for n in numbers]
+
+
+def _fill(bank, questions, variants):
+    for i in range(variants):
+        bank.add(questions, [{'number': q['number'], 'question': f"variant {i} of {q['number']}"} for q in questions])
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    jobs = []
+
+    def submit(kind, payload, user=None, job_id=None):
+        if job_id in [job[3] for job in jobs]:
+            raise sqlite3.IntegrityError('UNIQUE constraint failed: jobs.id')
+        jobs.append((kind, payload, user, job_id))
+    monkeypatch.setattr(practice.job_queue, 'submit', submit)
+    return jobs
+
+
+def test_concepts_below_the_minimum_are_generated():
+    bank, questions = PracticeBank(), _questions('1')
+    _fill(bank, questions, PRACTICE_BANK_MIN_VARIANTS - 1)
+    served, missing = bank.take(questions)
+    assert served == {} and missing == questions
+    assert (bank.requested, bank.hits) == (1, 0)
+
+
+def test_bank_serves_least_served_variants_first():
+    bank, questions = PracticeBank(), _questions('1', '2')
+    _fill(bank, questions[:1], PRACTICE_BANK_MIN_VARIANTS)
+    seen = []
+    for _ in range(PRACTICE_BANK_MIN_VARIANTS):
+        served, missing = bank.take(questions)
+        assert missing == questions[1:]
+        seen.append(served['1']['question'])
+    assert sorted(seen) == [f'variant {i} of 1' for i in range(PRACTICE_BANK_MIN_VARIANTS)]
+    stats = bank.stats()
+    assert (stats['questions_requested'], stats['served_from_bank'], stats['hit_rate']) == (6, 3, 0.5)
+    assert stats['tokens_saved_estimate'] == 3 * practice.PRACTICE_TOKENS_PER_QUESTION
+
+
+def test_topup_is_scheduled_once_for_short_concepts(submitted):
+    bank, questions = PracticeBank(), _questions('1', '2')
+    _fill(bank, questions[:1], PRACTICE_BANK_TARGET_VARIANTS)
+    bank.schedule_topup(questions, user='practice-user')
+    bank.schedule_topup(questions, user='practice-user')
+    assert [(kind, payload, user) for kind, payload, user, _ in submitted] == [
+        ('practice_topup', {'questions': questions[1:]}, 'practice-user')]
+
+
+def test_full_concepts_schedule_nothing(submitted):
+    bank, questions = PracticeBank(), _questions('1')
+    _fill(bank, questions, PRACTICE_BANK_TARGET_VARIANTS)
+    bank.schedule_topup(questions)
+    assert submitted == []
+
+
+def test_topup_job_fills_the_bank_to_the_target(monkeypatch):
+    questions = _questions('1')
+    calls = []
+
+    def generate(client, short):
+        calls.append(short)
+        _fill(practice.practice_bank, short, 2)
+        return short * 2
+    monkeypatch.setattr(practice, 'run_practice_generation', generate)
+    monkeypatch.setattr(practice, 'get_openai_client', lambda api_key: None)
+    result = practice._practice_topup_job('topup-test', {'questions': questions})
+    signature = practice._practice_signature(questions[0])
+    # Two variants per call until the target is reached, then no further call
+    assert len(calls) == -(-PRACTICE_BANK_TARGET_VARIANTS // 2)
+    assert practice.practice_bank.fresh_counts({signature})[signature] == len(calls) * 2
+    assert result == {'added': len(calls) * 2}
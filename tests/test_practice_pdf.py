@@ -0,0 +1,27 @@
+"""Practice PDFs: LaTeX to paragraph markup, escaping of text that looks like markup, and rendering."""
+from mathocr.practice_pdf import _latex_to_markup, _text_to_markup, render_practice_pdf
+
+
+def test_text_special_characters_are_escaped():
+    assert _text_to_markup('Tom & Jerry <b>shared</b> 3 < 5') == \
+        'Tom &amp; Jerry &lt;b&gt;shared&lt;/b&gt; 3 &lt; 5'
+
+
+def test_math_special_characters_are_escaped():
+    assert _text_to_markup('If $x < y & y > 2$') == 'If x &lt; y &amp; y &gt; 2'
+    assert _latex_to_markup(r'a \& b') == 'a &amp; b'
+
+
+def test_line_breaks_survive_escaping():
+    assert _text_to_markup('one<br>two < three<br/>four') == 'one<br/>two &lt; three<br/>four'
+
+
+def test_latex_is_converted():
+    assert _latex_to_markup(r'\frac{x+1}{2} \times y^{2}') == '(x+1)/2 × y<super>2</super>'
+    assert _latex_to_markup(r'\sqrt{a_1}') == '√(a<sub>1</sub>)'
+
+
+def test_markup_lookalikes_render():
+    pdf = render_practice_pdf([{'number': '<1>', 'question': 'Is $a < b$ & b <c> true?<br>Explain'},
+                               {'number': '2', 'question': 'Unclosed <para> & $\\frac{1}{'}])
+    assert pdf.startswith(b'%PDF')
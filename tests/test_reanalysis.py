@@ -0,0 +1,75 @@
+"""Follow-up questions: identical concurrent calls collapse into one, and the cache key ignores noise."""
+import threading
+import time
+
+import pytest
+
+from mathocr.reanalysis import SingleFlight, reanalysis_key
+
+QUESTION = {'question': 'Solve x + 1 = 2', 'student_original': 'x = 3', 'error': 'Sign',
+            'correct_solution': 'x = 1', 'user_query': 'Why is it wrong?'}
+
+
+def _together(flight, fn, n=5):
+    # Starts n identical calls and lets fn finish only once they have all joined
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(flight.do('same', fn))
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=call) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def _wait_for_followers(flight, n):
+    while flight.followers < n:
+        time.sleep(0.01)
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    flight, release, calls = SingleFlight(), threading.Event(), []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {'status': 'correct'}
+    threads, results, errors = _together(flight, fn)
+    _wait_for_followers(flight, 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{'status': 'correct'}] * 5 and not errors
+    assert flight.stats() == {'in_flight': 0, 'upstream_calls': 1, 'collapsed': 4}
+
+
+def test_followers_get_the_leaders_error():
+    flight, release = SingleFlight(), threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError('upstream failed')
+    threads, results, errors = _together(flight, fn, n=3)
+    _wait_for_followers(flight, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert not results and [str(e) for e in errors] == ['upstream failed'] * 3
+    # The failed call is forgotten; the next one runs again
+    assert flight.do('same', lambda: 'retried') == 'retried'
+
+
+def test_key_ignores_whitespace_and_query_case():
+    noisy = dict(QUESTION, question='  Solve  x + 1 = 2\n', user_query='WHY is it   wrong?')
+    assert reanalysis_key(noisy) == reanalysis_key(QUESTION)
+    assert reanalysis_key(dict(QUESTION, student_original='X = 3')) != reanalysis_key(QUESTION)
+    assert reanalysis_key(QUESTION, crop=b'jpeg') != reanalysis_key(QUESTION)
+
+
+@pytest.mark.parametrize('field', ['question', 'error', 'correct_solution'])
+def test_key_covers_every_prompt_field(field):
+    assert reanalysis_key(dict(QUESTION, **{field: 'something else'})) != reanalysis_key(QUESTION)
@@ -0,0 +1,60 @@
+"""Server-side sessions: expiry, the sweeper and when an unchanged session is written back."""
+import time
+
+import pytest
+
+from mathocr import sessions
+from mathocr.database import db
+
+
+@pytest.fixture
+def interface(app):
+    return app.session_interface
+
+
+def _sid(app, client):
+    return client.get_cookie(app.config['SESSION_COOKIE_NAME']).value
+
+
+def _expire(interface, sid):
+    interface.store.save(sid, interface.store.load(sid)[0], time.time() - 1)
+    interface.cache.delete(sid)
+
+
+def test_expired_session_is_not_loaded(app, login, interface):
+    client = login('session-expired')
+    assert client.post('/uploads', json={}).status_code != 401
+    _expire(interface, _sid(app, client))
+    assert client.post('/uploads', json={}).status_code == 401
+
+
+def test_stale_cache_entry_past_expiry_is_ignored(app, login, interface):
+    client = login('session-cached')
+    sid = _sid(app, client)
+    data, _ = interface.store.load(sid)
+    interface.cache.set(sid, (data, time.time() - 1))
+    assert client.post('/uploads', json={}).status_code == 401
+
+
+def test_sweep_removes_only_expired_sessions(app, login, interface):
+    expired = _sid(app, login('session-swept'))
+    _expire(interface, expired)
+    live = _sid(app, login('session-kept'))
+    interface.store.sweep()
+    assert db().execute('SELECT COUNT(*) FROM sessions WHERE id = ?', (expired,)).fetchone()[0] == 0
+    assert interface.store.load(live) is not None
+
+
+def test_unchanged_session_is_extended_only_past_half_its_lifetime(app, login, interface):
+    client = login('session-extended')
+    sid = _sid(app, client)
+    saves = interface.saves
+    client.get('/history')
+    assert interface.saves == saves
+    data, _ = interface.store.load(sid)
+    soon = time.time() + sessions.SESSION_LIFETIME / 2 - 60
+    interface.store.save(sid, data, soon)
+    interface.cache.delete(sid)
+    client.get('/history')
+    assert interface.saves == saves + 1
+    assert interface.store.load(sid)[1] > soon + 3600
@@ -0,0 +1,153 @@
+"""Resumable uploads: chunks, resuming, checksums, assembly races, login, ownership and the per-user quota."""
+import hashlib
+import os
+import shutil
+import time
+
+import pytest
+
+from mathocr import uploads
+from mathocr.database import db
+from mathocr.uploads import UploadError, upload_store
+
+CHUNK = 1024
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(upload_store, 'chunk_size', CHUNK)
+
+
+def _file(n=2500, seed=b'page'):
+    data = (seed * (n // len(seed) + 1))[:n]
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def _begin(client, upload_id, size):
+    return client.post('/uploads', json={'id': upload_id, 'name': 'a.png', 'type': 'image/png', 'size': size})
+
+
+def _put(client, upload_id, index, data):
+    return client.put(f'/uploads/{upload_id}/{index}', data=data[index * CHUNK:(index + 1) * CHUNK])
+
+
+def test_upload_routes_need_a_login(client):
+    data, upload_id = _file()
+    assert _begin(client, upload_id, len(data)).status_code == 401
+    assert _put(client, upload_id, 0, data).status_code == 401
+
+
+@pytest.fixture
+def owner(logged_in):
+    with logged_in.session_transaction() as session:
+        return session['user']
+
+
+def test_chunks_are_assembled_and_checked(logged_in, owner):
+    data, upload_id = _file()
+    state = _begin(logged_in, upload_id, len(data)).get_json()
+    assert state['missing'] == [0, 1, 2]
+    for index in state['missing']:
+        reply = _put(logged_in, upload_id, index, data).get_json()
+    assert reply['complete']
+    assert upload_store.open(upload_id, owner).read() == data
+    assert not [name for name in os.listdir(upload_store._dir(upload_id, owner)) if name.endswith('.part')]
+    # Uploading the same file again sends nothing
+    assert _begin(logged_in, upload_id, len(data)).get_json() == {'id': upload_id, 'chunk_size': CHUNK,
+                                                                  'missing': [], 'complete': True}
+
+
+def test_interrupted_upload_resumes(logged_in):
+    data, upload_id = _file(seed=b'resume')
+    _begin(logged_in, upload_id, len(data))
+    _put(logged_in, upload_id, 1, data)
+    assert _begin(logged_in, upload_id, len(data)).get_json()['missing'] == [0, 2]
+
+
+def test_wrong_chunk_size_is_rejected(logged_in):
+    data, upload_id = _file(seed=b'short')
+    _begin(logged_in, upload_id, len(data))
+    assert logged_in.put(f'/uploads/{upload_id}/0', data=data[:CHUNK - 1]).status_code == 400
+    assert _begin(logged_in, upload_id, len(data)).get_json()['missing'] == [0, 1, 2]
+
+
+def test_checksum_mismatch_discards_the_upload(logged_in, owner):
+    data, upload_id = _file(seed=b'checksum')
+    _begin(logged_in, upload_id, len(data))
+    forged = b'x' * len(data)
+    _put(logged_in, upload_id, 0, forged)
+    _put(logged_in, upload_id, 1, forged)
+    reply = _put(logged_in, upload_id, 2, forged)
+    assert reply.status_code == 409
+    assert not os.path.exists(upload_store._dir(upload_id, owner))
+    assert _put(logged_in, upload_id, 0, data).status_code == 404
+
+
+def test_assembly_after_another_worker_finished_it(logged_in, owner):
+    data, upload_id = _file(seed=b'race')
+    _begin(logged_in, upload_id, len(data))
+    for index in range(3):
+        _put(logged_in, upload_id, index, data)
+    # The chunks are gone but the file is there: nothing to do
+    upload_store._assemble(upload_id, owner, len(data), CHUNK)
+    assert upload_store.open(upload_id, owner).read() == data
+
+
+def test_assembly_when_the_upload_directory_vanished(logged_in, owner):
+    data, upload_id = _file(seed=b'vanished')
+    _begin(logged_in, upload_id, len(data))
+    shutil.rmtree(upload_store._dir(upload_id, owner))
+    with pytest.raises(UploadError) as e:
+        upload_store._assemble(upload_id, owner, len(data), CHUNK)
+    assert e.value.status == 409
+
+
+def test_quota_is_per_user(logged_in, login, monkeypatch):
+    monkeypatch.setattr(uploads, 'UPLOAD_QUOTA_BYTES', 4000)
+    first, first_id = _file(seed=b'quota-1')
+    second, second_id = _file(seed=b'quota-2')
+    assert _begin(logged_in, first_id, len(first)).status_code == 200
+    assert _begin(logged_in, second_id, len(second)).status_code == 429
+    # An upload already registered is not counted again
+    assert _begin(logged_in, first_id, len(first)).status_code == 200
+    assert _begin(login('tester-quota-other'), second_id, len(second)).status_code == 200
+
+
+def test_every_chunk_keeps_a_slow_upload_alive(logged_in, owner):
+    data, upload_id = _file(seed=b'slow')
+    _begin(logged_in, upload_id, len(data))
+    stale = time.time() - 3600
+    db().execute('UPDATE uploads SET last_used = ? WHERE id = ?', (stale, upload_id))
+    _put(logged_in, upload_id, 0, data)
+    assert db().execute('SELECT last_used FROM uploads WHERE id = ? AND user = ?',
+                        (upload_id, owner)).fetchone()[0] > stale
+    upload_store.sweep(stale + 1)
+    assert _begin(logged_in, upload_id, len(data)).get_json()['missing'] == [1, 2]
+
+
+def test_uploads_are_private_to_their_user(logged_in, login):
+    data, upload_id = _file(seed=b'private')
+    _begin(logged_in, upload_id, len(data))
+    for index in range(3):
+        _put(logged_in, upload_id, index, data)
+    other = login('tester-uploads-other')
+    # Knowing the hash neither reveals that the file is stored nor opens it
+    assert _put(other, upload_id, 0, data).status_code == 404
+    assert _begin(other, upload_id, len(data)).get_json()['missing'] == [0, 1, 2]
+    with pytest.raises(UploadError) as e:
+        upload_store.open(upload_id, 'tester-uploads-other')
+    assert e.value.status == 404
+    reply = other.post('/analyze', data={'uploads': f'[{{"id": "{upload_id}", "name": "a.png"}}]'})
+    assert reply.status_code == 404
+
+
+def test_users_upload_the_same_file_independently(logged_in, owner, login):
+    data, upload_id = _file(seed=b'shared')
+    for user in ('tester-uploads-other', owner):
+        client = login(user)
+        _begin(client, upload_id, len(data))
+        for index in range(3):
+            _put(client, upload_id, index, data)
+    assert upload_store.open(upload_id, owner).read() == data
+    assert upload_store.open(upload_id, 'tester-uploads-other').read() == data
+    assert upload_store._dir(upload_id, owner) != upload_store._dir(upload_id, 'tester-uploads-other')
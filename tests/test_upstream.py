@@ -0,0 +1,135 @@
+"""The OpenAI circuit breaker: opening, failing fast, the half-open probe and closing again."""
+import threading
+import time
+
+import httpx
+import pytest
+from openai import APIConnectionError, BadRequestError
+
+from mathocr import upstream
+from mathocr.upstream import CircuitBreaker, UpstreamUnavailableError
+
+
+def _opened(threshold=3):
+    breaker = CircuitBreaker(threshold=threshold, cooldown=30)
+    for _ in range(threshold):
+        breaker.failure()
+    return breaker
+
+
+def _cool_down(breaker):
+    breaker.opened_at -= breaker.cooldown
+
+
+def test_opens_after_threshold_consecutive_failures():
+    breaker = CircuitBreaker(threshold=3, cooldown=30)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow() and not breaker.reject()
+    breaker.failure()
+    assert breaker.is_open()
+    assert breaker.stats()['times_opened'] == 1
+
+
+def test_open_breaker_rejects_and_counts():
+    breaker = _opened()
+    assert breaker.reject()
+    assert not breaker.allow()
+    assert breaker.stats() == {'state': 'open', 'consecutive_failures': 3, 'times_opened': 1, 'rejected': 2}
+
+
+def test_rejections_are_counted_under_concurrency():
+    breaker = _opened()
+    threads = [threading.Thread(target=lambda: [breaker.reject() for _ in range(1000)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert breaker.rejected == 8000
+
+
+def test_half_open_lets_one_probe_through():
+    breaker = _opened()
+    _cool_down(breaker)
+    assert not breaker.reject()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.stats()['state'] == 'closed'
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_opens_it_again():
+    breaker = _opened()
+    _cool_down(breaker)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.is_open()
+    assert breaker.stats()['times_opened'] == 2
+
+
+def test_call_openai_fails_fast_while_open(monkeypatch):
+    breaker = _opened()
+    monkeypatch.setattr(upstream, 'upstream_breaker', breaker)
+
+    class Completions:
+        def create(self, **kwargs):
+            raise AssertionError('OpenAI called while the breaker is open')
+
+    client = type('Client', (), {'chat': type('Chat', (), {'completions': Completions()})()})()
+    started = time.monotonic()
+    with pytest.raises(UpstreamUnavailableError) as e:
+        upstream.call_openai(client, 'breaker-test', model='gpt-test', messages=[])
+    assert time.monotonic() - started < 1
+    assert e.value.status == 503
+    assert breaker.rejected == 1
+
+
+def test_retries_stop_once_the_breaker_opens(monkeypatch):
+    breaker = CircuitBreaker(threshold=2, cooldown=30)
+    monkeypatch.setattr(upstream, 'upstream_breaker', breaker)
+    monkeypatch.setattr(upstream, '_retry_delay', lambda e, attempt: 0)
+    attempts = []
+
+    def create(timeout):
+        attempts.append(timeout)
+        raise APIConnectionError(request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+
+    with pytest.raises(UpstreamUnavailableError):
+        upstream._with_retries('breaker-test', create, time.monotonic() + 30)
+    assert len(attempts) == 2
+    assert breaker.is_open()
+
+
+def test_refusals_count_as_replies(monkeypatch):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+    _cool_down(breaker)
+    monkeypatch.setattr(upstream, 'upstream_breaker', breaker)
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+    def create(timeout):
+        raise BadRequestError('bad request', response=httpx.Response(400, request=request), body=None)
+
+    with pytest.raises(BadRequestError):
+        upstream._with_retries('breaker-test', create, time.monotonic() + 30)
+    assert breaker.stats()['state'] == 'closed'
+
+
+def test_local_errors_leave_the_breaker_alone(monkeypatch):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+    _cool_down(breaker)
+    monkeypatch.setattr(upstream, 'upstream_breaker', breaker)
+
+    def create(timeout):
+        raise TypeError('unexpected keyword argument')
+
+    with pytest.raises(TypeError):
+        upstream._with_retries('breaker-test', create, time.monotonic() + 30)
+    # Still half-open, with the probe free for the next call
+    assert breaker.stats()['state'] == 'half_open'
+    assert breaker.allow()